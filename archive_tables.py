@@ -0,0 +1,85 @@
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import Column, Index, MetaData, Table, select
+from sqlalchemy.orm import Session
+
+import models
+
+# --- Tablas de Archivo Mensuales ---
+#
+# Los eventos, pagos y filas de conciliación más viejos que el horizonte de retención
+# se mueven (ver data_retention.py) a una tabla por tipo y mes, p. ej.
+# `parking_events_archive_202401`, con las mismas columnas e ids que la tabla
+# original pero sin claves foráneas. Así las tablas "calientes" y sus índices sólo
+# contienen el periodo reciente. El catálogo `archive_months` registra qué meses
+# existen y su rango de ids, de modo que las exportaciones y la analítica pueden
+# sumar las tablas de archivo que correspondan sin inspeccionar el esquema.
+
+class ArchiveKind(NamedTuple):
+    table: Table
+    time_column: str
+
+
+KINDS: Dict[str, ArchiveKind] = {
+    "parking_events": ArchiveKind(models.ParkingEvent.__table__, "event_time"),
+    "payments": ArchiveKind(models.Payment.__table__, "payment_time"),
+    "payment_reconciliations": ArchiveKind(models.PaymentReconciliation.__table__, "reference_time"),
+}
+
+# Metadata propia: create_all de la app no debe crear (ni conocer) las tablas de archivo
+archive_metadata = MetaData()
+
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+def table_name(kind: str, month: datetime) -> str:
+    return f"{kind}_archive_{month:%Y%m}"
+
+def archive_table(kind: str, month: datetime) -> Table:
+    """Definición de la tabla de archivo de `kind` para `month` (no la crea en la BD)."""
+    name = table_name(kind, month)
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+    source, time_column = KINDS[kind]
+    columns = [Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                      autoincrement=False)
+               for column in source.columns]
+    indexes = [Index(f"ix_{name}_time", time_column)]
+    if kind == "payments":
+        # Mismo índice que el listado/exportación por vendedor de la tabla caliente
+        indexes.append(Index(f"ix_{name}_seller_time_id", "seller_id", "payment_time", "id"))
+    if kind == "payment_reconciliations":
+        # El archivador comprueba que cada salida y pago ya tiene su fila archivada
+        indexes += [Index(f"ix_{name}_exit_event", "exit_event_id"), Index(f"ix_{name}_payment", "payment_id")]
+    return Table(name, archive_metadata, *columns, *indexes)
+
+def ensure_archive_table(db: Session, kind: str, month: datetime) -> Table:
+    table = archive_table(kind, month)
+    # En la transacción de la sesión (en SQLite otra conexión quedaría bloqueada por ella)
+    table.create(bind=db.connection(), checkfirst=True)
+    return table
+
+def archived_months(db: Session, kind: str, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    after_id: Optional[int] = None) -> List[models.ArchivedMonth]:
+    """Meses archivados de `kind`, en orden cronológico, que se solapan con [start, end)."""
+    query = select(models.ArchivedMonth).where(models.ArchivedMonth.kind == kind)
+    if start is not None:
+        query = query.where(models.ArchivedMonth.month >= month_start(start))
+    if end is not None:
+        query = query.where(models.ArchivedMonth.month < end)
+    if after_id is not None:
+        query = query.where(models.ArchivedMonth.max_id > after_id)
+    return list(db.execute(query.order_by(models.ArchivedMonth.month)).scalars())
+
+def tables_for_range(db: Session, kind: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Table]:
+    """Tablas de archivo con datos de [start, end), en orden cronológico."""
+    return [archive_table(kind, row.month) for row in archived_months(db, kind, start, end)]
+
+def tables_after_id(db: Session, kind: str, after_id: int) -> List[Table]:
+    """Tablas de archivo que contienen ids mayores que `after_id`."""
+    return [archive_table(kind, row.month) for row in archived_months(db, kind, after_id=after_id)]
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+import schemas
+from settings import settings
+from shared_backend import SharedBackend, shared_backend
+
+# --- Caché de Usuarios Autenticados ---
+#
+# Cada llamada del dashboard pasa por security.get_current_user, que tras validar el
+# JWT consultaba al vendedor (y sus tótems) en la base de datos. Esta caché guarda el
+# `schemas.Seller` ya resuelto por (subject, exp) del token durante un TTL corto; las
+# funciones de crud que modifican al vendedor o sus tótems la invalidan. Como en la
+# caché de tokens de los tótems, las invalidaciones llegan a los demás workers por el
+# pub/sub del backend compartido.
+
+INVALIDATION_CHANNEL = "principal_cache"
+
+
+class PrincipalCache:
+    """LRU acotado con TTL de vendedores autenticados, indexado también por seller_id."""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 60.0, backend: Optional[SharedBackend] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        if backend is not None:
+            backend.subscribe(INVALIDATION_CHANNEL, self._on_invalidation)
+        self._lock = threading.Lock()
+        # (subject, exp) -> (seller, expires_at monotónico)
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[schemas.Seller, float]]" = OrderedDict()
+        # seller_id -> {(subject, exp), ...}
+        self._by_seller: Dict[int, Set[Tuple[str, int]]] = {}
+
+    def get(self, subject: str, exp: int) -> Optional[schemas.Seller]:
+        key = (subject, exp)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            seller, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return seller
+
+    def put(self, subject: str, exp: int, seller: schemas.Seller):
+        """Guarda al vendedor hasta el TTL o hasta que expire el token, lo que ocurra antes."""
+        ttl = min(self.ttl_seconds, exp - time.time())
+        if ttl <= 0:
+            return
+        key = (subject, exp)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (seller, time.monotonic() + ttl)
+            self._by_seller.setdefault(seller.id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate_seller(self, seller_id: Optional[int]):
+        """Invalida al vendedor en este proceso y en los demás que compartan el backend."""
+        if seller_id is None:
+            return
+        if self.backend is None:
+            self._on_invalidation({"seller_id": seller_id})
+        else:
+            # El backend entrega el mensaje también a este proceso
+            self.backend.publish(INVALIDATION_CHANNEL, {"seller_id": seller_id})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_seller.clear()
+
+    def _on_invalidation(self, message: dict):
+        with self._lock:
+            for key in self._by_seller.pop(message["seller_id"], set()):
+                self._entries.pop(key, None)
+
+    def _discard(self, key: Tuple[str, int]):
+        # Debe llamarse con self._lock adquirido
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_seller.get(entry[0].id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_seller[entry[0].id]
+
+
+principal_cache = PrincipalCache(max_entries=settings.AUTH_CACHE_MAX_ENTRIES, ttl_seconds=settings.AUTH_CACHE_TTL_SECONDS,
+                                 backend=shared_backend)
@@ -0,0 +1,111 @@
+"""
+Benchmark de logins concurrentes.
+
+Lanza ráfagas de logins contra /token y, en paralelo, pide tokens de tótems por el
+camino rápido (token en caché), midiendo la latencia de ambos. Sirve para comprobar
+que una ola de logins (cambio de turno) no frena a los tótems del mismo worker.
+
+Se ejecuta contra la app en el mismo proceso (sin red) con una BD propia:
+
+    DATABASE_URL=sqlite:///./bench.db python benchmarks/login_benchmark.py --logins 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx
+
+import main
+import models
+import security
+from database import SessionLocal
+from settings import settings
+from token_cache import totem_token_cache
+
+EMAIL = "bench-login@example.com"
+PASSWORD = "bench-password"
+EXTERNAL_POS_ID = "BENCH_POS"
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summary(name: str, latencies, statuses) -> str:
+    ms = [value * 1000 for value in latencies]
+    counts = {code: statuses.count(code) for code in sorted(set(statuses))}
+    return (f"{name:<8} n={len(ms):<5} p50={percentile(ms, 0.5):8.1f}ms p95={percentile(ms, 0.95):8.1f}ms "
+            f"p99={percentile(ms, 0.99):8.1f}ms max={max(ms, default=0):8.1f}ms mean={statistics.fmean(ms) if ms else 0:8.1f}ms "
+            f"status={counts}")
+
+def setup():
+    models.Base.metadata.create_all(bind=main.engine)
+    db = SessionLocal()
+    try:
+        seller = db.query(models.Seller).filter(models.Seller.email == EMAIL).first()
+        if seller is None:
+            seller = models.Seller(name="Bench", email=EMAIL, hashed_password=security.get_password_hash(PASSWORD))
+            db.add(seller)
+            db.commit()
+        # El token del tótem queda en caché: la petición del tótem no toca la BD ni MP
+        totem_token_cache.put(EXTERNAL_POS_ID, seller.id, "bench-token", datetime.now(timezone.utc) + timedelta(hours=1))
+    finally:
+        db.close()
+
+async def run(logins: int, concurrency: int, totem_interval: float):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        semaphore = asyncio.Semaphore(concurrency)
+        login_latencies, login_statuses = [], []
+        totem_latencies, totem_statuses = [], []
+        done = asyncio.Event()
+
+        async def login():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/token", data={"username": EMAIL, "password": PASSWORD})
+                login_latencies.append(time.perf_counter() - start)
+                login_statuses.append(response.status_code)
+
+        async def totem():
+            headers = {"X-API-Key": settings.TOTEM_API_KEY}
+            while not done.is_set():
+                start = time.perf_counter()
+                response = await client.get(f"/api/v1/totems/token/{EXTERNAL_POS_ID}", headers=headers)
+                totem_latencies.append(time.perf_counter() - start)
+                totem_statuses.append(response.status_code)
+                await asyncio.sleep(totem_interval)
+
+        totem_task = asyncio.create_task(totem())
+        started = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await totem_task
+
+    print(f"bcrypt rounds={settings.BCRYPT_ROUNDS} workers={settings.PASSWORD_HASH_WORKERS} "
+          f"max_pending={settings.PASSWORD_HASH_MAX_PENDING} logins={logins} concurrency={concurrency}")
+    print(summary("login", login_latencies, login_statuses))
+    print(summary("totem", totem_latencies, totem_statuses))
+    print(f"throughput={logins / elapsed:.1f} logins/s hasher={security.password_hasher.status()}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--totem-interval", type=float, default=0.01, help="Pausa entre peticiones del tótem (s)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup()
+    asyncio.run(run(args.logins, args.concurrency, args.totem_interval))
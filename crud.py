@@ -1,27 +1,62 @@
-from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import insert, update, delete, or_, and_, func
+from sqlalchemy.exc import IntegrityError
+import base64
+import json
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.orm import Session, selectinload, joinedload
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, List, Optional
 import logging
-import mercadopago
 
 import models
+import payment_rollups
 import schemas
 import security
 from settings import settings
+from auth_cache import principal_cache
+from live_feed import live_feed
+from mp_client import MercadoPagoClient, MercadoPagoError, mp_client
+from token_cache import totem_token_cache
+from totem_keys import KEY_PREFIX_LENGTH, generate_key, hash_key, totem_key_index
+
+# Filas por sentencia INSERT multi-fila. Acota el número de parámetros por sentencia
+# (SQLite admite pocos) y el tiempo que cada transacción mantiene bloqueos.
+PARKING_EVENT_INSERT_BATCH_SIZE = 500
+
+# --- Mensajes del Canal en Vivo ---
+
+def publish_totem(totem, action: str, seller_id: Optional[int] = None):
+    live_feed.publish(seller_id if seller_id is not None else totem.owner_id, {
+        "type": "totem",
+        "action": action,
+        "totem": schemas.Totem.model_validate(totem).model_dump(mode="json"),
+    })
+
+def publish_payment(payment: models.Payment):
+    live_feed.publish(payment.seller_id, {
+        "type": "payment",
+        "payment": schemas.Payment.model_validate(payment).model_dump(mode="json"),
+    })
+
+def publish_parking_events(inserted: int, duplicates: int):
+    # Los eventos no tienen vendedor asociado: sólo los ven los administradores
+    if inserted:
+        live_feed.publish_admin({"type": "parking_events", "inserted": inserted, "duplicates": duplicates})
 
 # --- Funciones de Refresco de Token ---
 
-def refresh_seller_tokens(db: Session, seller: models.Seller) -> models.Seller:
+def refresh_seller_tokens(db: Session, seller: models.Seller, client: Optional[MercadoPagoClient] = None) -> models.Seller:
     """
     Usa el refresh_token de un vendedor para obtener un nuevo access_token y 
     actualiza al vendedor en la base de datos.
     """
-    sdk = mercadopago.SDK(settings.MP_SECRET_KEY)
+    if client is None:
+        client = mp_client
     try:
-        credentials = sdk.refresh_credentials(seller.mp_refresh_token)
-        if not credentials or "response" not in credentials or "access_token" not in credentials["response"]:
-            # Aquí se debería loguear el error. Si el refresh falla, es un problema serio.
-            # Por ahora, simplemente devolvemos el vendedor sin cambios.
+        credentials = client.refresh_access_token(seller.mp_refresh_token)
+        if credentials["status"] != 200 or not credentials["response"] or "access_token" not in credentials["response"]:
+            # Si el refresh falla, devolvemos el vendedor sin cambios y se reintentará
+            logging.warning(f"No se pudo refrescar el token de MP del vendedor {seller.id} (HTTP {credentials['status']}).")
             return seller
 
         access_token = credentials["response"]["access_token"]
@@ -34,8 +69,8 @@ def refresh_seller_tokens(db: Session, seller: models.Seller) -> models.Seller:
             access_token=access_token,
             refresh_token=refresh_token
         )
-    except Exception as e:
-        # Loguear el error e
+    except MercadoPagoError as e:
+        logging.warning(f"No se pudo refrescar el token de MP del vendedor {seller.id}: {e}")
         return seller
 
 # --- CRUD para Seller ---
@@ -47,7 +82,17 @@ def get_seller_by_email(db: Session, email: str):
     return db.query(models.Seller).options(selectinload(models.Seller.totems)).filter(models.Seller.email == email).first()
 
 def get_sellers(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Seller).offset(skip).limit(limit).all()
+    # Los tótems se cargan en una sola consulta adicional: schemas.Seller los incluye
+    # y la carga perezosa haría una consulta por vendedor
+    return db.query(models.Seller).options(selectinload(models.Seller.totems))\
+        .order_by(models.Seller.id).offset(skip).limit(limit).all()
+
+def get_sellers_with_mp_tokens(db: Session):
+    """Devuelve (id, mp_token_last_updated) de los vendedores con Mercado Pago conectado."""
+    return db.query(models.Seller.id, models.Seller.mp_token_last_updated).filter(
+        models.Seller.mp_refresh_token.isnot(None),
+        models.Seller.mp_token_last_updated.isnot(None)
+    ).all()
 
 def create_seller(db: Session, seller: schemas.SellerCreate):
     hashed_password = security.get_password_hash(seller.password)
@@ -66,6 +111,7 @@ def update_seller(db: Session, seller_id: int, seller_update: schemas.SellerUpda
         db.add(db_seller)
         db.commit()
         db.refresh(db_seller)
+        principal_cache.invalidate_seller(seller_id)
     return db_seller
 
 def update_seller_mp_tokens(db: Session, seller_id: int, access_token: str, refresh_token: str):
@@ -77,6 +123,8 @@ def update_seller_mp_tokens(db: Session, seller_id: int, access_token: str, refr
         db.add(db_seller)
         db.commit()
         db.refresh(db_seller)
+    totem_token_cache.invalidate_seller(seller_id)
+    principal_cache.invalidate_seller(seller_id)
     return db_seller
 
 def disconnect_seller_mp(db: Session, seller_id: int):
@@ -88,13 +136,18 @@ def disconnect_seller_mp(db: Session, seller_id: int):
         db.add(db_seller)
         db.commit()
         db.refresh(db_seller)
+    totem_token_cache.invalidate_seller(seller_id)
+    principal_cache.invalidate_seller(seller_id)
     return db_seller
 
 def delete_seller(db: Session, seller_id: int):
     db_seller = db.query(models.Seller).filter(models.Seller.id == seller_id).first()
     if db_seller:
+        db.query(models.PaymentSyncState).filter(models.PaymentSyncState.seller_id == seller_id).delete(synchronize_session=False)
         db.delete(db_seller)
         db.commit()
+        totem_token_cache.invalidate_seller(seller_id)
+        principal_cache.invalidate_seller(seller_id)
     return db_seller
 
 # --- CRUD para Totem ---
@@ -103,7 +156,8 @@ def get_totem(db: Session, totem_id: int):
     return db.query(models.Totem).filter(models.Totem.id == totem_id).first()
 
 def get_totem_by_external_id(db: Session, external_pos_id: str):
-    return db.query(models.Totem).filter(models.Totem.external_pos_id == external_pos_id).first()
+    # El dueño se carga en la misma consulta: el endpoint de tokens siempre lo necesita
+    return db.query(models.Totem).options(joinedload(models.Totem.owner)).filter(models.Totem.external_pos_id == external_pos_id).first()
 
 def get_totems(db: Session, skip: int = 0, limit: int = 100, owner_id: int = None):
     query = db.query(models.Totem)
@@ -121,99 +175,424 @@ def create_totem(db: Session, totem: schemas.TotemCreate):
     db.add(db_totem)
     db.commit()
     db.refresh(db_totem)
+    principal_cache.invalidate_seller(db_totem.owner_id)
+    publish_totem(db_totem, "created")
     return db_totem
 
 def update_totem(db: Session, totem_id: int, totem_update: schemas.TotemUpdate):
     db_totem = db.query(models.Totem).filter(models.Totem.id == totem_id).first()
     if db_totem:
+        # Invalidamos con el external_pos_id anterior, ya que puede cambiar
+        totem_token_cache.invalidate_totem(db_totem.external_pos_id)
+        previous_owner_id = db_totem.owner_id
         update_data = totem_update.model_dump(exclude_unset=True)
         for key, value in update_data.items():
             setattr(db_totem, key, value)
         db.add(db_totem)
         db.commit()
         db.refresh(db_totem)
+        # El tótem puede haber cambiado de dueño: invalidamos a ambos
+        principal_cache.invalidate_seller(previous_owner_id)
+        principal_cache.invalidate_seller(db_totem.owner_id)
+        if previous_owner_id != db_totem.owner_id:
+            publish_totem(db_totem, "deleted", seller_id=previous_owner_id)
+        publish_totem(db_totem, "updated")
+        # Cambia el external_pos_id, el dueño o is_active de las keys del tótem
+        totem_key_index.invalidate(db)
     return db_totem
 
 def delete_totem(db: Session, totem_id: int):
     db_totem = db.query(models.Totem).filter(models.Totem.id == totem_id).first()
     if db_totem:
+        totem_token_cache.invalidate_totem(db_totem.external_pos_id)
+        deleted = schemas.Totem.model_validate(db_totem)
+        db.query(models.TotemApiKey).filter(models.TotemApiKey.totem_id == totem_id).delete(synchronize_session=False)
         db.delete(db_totem)
         db.commit()
+        totem_key_index.invalidate(db)
+        principal_cache.invalidate_seller(db_totem.owner_id)
+        publish_totem(deleted, "deleted")
     return db_totem
 
+# --- API Keys de Tótems ---
+
+def get_totem_api_keys(db: Session, totem_id: int):
+    return db.query(models.TotemApiKey).filter(models.TotemApiKey.totem_id == totem_id)\
+        .order_by(models.TotemApiKey.id).all()
+
+def create_totem_api_key(db: Session, totem_id: int) -> schemas.TotemApiKeyCreated:
+    """Crea una key para el tótem. La key en claro sólo está en el valor devuelto."""
+    api_key = generate_key()
+    db_key = models.TotemApiKey(totem_id=totem_id, key_hash=hash_key(api_key), key_prefix=api_key[:KEY_PREFIX_LENGTH])
+    db.add(db_key)
+    db.commit()
+    db.refresh(db_key)
+    totem_key_index.invalidate(db)
+    return schemas.TotemApiKeyCreated(**schemas.TotemApiKey.model_validate(db_key).model_dump(), api_key=api_key)
+
+def revoke_totem_api_key(db: Session, totem_id: int, key_id: int):
+    db_key = db.query(models.TotemApiKey).filter(
+        models.TotemApiKey.id == key_id, models.TotemApiKey.totem_id == totem_id
+    ).first()
+    if db_key and db_key.revoked_at is None:
+        db_key.revoked_at = datetime.utcnow()
+        db.commit()
+        db.refresh(db_key)
+        totem_key_index.invalidate(db)
+    return db_key
+
+def encode_payment_cursor(payment: models.Payment) -> str:
+    """Cursor opaco que apunta a la posición de un pago en el orden (payment_time, id) descendente."""
+    raw = json.dumps({"t": payment.payment_time.isoformat(), "id": payment.id})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_payment_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decodifica un cursor de encode_payment_cursor. Lanza ValueError si es inválido."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return datetime.fromisoformat(data["t"]), int(data["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+def payments_by_seller_filters(
+    seller_id: int,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    after: Optional[tuple[datetime, int]] = None
+) -> list:
+    """Condiciones comunes del listado de pagos (usadas también por crud_async)."""
+    conditions = [models.Payment.seller_id == seller_id]
+    if start_date:
+        conditions.append(models.Payment.payment_time >= start_date)
+    if end_date:
+        # Añadimos un día para que la fecha final sea inclusiva
+        conditions.append(models.Payment.payment_time < end_date + timedelta(days=1))
+    if after:
+        # Keyset: sólo filas estrictamente posteriores al cursor en orden descendente
+        after_time, after_id = after
+        conditions.append(or_(
+            models.Payment.payment_time < after_time,
+            and_(models.Payment.payment_time == after_time, models.Payment.id < after_id)
+        ))
+    return conditions
+
 def get_payments_by_seller(
     db: Session, 
     seller_id: int, 
     skip: int = 0, 
     limit: int = 20, 
     start_date: Optional[datetime] = None, 
-    end_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None,
+    after: Optional[tuple[datetime, int]] = None
 ):
     """
     Obtiene los pagos de un vendedor específico, con filtros opcionales de fecha,
-    ordenados por fecha descendente.
+    ordenados por fecha descendente. Con `after` (posición decodificada de un cursor)
+    pagina por keyset sobre el índice (seller_id, payment_time, id); `skip` se
+    mantiene como alternativa por offset.
     """
-    query = db.query(models.Payment).filter(models.Payment.seller_id == seller_id)
-    if start_date:
-        query = query.filter(models.Payment.payment_time >= start_date)
-    if end_date:
-        # Añadimos un día para que la fecha final sea inclusiva
-        query = query.filter(models.Payment.payment_time < end_date + timedelta(days=1))
-        
+    query = db.query(models.Payment).filter(*payments_by_seller_filters(seller_id, start_date, end_date, after))
     return query\
-        .order_by(models.Payment.payment_time.desc())\
+        .order_by(models.Payment.payment_time.desc(), models.Payment.id.desc())\
         .offset(skip).limit(limit).all()
 
-def create_parking_events(db: Session, events: list[schemas.ParkingEventCreate]):
-    # Esta función podría ser más compleja, manejando duplicados, etc.
-    # Por ahora, simplemente los crea.
+def _insert_ignore_duplicates(dialect: str, table):
+    """
+    Construye un INSERT que descarta silenciosamente las filas que violan una
+    restricción única, usando la sintaxis propia de cada motor.
+    """
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect in ("mysql", "mariadb"):
+        return insert(table).prefix_with("IGNORE")
+    return insert(table)
+
+def _parking_event_chunks(events: list[schemas.ParkingEventCreate]):
+    """Deduplica el lote por clave natural y lo divide en trozos para INSERT multi-fila."""
+    rows = {}
     for event_data in events:
-        db_event = models.ParkingEvent(**event_data.model_dump())
-        db.add(db_event)
+        row = event_data.model_dump()
+        rows.setdefault((row["ticket_code"], row["device_id"], row["event_type"], row["event_time"]), row)
+    rows = list(rows.values())
+    for start in range(0, len(rows), PARKING_EVENT_INSERT_BATCH_SIZE):
+        yield rows[start:start + PARKING_EVENT_INSERT_BATCH_SIZE]
+
+def create_parking_events(db: Session, events: list[schemas.ParkingEventCreate]) -> tuple[int, int]:
+    """
+    Inserta un lote de eventos de forma idempotente, en sentencias multi-fila.
+    Los eventos ya registrados (misma clave natural) se ignoran, de modo que un tótem
+    puede reenviar un lote completo tras un timeout sin duplicar datos.
+    Devuelve (insertados, duplicados).
+    """
+    inserted = 0
+    statement = _insert_ignore_duplicates(db.get_bind().dialect.name, models.ParkingEvent.__table__)
+    for chunk in _parking_event_chunks(events):
+        result = db.execute(statement.values(chunk))
+        # Cada lote es idempotente, así que podemos confirmarlo por separado
+        db.commit()
+        inserted += result.rowcount
+    publish_parking_events(inserted, len(events) - inserted)
+    return inserted, len(events) - inserted
+
+def get_payment_by_mp_id(db: Session, mp_payment_id: str):
+    return db.query(models.Payment).filter(models.Payment.mp_payment_id == mp_payment_id).first()
+
+def _apply_payment_changes(db_payment: models.Payment, values: dict) -> bool:
+    changed = False
+    for key, value in values.items():
+        if getattr(db_payment, key) != value:
+            setattr(db_payment, key, value)
+            changed = True
+    return changed
+
+def upsert_payment(db: Session, values: dict) -> tuple[models.Payment, bool]:
+    """
+    Crea el pago o actualiza el existente con el mismo `mp_payment_id` (por ejemplo,
+    cuando pasa de 'pending' a 'approved'). Devuelve (pago, hubo_cambios).
+    """
+    db_payment = get_payment_by_mp_id(db, values["mp_payment_id"])
+    if db_payment is None:
+        db_payment = models.Payment(**values)
+        db.add(db_payment)
+        # Los rollups de recaudación se actualizan en la misma transacción que el pago
+        payment_rollups.apply_payment_change(db, None, db_payment)
+        try:
+            db.commit()
+            return db_payment, True
+        except IntegrityError:
+            # Otro worker lo insertó entre nuestra consulta y el INSERT
+            db.rollback()
+            db_payment = get_payment_by_mp_id(db, values["mp_payment_id"])
+    before = payment_rollups.snapshot(db_payment)
+    if not _apply_payment_changes(db_payment, values):
+        return db_payment, False
+    payment_rollups.apply_payment_change(db, before, db_payment)
     db.commit()
-    return
+    return db_payment, True
+
+def upsert_payments(db: Session, values_list: List[dict]) -> List[models.Payment]:
+    """
+    Versión por lotes de upsert_payment: una sola consulta para los pagos ya
+    existentes y un único commit para todo el lote. Devuelve los pagos creados o
+    modificados.
+    """
+    # Un mismo pago puede venir repetido (p. ej. si cambió mientras se paginaba): gana el último
+    by_mp_id = {values["mp_payment_id"]: values for values in values_list}
+    if not by_mp_id:
+        return []
+    existing = {
+        db_payment.mp_payment_id: db_payment
+        for db_payment in db.query(models.Payment).filter(models.Payment.mp_payment_id.in_(list(by_mp_id)))
+    }
+    changed = []
+    for mp_payment_id, values in by_mp_id.items():
+        db_payment = existing.get(mp_payment_id)
+        if db_payment is None:
+            db_payment = models.Payment(**values)
+            db.add(db_payment)
+            payment_rollups.apply_payment_change(db, None, db_payment)
+            changed.append(db_payment)
+            continue
+        before = payment_rollups.snapshot(db_payment)
+        if _apply_payment_changes(db_payment, values):
+            payment_rollups.apply_payment_change(db, before, db_payment)
+            changed.append(db_payment)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Un webhook guardó alguno de estos pagos a la vez: se rehace el lote de a uno
+        db.rollback()
+        return [db_payment for db_payment, was_changed in (upsert_payment(db, values) for values in by_mp_id.values()) if was_changed]
+    return changed
+
+def get_totem_owners(db: Session, external_pos_ids: List[str]) -> Dict[str, int]:
+    """Mapa external_pos_id -> owner_id de los tótems indicados, en una sola consulta."""
+    if not external_pos_ids:
+        return {}
+    return dict(db.query(models.Totem.external_pos_id, models.Totem.owner_id).filter(models.Totem.external_pos_id.in_(external_pos_ids)).all())
+
+def payment_values_from_mp(db: Session, payment: dict, default_seller_id: Optional[int] = None,
+                           totem_owners: Optional[Dict[str, int]] = None) -> dict:
+    """
+    Convierte un pago tal como lo devuelve la API de Mercado Pago en los valores de
+    un `models.Payment`. El vendedor se obtiene del tótem indicado en la referencia
+    externa (de `totem_owners` si se pasa, para no consultar pago por pago); si no
+    se encuentra, se usa `default_seller_id`.
+    """
+    # Parsear la referencia externa para obtener ticket y pos_id
+    external_reference = payment.get("external_reference") or ""
+    parts = external_reference.split('-')
+    ticket_code = parts[0] if parts else None
+    external_pos_id = parts[1] if len(parts) > 1 else None
+
+    # Encontrar al vendedor a través del tótem
+    seller_id = default_seller_id
+    if external_pos_id and totem_owners is not None:
+        seller_id = totem_owners.get(external_pos_id, default_seller_id)
+    elif external_pos_id:
+        totem = get_totem_by_external_id(db, external_pos_id)
+        if totem:
+            seller_id = totem.owner_id
+
+    # Los pagos aún no aprobados no tienen date_approved
+    payment_time = payment.get("date_approved") or payment["date_created"]
+
+    return {
+        "mp_payment_id": str(payment["id"]),
+        "ticket_code": ticket_code,
+        "external_pos_id": external_pos_id,
+        "amount": payment["transaction_amount"],
+        "status": payment["status"],
+        # Se guarda la hora local de MP sin zona (como la almacena la columna DateTime),
+        # para que volver a ver el mismo pago no cuente como un cambio
+        "payment_time": datetime.fromisoformat(payment_time).replace(tzinfo=None),
+        "seller_id": seller_id,
+    }
 
 def process_payment_notification(db: Session, payment_id: str):
     """
     Obtiene los detalles de un pago de MP y lo guarda en la BD del backoffice.
+    Si el pago ya existe, actualiza su estado en lugar de fallar.
+    Lanza una excepción si el pago no pudo procesarse, para que la cola de
+    notificaciones lo reintente.
     """
     try:
         # Usamos el token del marketplace para poder ver todos los pagos
-        sdk = mercadopago.SDK(settings.MP_SECRET_KEY) # Asumiendo que el secret es el access token del marketplace
-        payment_info = sdk.payment().get(payment_id)
+        # (asumiendo que el secret es el access token del marketplace)
+        payment_info = mp_client.get_payment(payment_id, access_token=settings.MP_SECRET_KEY)
 
         if payment_info["status"] != 200:
-            logging.error(f"No se pudo obtener el detalle del pago {payment_id} desde Mercado Pago.")
-            return
+            raise RuntimeError(f"No se pudo obtener el detalle del pago {payment_id} desde Mercado Pago (HTTP {payment_info['status']}).")
 
         payment = payment_info["response"]
-        
-        # Parsear la referencia externa para obtener ticket y pos_id
-        external_reference = payment.get("external_reference", "")
-        parts = external_reference.split('-')
-        ticket_code = parts[0] if parts else None
-        external_pos_id = parts[1] if len(parts) > 1 else None
-
-        # Encontrar al vendedor a través del tótem
-        seller_id = None
-        if external_pos_id:
-            totem = get_totem_by_external_id(db, external_pos_id)
-            if totem:
-                seller_id = totem.owner_id
-
-        db_payment = models.Payment(
-            mp_payment_id=str(payment["id"]),
-            ticket_code=ticket_code,
-            external_pos_id=external_pos_id,
-            amount=payment["transaction_amount"],
-            status=payment["status"],
-            payment_time=datetime.fromisoformat(payment["date_approved"]),
-            seller_id=seller_id
-        )
-        db.add(db_payment)
-        db.commit()
-        logging.info(f"Pago {payment_id} procesado y guardado en la base de datos del backoffice.")
+        db_payment, changed = upsert_payment(db, payment_values_from_mp(db, payment))
+        if changed:
+            publish_payment(db_payment)
+            logging.info(f"Pago {payment_id} procesado y guardado en la base de datos del backoffice (estado: {payment['status']}).")
+        else:
+            logging.info(f"Pago {payment_id} sin cambios respecto a lo ya registrado.")
 
     except Exception as e:
         logging.error(f"Error procesando la notificación de pago {payment_id}: {e}")
         db.rollback()
+        raise
+
+# --- Cola persistente de notificaciones de Mercado Pago ---
+
+def enqueue_webhook_notification(db: Session, topic: str, resource_id: str, action: Optional[str] = None):
+    """
+    Encola una notificación. Si ya hay una pendiente para el mismo recurso, no se
+    crea otra: cuando se procese, la consulta a MP devolverá el estado más reciente.
+    """
+    db_notification = db.query(models.WebhookNotification).filter(
+        models.WebhookNotification.topic == topic,
+        models.WebhookNotification.resource_id == resource_id,
+        models.WebhookNotification.status == "pending"
+    ).first()
+    if db_notification:
+        return db_notification
+    db_notification = models.WebhookNotification(
+        topic=topic,
+        action=action,
+        resource_id=resource_id,
+        status="pending",
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.add(db_notification)
+    db.commit()
+    db.refresh(db_notification)
+    return db_notification
+
+def claim_webhook_notifications(db: Session, limit: int, lock_timeout_seconds: float):
+    """
+    Reserva hasta `limit` notificaciones listas para procesarse y las marca como
+    'processing'. También recupera las que quedaron en 'processing' más allá de
+    `lock_timeout_seconds` (el worker que las tenía murió).
+    En MySQL/PostgreSQL usa SELECT ... FOR UPDATE SKIP LOCKED para que varios workers
+    no compitan por las mismas filas; en SQLite (que no lo soporta) la reserva se
+    garantiza con un UPDATE condicional por fila.
+    """
+    now = datetime.utcnow()
+    ready = or_(
+        and_(models.WebhookNotification.status == "pending", models.WebhookNotification.next_attempt_at <= now),
+        and_(
+            models.WebhookNotification.status == "processing",
+            models.WebhookNotification.locked_at < now - timedelta(seconds=lock_timeout_seconds)
+        ),
+    )
+    query = db.query(models.WebhookNotification.id, models.WebhookNotification.status)\
+        .filter(ready)\
+        .order_by(models.WebhookNotification.next_attempt_at)\
+        .limit(limit)
+    if db.get_bind().dialect.name != "sqlite":
+        query = query.with_for_update(skip_locked=True)
+
+    claimed_ids = []
+    for notification_id, current_status in query.all():
+        result = db.execute(
+            update(models.WebhookNotification)
+            .where(models.WebhookNotification.id == notification_id, models.WebhookNotification.status == current_status, ready)
+            .values(status="processing", locked_at=now)
+        )
+        if result.rowcount:
+            claimed_ids.append(notification_id)
+    db.commit()
+    if not claimed_ids:
+        return []
+    return db.query(models.WebhookNotification).filter(models.WebhookNotification.id.in_(claimed_ids)).all()
+
+def complete_webhook_notification(db: Session, notification_id: int):
+    db.execute(
+        update(models.WebhookNotification)
+        .where(models.WebhookNotification.id == notification_id)
+        .values(status="done", locked_at=None, last_error=None)
+    )
+    db.commit()
+
+def fail_webhook_notification(db: Session, notification_id: int, error: str, max_attempts: int, retry_base_seconds: float):
+    """
+    Registra un intento fallido. Reprograma la notificación con backoff exponencial
+    o la mueve a 'dead' (dead-letter) si agotó los intentos.
+    """
+    db_notification = db.query(models.WebhookNotification).filter(models.WebhookNotification.id == notification_id).first()
+    if not db_notification:
+        return None
+    db_notification.attempts += 1
+    db_notification.last_error = error[:2000]
+    db_notification.locked_at = None
+    if db_notification.attempts >= max_attempts:
+        db_notification.status = "dead"
+    else:
+        db_notification.status = "pending"
+        db_notification.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_base_seconds * (2 ** (db_notification.attempts - 1)))
+    db.commit()
+    return db_notification
+
+def purge_done_webhook_notifications(db: Session, older_than: datetime, batch_size: int = 500) -> int:
+    """
+    Borra las notificaciones ya procesadas ('done') cuya última actualización es
+    anterior a `older_than`, en lotes de `batch_size` filas por transacción. Las
+    'dead' se conservan para poder revisarlas. Devuelve cuántas filas borró.
+    """
+    deleted = 0
+    while True:
+        ids = [row_id for (row_id,) in db.query(models.WebhookNotification.id).filter(
+            models.WebhookNotification.status == "done",
+            models.WebhookNotification.updated_at < older_than
+        ).order_by(models.WebhookNotification.id).limit(batch_size).all()]
+        if not ids:
+            return deleted
+        deleted += db.execute(
+            delete(models.WebhookNotification)
+            .where(models.WebhookNotification.id.in_(ids), models.WebhookNotification.status == "done")
+        ).rowcount
+        db.commit()
+
+def count_webhook_notifications_by_status(db: Session) -> dict:
+    rows = db.query(models.WebhookNotification.status, func.count(models.WebhookNotification.id))\
+        .group_by(models.WebhookNotification.status).all()
+    return {row_status: count for row_status, count in rows}
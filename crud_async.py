@@ -0,0 +1,54 @@
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, joinedload
+from datetime import datetime
+from typing import Optional
+
+import crud
+import models
+import schemas
+
+# --- Variantes asíncronas de crud para los endpoints más usados ---
+# Mismo comportamiento que sus equivalentes en crud.py, pero sobre AsyncSession.
+
+async def get_seller_by_email(db: AsyncSession, email: str):
+    result = await db.execute(
+        select(models.Seller).options(selectinload(models.Seller.totems)).where(models.Seller.email == email)
+    )
+    return result.scalars().first()
+
+async def update_seller_password_hash(db: AsyncSession, seller_id: int, hashed_password: str):
+    await db.execute(update(models.Seller).where(models.Seller.id == seller_id).values(hashed_password=hashed_password))
+    await db.commit()
+
+async def get_totem_by_external_id(db: AsyncSession, external_pos_id: str):
+    result = await db.execute(
+        select(models.Totem).options(joinedload(models.Totem.owner)).where(models.Totem.external_pos_id == external_pos_id)
+    )
+    return result.scalars().first()
+
+async def get_payments_by_seller(
+    db: AsyncSession,
+    seller_id: int,
+    skip: int = 0,
+    limit: int = 20,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    after: Optional[tuple[datetime, int]] = None
+):
+    query = select(models.Payment)\
+        .where(*crud.payments_by_seller_filters(seller_id, start_date, end_date, after))\
+        .order_by(models.Payment.payment_time.desc(), models.Payment.id.desc())\
+        .offset(skip).limit(limit)
+    result = await db.execute(query)
+    return result.scalars().all()
+
+async def create_parking_events(db: AsyncSession, events: list[schemas.ParkingEventCreate]) -> tuple[int, int]:
+    inserted = 0
+    statement = crud._insert_ignore_duplicates(db.bind.dialect.name, models.ParkingEvent.__table__)
+    for chunk in crud._parking_event_chunks(events):
+        result = await db.execute(statement.values(chunk))
+        await db.commit()
+        inserted += result.rowcount
+    crud.publish_parking_events(inserted, len(events) - inserted)
+    return inserted, len(events) - inserted
@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from sqlalchemy import and_, delete, exists, false, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+import archive_tables
+import models
+import parking_analytics
+import payment_reconciliation
+from shared_backend import JobLock, SharedBackend
+
+logger = logging.getLogger(__name__)
+
+# --- Retención y Archivo de Datos Históricos ---
+#
+# `parking_events` y `payments` crecen sin límite y con ellos sus índices, que son los
+# que usan las escrituras de los tótems y los webhooks. Este proceso mueve los meses
+# completos anteriores al horizonte de retención a tablas de archivo mensuales (ver
+# archive_tables.py): en cada tanda copia las filas con INSERT ... SELECT, las borra
+# de la tabla principal y actualiza el catálogo, todo en la misma transacción. Las
+# exportaciones, los totales de recaudación y las reconstrucciones de analítica leen
+# también el archivo, así que los datos movidos siguen siendo consultables.
+#
+# Una fila sólo se archiva cuando ya nadie la va a volver a leer de la tabla principal:
+# los eventos, cuando la analítica ya los procesó (marca de agua); los eventos y pagos,
+# cuando ninguna fila de conciliación en uso los referencia (por eso las filas de
+# conciliación viejas se archivan primero). Además, como la reconstrucción de la
+# conciliación sólo lee las tablas principales, una salida o un pago con ticket sólo
+# se archiva si su fila de conciliación ya está en el archivo: no basta con que su id
+# sea menor que la marca de agua, porque una fila que la conciliación saltó quedaría
+# perdida. Se archiva mes a mes para buscar esas filas sólo en los meses vecinos.
+
+JOB_LOCK_NAME = "job:data_archive"
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _update_catalog(db: Session, kind: str, month: datetime, rows: int, min_id: int, max_id: int):
+    entry = db.execute(
+        select(models.ArchivedMonth).where(models.ArchivedMonth.kind == kind, models.ArchivedMonth.month == month)
+    ).scalar_one_or_none()
+    if entry is None:
+        entry = models.ArchivedMonth(kind=kind, month=month, table_name=archive_tables.table_name(kind, month),
+                                     row_count=0, min_id=min_id, max_id=max_id)
+        db.add(entry)
+        db.flush()
+    entry.row_count += rows
+    entry.min_id = min(entry.min_id, min_id) if entry.min_id is not None else min_id
+    entry.max_id = max(entry.max_id, max_id) if entry.max_id is not None else max_id
+
+def archive_batch(db: Session, kind: str, month: datetime, conditions: list, batch_size: int = 500) -> int:
+    """
+    Mueve al archivo hasta `batch_size` filas de `kind` del mes que empieza en `month`
+    que cumplen `conditions`. Devuelve el número de filas movidas.
+    """
+    table, time_column = archive_tables.KINDS[kind]
+    ids = db.execute(
+        select(table.c.id)
+        .where(table.c[time_column] >= month, table.c[time_column] < archive_tables.next_month(month), *conditions)
+        .order_by(table.c.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+
+    # DDL antes de mover nada: en MySQL un CREATE TABLE confirma la transacción en curso
+    archive = archive_tables.ensure_archive_table(db, kind, month)
+    replaced = 0
+    if kind == "payments":
+        # Un pago archivado que volvió a llegar por webhook/backfill reemplaza a su copia anterior
+        replaced = db.execute(delete(archive).where(
+            archive.c.mp_payment_id.in_(select(table.c.mp_payment_id).where(table.c.id.in_(ids)))
+        )).rowcount
+    columns = [column.name for column in table.columns]
+    # Se cuentan las filas realmente copiadas y borradas, no los ids leídos: otra
+    # ejecución puede haber movido algunas entre la lectura y esta tanda
+    inserted = db.execute(insert(archive).from_select(columns, select(*table.columns).where(table.c.id.in_(ids)))).rowcount
+    moved = db.execute(delete(table).where(table.c.id.in_(ids))).rowcount
+    if moved:
+        _update_catalog(db, kind, month, inserted - replaced, min(ids), max(ids))
+    db.commit()
+    return moved
+
+def catalog_summary(db: Session) -> dict:
+    rows = db.execute(
+        select(models.ArchivedMonth.kind, func.count(models.ArchivedMonth.id), func.sum(models.ArchivedMonth.row_count),
+               func.min(models.ArchivedMonth.month), func.max(models.ArchivedMonth.month))
+        .group_by(models.ArchivedMonth.kind)
+    ).all()
+    return {
+        kind: {"months": months, "rows": int(total or 0), "oldest_month": oldest, "newest_month": newest}
+        for kind, months, total, oldest, newest in rows
+    }
+
+
+class DataArchiver:
+    """
+    Tarea en segundo plano que archiva cada `interval_seconds` los meses vencidos de
+    eventos y pagos. Con `wait_for_analytics`, los eventos sólo se archivan hasta la
+    marca de agua de la analítica; con `wait_for_reconciliation`, las salidas y pagos
+    sólo si ya tienen su fila de conciliación archivada. Con `backend`, cada ejecución
+    toma un lock compartido para que sólo archive un worker a la vez.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        interval_seconds: float = 3600.0,
+        batch_size: int = 500,
+        events_retention_days: float = 90.0,
+        payments_retention_days: float = 400.0,
+        wait_for_analytics: bool = True,
+        wait_for_reconciliation: bool = True,
+        backend: Optional[SharedBackend] = None,
+        lock_ttl_seconds: float = 900.0,
+    ):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        # Los ids de cada tanda van en cláusulas IN (SQLite admite pocos parámetros)
+        self.batch_size = min(batch_size, payment_reconciliation.QUERY_CHUNK_SIZE)
+        self.events_retention = timedelta(days=events_retention_days)
+        self.payments_retention = timedelta(days=payments_retention_days)
+        self.wait_for_analytics = wait_for_analytics
+        self.wait_for_reconciliation = wait_for_reconciliation
+        self.backend = backend
+        self.lock_ttl_seconds = lock_ttl_seconds
+
+        self._task: Optional[asyncio.Task] = None
+        self._run_lock: Optional[asyncio.Lock] = None
+
+        self.totals = {kind: 0 for kind in archive_tables.KINDS}
+        self.runs_total = 0
+        self.failures_total = 0
+        self.skipped_total = 0 # Ejecuciones omitidas porque otro worker tenía el lock
+        self.last_run_at: Optional[datetime] = None
+        self.last_run_seconds = 0.0
+        self.last_run: Optional[dict] = None
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def is_archiving(self) -> bool:
+        return self._run_lock is not None and self._run_lock.locked()
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._run_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Archivo de datos históricos iniciado.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        logger.info("Archivo de datos históricos detenido.")
+
+    # --- API pública ---
+
+    def status(self) -> dict:
+        db = self.session_factory()
+        try:
+            summary = catalog_summary(db)
+        finally:
+            db.close()
+        now = _utcnow()
+        return {
+            "running": self.is_running,
+            "archiving": self.is_archiving,
+            "cutoffs": {
+                "parking_events": archive_tables.month_start(now - self.events_retention),
+                "payments": archive_tables.month_start(now - self.payments_retention),
+            },
+            "archive": summary,
+            "totals": dict(self.totals),
+            "runs_total": self.runs_total,
+            "failures_total": self.failures_total,
+            "skipped_total": self.skipped_total,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": round(self.last_run_seconds, 3),
+            "last_run": self.last_run,
+        }
+
+    async def run_all(self) -> Optional[dict]:
+        """Archiva todo lo vencido. Devuelve None si otro worker tenía el lock del archivado."""
+        if self._run_lock is None:
+            self._run_lock = asyncio.Lock()
+        async with self._run_lock:
+            started = time.monotonic()
+            try:
+                run = await asyncio.to_thread(self.archive_pending)
+            except Exception:
+                self.failures_total += 1
+                raise
+            if run is None:
+                self.skipped_total += 1
+                return None
+            for kind, moved in run.items():
+                self.totals[kind] += moved
+            self.runs_total += 1
+            self.last_run_at = datetime.now(timezone.utc)
+            self.last_run_seconds = time.monotonic() - started
+            self.last_run = run
+            return run
+
+    def request_run(self) -> bool:
+        """Lanza un archivado sin esperarlo. Devuelve False si ya hay uno en curso."""
+        if self.is_archiving:
+            return False
+        task = asyncio.create_task(self.run_all())
+        task.add_done_callback(self._log_failure)
+        return True
+
+    def archive_pending(self) -> Optional[dict]:
+        """
+        Archiva por tandas todo lo vencido. Devuelve las filas movidas por tabla, o None
+        si otro worker tenía el lock del archivado.
+        """
+        job_lock = JobLock(self.backend, JOB_LOCK_NAME, self.lock_ttl_seconds)
+        if not job_lock.acquire():
+            return None
+        now = _utcnow()
+        events_cutoff = archive_tables.month_start(now - self.events_retention)
+        payments_cutoff = archive_tables.month_start(now - self.payments_retention)
+        run = {kind: 0 for kind in archive_tables.KINDS}
+        db = self.session_factory()
+        steps = [
+            # Conciliación primero: libera los eventos y pagos que referencia
+            ("payment_reconciliations", events_cutoff, lambda month: []),
+            ("parking_events", events_cutoff, lambda month: self._event_conditions(db, month)),
+            ("payments", payments_cutoff, lambda month: self._payment_conditions(db, month)),
+        ]
+        try:
+            for kind, cutoff, conditions_for in steps:
+                # Si se pierde el lock, otro worker ya está archivando: se deja de mover filas
+                run[kind] = self._archive_kind(db, kind, cutoff, conditions_for, job_lock.keep)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+            job_lock.release()
+        return run
+
+    # --- Implementación ---
+
+    def _reconciled(self, db: Session, column: str, row_id, month: datetime, margin_months: int = 0):
+        """La fila de conciliación que referencia `row_id` está en el archivo del mes (± margen)."""
+        start, end = month, archive_tables.next_month(month)
+        for _ in range(margin_months):
+            start, end = archive_tables.month_start(start - timedelta(days=1)), archive_tables.next_month(end)
+        tables = archive_tables.tables_for_range(db, "payment_reconciliations", start, end)
+        return or_(false(), *(exists().where(table.c[column] == row_id) for table in tables))
+
+    def _event_conditions(self, db: Session, month: datetime) -> list:
+        event = models.ParkingEvent
+        conditions = [~exists().where(models.PaymentReconciliation.exit_event_id == event.id)]
+        if self.wait_for_analytics:
+            conditions.append(event.id <= parking_analytics.get_watermark(db))
+        if self.wait_for_reconciliation:
+            exit_types = [name for name, normalized in parking_analytics.EVENT_TYPES.items()
+                          if normalized == parking_analytics.EXIT]
+            reconcilable = and_(func.lower(func.trim(event.event_type)).in_(exit_types),
+                                func.coalesce(event.ticket_code, "") != "")
+            # La fila de una salida tiene como referencia la hora de la salida: está en el mismo mes
+            conditions.append(or_(~reconcilable, self._reconciled(db, "exit_event_id", event.id, month)))
+        return conditions
+
+    def _payment_conditions(self, db: Session, month: datetime) -> list:
+        payment = models.Payment
+        conditions = [~exists().where(models.PaymentReconciliation.payment_id == payment.id)]
+        if self.wait_for_reconciliation:
+            # Un pago emparejado queda en el mes de su salida, que puede ser el anterior o el siguiente
+            conditions.append(or_(func.coalesce(payment.ticket_code, "") == "",
+                                  self._reconciled(db, "payment_id", payment.id, month, margin_months=1)))
+        return conditions
+
+    def _archive_kind(self, db: Session, kind: str, cutoff: datetime, conditions_for: Callable[[datetime], list],
+                      keep_running: Callable[[], bool]) -> int:
+        """
+        Archiva mes a mes, del más antiguo al `cutoff`. Las filas que aún no cumplen las
+        condiciones quedan. Antes de cada tanda consulta `keep_running` y se detiene si
+        devuelve False.
+        """
+        table, time_column = archive_tables.KINDS[kind]
+        moved, start = 0, None
+        while keep_running():
+            bounds = [table.c[time_column] < cutoff] + ([table.c[time_column] >= start] if start else [])
+            oldest = db.execute(select(func.min(table.c[time_column])).where(*bounds)).scalar()
+            if oldest is None:
+                return moved
+            month = archive_tables.month_start(oldest)
+            conditions = conditions_for(month)
+            while keep_running():
+                batch = archive_batch(db, kind, month, conditions, batch_size=self.batch_size)
+                moved += batch
+                if batch < self.batch_size:
+                    break
+            start = archive_tables.next_month(month)
+        return moved
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error en el archivo de datos históricos: {task.exception()}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el archivo de datos históricos: {e}")
+            await asyncio.sleep(self.interval_seconds)
@@ -1,18 +1,85 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 
+from db_metrics import PoolMetrics, instrumented_pool_class
+from request_metrics import request_metrics
 from settings import settings
 
+def _pool_options(database_url: str, pool_class, metrics: PoolMetrics) -> dict:
+    """
+    Opciones del pool según Settings. SQLite no tiene conexiones de red que caduquen
+    ni un límite de conexiones del servidor, así que conserva el pool por defecto
+    (sólo se instrumenta si es un QueuePool, es decir, si no es una BD en memoria).
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}
+        return {"poolclass": instrumented_pool_class(pool_class, metrics)}
+    return {
+        "poolclass": instrumented_pool_class(pool_class, metrics),
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        # Reciclar antes del wait_timeout de MySQL y verificar la conexión al pedirla
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+# Métricas de los pools (expuestas por la API de administración)
+engine_pool_metrics = PoolMetrics("sync")
+async_engine_pool_metrics = PoolMetrics("async")
+
 # El "engine" es el punto de entrada a la base de datos.
 # El argumento connect_args es necesario solo para SQLite.
 engine = create_engine(
     settings.DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {}
+    connect_args={"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {},
+    **_pool_options(settings.DATABASE_URL, QueuePool, engine_pool_metrics)
 )
+engine_pool_metrics.attach(engine)
+request_metrics.attach(engine)
 
 # Cada instancia de SessionLocal será una sesión de base de datos.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Usaremos Base en nuestros modelos para que SQLAlchemy los descubra.
 Base = declarative_base()
+
+
+# --- Acceso Asíncrono ---
+# Los endpoints más usados (autenticación, token de tótems, pagos, eventos) usan un
+# engine asíncrono para no bloquear el event loop mientras esperan a la base de datos.
+# El acceso síncrono de arriba se mantiene para el resto de la app y para scripts.
+
+# Driver asíncrono equivalente a cada driver síncrono soportado
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mariadb": "mariadb+aiomysql",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def get_async_database_url(database_url: str) -> str:
+    """Deriva la URL asíncrona a partir de DATABASE_URL (ej. mysql+pymysql -> mysql+aiomysql)."""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No hay driver asíncrono configurado para '{backend}'. Define ASYNC_DATABASE_URL.")
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = settings.ASYNC_DATABASE_URL or get_async_database_url(settings.DATABASE_URL)
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    **_pool_options(ASYNC_DATABASE_URL, AsyncAdaptedQueuePool, async_engine_pool_metrics)
+)
+async_engine_pool_metrics.attach(async_engine.sync_engine)
+request_metrics.attach(async_engine.sync_engine)
+
+# expire_on_commit=False: los objetos devueltos se usan después de cerrar la sesión
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# --- Métricas del Pool de Conexiones ---
+#
+# Permiten dimensionar el pool según el número de workers: cuántas conexiones se piden,
+# cuánto se espera por una, cuántas veces se entra en overflow y cuántas conexiones se
+# invalidan (ej. por el wait_timeout de MySQL).
+
+
+class PoolMetrics:
+    """Contadores de un pool de conexiones, alimentados por eventos de SQLAlchemy."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._engine = None
+        self.checkouts_total = 0
+        self.checkins_total = 0
+        self.connects_total = 0
+        self.invalidations_total = 0
+        self.soft_invalidations_total = 0
+        self.overflow_checkouts_total = 0
+        self.timeouts_total = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def attach(self, engine):
+        """Registra los listeners de eventos del pool del engine (sobreviven a dispose())."""
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        event.listen(engine, "soft_invalidate", self._on_soft_invalidate)
+        self._engine = engine
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts_total += 1
+
+    def snapshot(self) -> dict:
+        pool = self._engine.pool
+        data = {
+            "pool_class": type(pool).__name__,
+            "checkouts_total": self.checkouts_total,
+            "checkins_total": self.checkins_total,
+            "connects_total": self.connects_total,
+            "invalidations_total": self.invalidations_total,
+            "soft_invalidations_total": self.soft_invalidations_total,
+            "overflow_checkouts_total": self.overflow_checkouts_total,
+            "timeouts_total": self.timeouts_total,
+            "wait_seconds_total": round(self.wait_seconds_total, 6),
+            "wait_seconds_max": round(self.wait_seconds_max, 6),
+            "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts_total, 6) if self.checkouts_total else 0.0,
+        }
+        if isinstance(pool, QueuePool):
+            data.update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            })
+        return data
+
+    # --- Listeners ---
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects_total += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool = self._engine.pool
+        with self._lock:
+            self.checkouts_total += 1
+            if isinstance(pool, QueuePool) and pool.overflow() > 0:
+                self.overflow_checkouts_total += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins_total += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations_total += 1
+
+    def _on_soft_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.soft_invalidations_total += 1
+
+
+def instrumented_pool_class(base, metrics: PoolMetrics):
+    """
+    Devuelve una subclase de `base` que mide el tiempo de espera al pedir una conexión.
+    Se usa una subclase porque no existe un evento de "inicio de checkout"; al ser la
+    clase del pool, se conserva también cuando el engine recrea el pool.
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = base._do_get(self)
+        except exc.TimeoutError:
+            metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+    return type(f"Instrumented{base.__name__}", (base,), {"_do_get": _do_get})
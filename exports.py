@@ -0,0 +1,156 @@
+import csv
+import io
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import archive_tables
+import models
+
+# --- Exportación de Pagos y Eventos ---
+#
+# Las exportaciones se generan a medida que se leen las filas: la consulta se ejecuta
+# con stream_results/yield_per (cursor del lado del servidor en MySQL/PostgreSQL) y
+# cada tanda se serializa y se entrega a la StreamingResponse antes de leer la
+# siguiente. No se crean objetos ORM ni modelos Pydantic por fila, así que la memoria
+# no depende del tamaño del rango exportado. Los generadores abren su propia sesión
+# porque siguen ejecutándose después de que el endpoint retornó.
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+PAYMENT_COLUMNS = ["id", "mp_payment_id", "ticket_code", "external_pos_id", "amount", "status", "payment_time", "created_at"]
+PARKING_EVENT_COLUMNS = ["id", "ticket_code", "device_id", "event_type", "event_time", "created_at"]
+
+# Las filas archivadas (ver data_retention.py) se exportan igual que las recientes:
+# cada constructor devuelve una consulta por tabla de archivo del rango, en orden
+# cronológico, seguida de la de la tabla principal, y se leen una tras otra.
+
+def _payment_query(table, seller_id: int, start_date: Optional[datetime], end_date: Optional[datetime]):
+    # Mismos filtros que crud.payments_by_seller_filters, sobre cualquier tabla de pagos
+    conditions = [table.c.seller_id == seller_id]
+    if start_date:
+        conditions.append(table.c.payment_time >= start_date)
+    if end_date:
+        conditions.append(table.c.payment_time < end_date + timedelta(days=1))
+    return select(*(table.c[name] for name in PAYMENT_COLUMNS))\
+        .where(*conditions)\
+        .order_by(table.c.payment_time, table.c.id)
+
+def payments_queries(db: Session, seller_id: int, start_date: Optional[datetime] = None,
+                     end_date: Optional[datetime] = None) -> list:
+    """Pagos del vendedor en orden cronológico, con los mismos filtros de fecha que el listado."""
+    end = end_date + timedelta(days=1) if end_date else None
+    tables = archive_tables.tables_for_range(db, "payments", start_date, end) + [models.Payment.__table__]
+    return [_payment_query(table, seller_id, start_date, end_date) for table in tables]
+
+def parking_events_queries(db: Session, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                           device_id: Optional[int] = None) -> list:
+    tables = archive_tables.tables_for_range(db, "parking_events", start_date, end_date) + [models.ParkingEvent.__table__]
+    queries = []
+    for table in tables:
+        conditions = []
+        if start_date:
+            conditions.append(table.c.event_time >= start_date)
+        if end_date:
+            conditions.append(table.c.event_time < end_date)
+        if device_id is not None:
+            conditions.append(table.c.device_id == device_id)
+        queries.append(select(*(table.c[name] for name in PARKING_EVENT_COLUMNS)).where(*conditions).order_by(table.c.id))
+    return queries
+
+def _batches(session_factory: Callable[[], Session], queries: list, batch_size: int) -> Iterator[list]:
+    db = session_factory()
+    try:
+        for query in queries:
+            result = db.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+            for partition in result.partitions():
+                yield partition
+    finally:
+        db.close()
+
+def _csv_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def stream_csv(session_factory: Callable[[], Session], queries: list, batch_size: int = 2000) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # La cabecera sale antes de ejecutar la consulta: el primer byte llega enseguida
+    writer.writerow([column["name"] for column in queries[0].column_descriptions])
+    yield buffer.getvalue()
+    for rows in _batches(session_factory, queries, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+
+
+class _ParquetSink:
+    """Destino en memoria para ParquetWriter que se vacía tras cada row group."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def _arrow_schema(query):
+    import pyarrow as pa
+
+    types = {"Integer": pa.int64(), "Float": pa.float64(), "DateTime": pa.timestamp("us")}
+    return pa.schema([
+        (column["name"], types.get(type(column["type"]).__name__, pa.string()))
+        for column in query.column_descriptions
+    ])
+
+def stream_parquet(session_factory: Callable[[], Session], queries: list, batch_size: int = 2000) -> Iterator[bytes]:
+    """Un row group por tanda de filas; cada row group se entrega en cuanto se escribe."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(queries[0])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    yield sink.drain()
+    try:
+        for rows in _batches(session_factory, queries, batch_size):
+            columns: List[list] = [list(values) for values in zip(*rows)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def stream(session_factory: Callable[[], Session], queries: list, export_format: str, batch_size: int = 2000):
+    if export_format == "parquet":
+        return stream_parquet(session_factory, queries, batch_size)
+    return stream_csv(session_factory, queries, batch_size)
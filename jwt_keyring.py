@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from jose import JWTError, jwt
+
+logger = logging.getLogger(__name__)
+
+# --- Claves de Firma de JWT ---
+#
+# Los tokens se firman con la clave activa de un llavero (kid -> secreto) y llevan su
+# `kid` en la cabecera; se verifican con la clave que indique ese `kid`. Para rotar,
+# se agrega la clave nueva al llavero, se la activa, y la anterior se retira cuando
+# vencieron los tokens que firmó. Todos los workers y nodos deben compartir el mismo
+# llavero (JWT_KEYS/JWT_ACTIVE_KID, o al menos SECRET_KEY) para aceptar los tokens de
+# los demás. Los tokens sin `kid` (emitidos antes del llavero) se verifican con
+# SECRET_KEY.
+#
+# Como los tokens son inmutables, una vez verificada la firma de un token su
+# contenido no cambia hasta su `exp`: VerifiedTokenCache guarda las claims ya
+# verificadas y evita repetir la criptografía en cada llamada del dashboard.
+
+LEGACY_KID = "default"
+
+
+class JWTKeyring:
+    def __init__(self, keys: Dict[str, str], active_kid: str, algorithm: str = "HS256"):
+        if active_kid not in keys:
+            raise ValueError(f"La clave activa '{active_kid}' no está en el llavero de JWT")
+        self.keys = dict(keys)
+        self.active_kid = active_kid
+        self.algorithm = algorithm
+
+    @classmethod
+    def from_settings(cls, settings) -> "JWTKeyring":
+        keys = dict(settings.JWT_KEYS)
+        keys.setdefault(LEGACY_KID, settings.SECRET_KEY)
+        active_kid = settings.JWT_ACTIVE_KID or (next(iter(settings.JWT_KEYS)) if len(settings.JWT_KEYS) == 1 else LEGACY_KID)
+        if not settings.JWT_KEYS and "SECRET_KEY" not in settings.model_fields_set:
+            logger.warning("SECRET_KEY no está configurada: se usa una clave aleatoria de este proceso y los "
+                           "tokens emitidos aquí no serán válidos en otros workers ni tras reiniciar.")
+        return cls(keys, active_kid, settings.ALGORITHM)
+
+    def encode(self, claims: dict) -> str:
+        return jwt.encode(claims, self.keys[self.active_kid], algorithm=self.algorithm, headers={"kid": self.active_kid})
+
+    def decode(self, token: str) -> dict:
+        """Verifica firma y `exp`. Lanza JWTError si el token no es válido o su `kid` no se conoce."""
+        kid = jwt.get_unverified_header(token).get("kid", LEGACY_KID)
+        secret = self.keys.get(kid)
+        if secret is None:
+            raise JWTError(f"Clave de firma desconocida: {kid}")
+        return jwt.decode(token, secret, algorithms=[self.algorithm])
+
+
+class VerifiedTokenCache:
+    """LRU acotado de claims de tokens ya verificados, válido hasta el `exp` de cada token."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # sha256(token) -> (claims, exp); no se guardan los tokens en claro
+        self._entries: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+        self.hits_total = 0
+        self.misses_total = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses_total += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits_total += 1
+            return entry[0]
+
+    def put(self, token: str, claims: dict):
+        """Guarda las claims hasta el `exp` del token. Los tokens sin `exp` no se cachean."""
+        exp = claims.get("exp")
+        if not isinstance(exp, (int, float)) or exp <= time.time():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (claims, float(exp))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "hits_total": self.hits_total, "misses_total": self.misses_total}
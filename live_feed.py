@@ -0,0 +1,161 @@
+import asyncio
+import itertools
+import logging
+import threading
+from typing import Dict, Optional, Set
+
+from settings import settings
+from shared_backend import SharedBackend, shared_backend
+
+logger = logging.getLogger(__name__)
+
+# --- Canal en Vivo del Dashboard ---
+#
+# Quien escribe datos (el procesamiento de pagos, la ingesta de eventos, el CRUD de
+# tótems) publica un mensaje para el vendedor afectado y cada dashboard conectado por
+# SSE lo recibe sin volver a consultar la base de datos. Los mensajes viajan por el
+# pub/sub del backend compartido (shared_backend.py), así que con varios workers o
+# nodos un dashboard recibe también lo que se escribe en los demás. Se publican desde
+# hilos (workers de webhooks, threadpool de FastAPI) y desde el event loop, así que la
+# entrega a cada conexión se hace con call_soon_threadsafe.
+
+CHANNEL = "live_feed"
+
+RESYNC = "resync"
+
+
+class Subscription:
+    """
+    Conexión de un dashboard con un buffer acotado. Si el cliente no consume a tiempo
+    y el buffer se llena, se descarta lo pendiente y se deja un único mensaje
+    'resync' para que el cliente recargue sus datos por la API (backpressure sin
+    bloquear a quien publica ni crecer sin límite).
+    """
+
+    def __init__(self, seller_id: int, is_admin: bool, max_queue: int, loop: asyncio.AbstractEventLoop):
+        self.seller_id = seller_id
+        self.is_admin = is_admin
+        self.loop = loop
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=max_queue)
+        self.dropped_total = 0
+
+    def offer(self, message: dict):
+        """Encola un mensaje. Sólo debe llamarse desde el event loop de la suscripción."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped_total += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": RESYNC})
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """Siguiente mensaje, o None si no llega ninguno en `timeout` segundos."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LiveFeedBroker:
+    def __init__(self, max_queue: int = 100, max_connections_per_seller: int = 5, backend: Optional[SharedBackend] = None):
+        self.max_queue = max_queue
+        self.max_connections_per_seller = max_connections_per_seller
+        self._lock = threading.Lock()
+        self._by_seller: Dict[int, Set[Subscription]] = {}
+        self._ids = itertools.count(1)
+        self.published_total = 0
+        self.delivered_total = 0
+        self.backend = backend
+        if backend is not None:
+            backend.subscribe(CHANNEL, self._on_message)
+
+    def subscribe(self, seller_id: int, is_admin: bool = False) -> Optional[Subscription]:
+        """Registra una conexión. Devuelve None si el vendedor ya tiene demasiadas abiertas."""
+        subscription = Subscription(seller_id, is_admin, self.max_queue, asyncio.get_running_loop())
+        with self._lock:
+            subscriptions = self._by_seller.setdefault(seller_id, set())
+            if len(subscriptions) >= self.max_connections_per_seller:
+                return None
+            subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._by_seller.get(subscription.seller_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._by_seller[subscription.seller_id]
+
+    def publish(self, seller_id: Optional[int], message: dict):
+        """Envía `message` a los dashboards del vendedor. No bloquea; seguro desde cualquier hilo."""
+        if seller_id is None:
+            return
+        self._broadcast({"seller_id": seller_id, "message": message})
+
+    def publish_admin(self, message: dict):
+        """Envía `message` a los dashboards de administradores (datos sin vendedor asociado)."""
+        self._broadcast({"seller_id": None, "message": message})
+
+    def _broadcast(self, envelope: dict):
+        if self.backend is None:
+            self._on_message(envelope)
+            return
+        # El backend lo entrega también a este proceso. En el event loop no se espera
+        # la escritura (el backend en base de datos es bloqueante).
+        loop = None
+        if self.backend.name != "memory":
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+        if loop is None:
+            self._publish_to_backend(envelope)
+        else:
+            loop.run_in_executor(None, self._publish_to_backend, envelope)
+
+    def _publish_to_backend(self, envelope: dict):
+        try:
+            self.backend.publish(CHANNEL, envelope)
+        except Exception as e:
+            logger.error(f"Error publicando en el canal en vivo: {e}")
+
+    def _on_message(self, envelope: dict):
+        seller_id = envelope["seller_id"]
+        with self._lock:
+            if seller_id is None:
+                targets = [subscription for subscriptions in self._by_seller.values()
+                           for subscription in subscriptions if subscription.is_admin]
+            else:
+                targets = list(self._by_seller.get(seller_id, ()))
+        self._deliver(targets, envelope["message"])
+
+    def _deliver(self, targets, message: dict):
+        message = {"id": next(self._ids), **message}
+        self.published_total += 1
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+                self.delivered_total += 1
+            except RuntimeError:
+                # El event loop de la conexión ya se cerró
+                self.unsubscribe(subscription)
+
+    def status(self) -> dict:
+        with self._lock:
+            subscriptions = [subscription for group in self._by_seller.values() for subscription in group]
+        return {
+            "sellers": len({subscription.seller_id for subscription in subscriptions}),
+            "connections": len(subscriptions),
+            "published_total": self.published_total,
+            "delivered_total": self.delivered_total,
+            "dropped_total": sum(subscription.dropped_total for subscription in subscriptions),
+        }
+
+
+live_feed = LiveFeedBroker(
+    max_queue=settings.LIVE_FEED_QUEUE_SIZE,
+    max_connections_per_seller=settings.LIVE_FEED_MAX_CONNECTIONS_PER_SELLER,
+    backend=shared_backend,
+)
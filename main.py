@@ -1,39 +1,166 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, BackgroundTasks
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, Depends, HTTPException, Query, status, Request, Response
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-from typing import List, Optional
+from typing import List, Literal, Optional
 from datetime import timedelta, datetime, timezone
-import mercadopago
+from contextlib import asynccontextmanager
 import hmac
 import hashlib
+import json
 import logging
 import os
+import time
 import urllib.parse
-import requests
 
 import crud
+import crud_async
+import data_retention
+import exports
 import models
+import parking_analytics
+import payment_backfill
+import payment_reconciliation
+import payment_rollups
 import schemas
 import security
-from database import SessionLocal, engine
+from database import SessionLocal, AsyncSessionLocal, async_engine, engine, engine_pool_metrics, async_engine_pool_metrics
 from settings import settings
+from live_feed import live_feed
+from mp_client import LatencyHistogram, MercadoPagoError, mp_client
+from password_hashing import PasswordHasherBusy
+from request_metrics import MetricsMiddleware, render_counter, render_histogram, request_metrics
+from shared_backend import LockTimeout, shared_backend
+from token_cache import seller_refresh_lock, totem_token_cache
+from token_scheduler import TokenRefreshScheduler
+from totem_keys import TotemPrincipal, auth_log, totem_key_index
+from webhook_worker import WebhookWorkerPool
 
 # --- Constantes ---
 # Un token de MP dura 6 horas (21600 segundos). Lo refrescamos proactivamente.
 TOKEN_STALE_THRESHOLD_SECONDS = 19800  # 5.5 horas
+MP_TOKEN_LIFETIME_SECONDS = 21600  # 6 horas
+# Límites para la ingesta NDJSON: una línea no puede crecer sin límite en memoria,
+# y sólo se devuelve el detalle de los primeros errores.
+NDJSON_MAX_LINE_BYTES = 64 * 1024
+NDJSON_MAX_REPORTED_ERRORS = 100
+# Tamaño máximo de una página del listado de pagos
+PAYMENTS_PAGE_MAX_LIMIT = 100
 
 # --- Setup de la App ---
 models.Base.metadata.create_all(bind=engine)
 
+token_refresh_scheduler = TokenRefreshScheduler(
+    session_factory=SessionLocal,
+    refresh_after_seconds=TOKEN_STALE_THRESHOLD_SECONDS - settings.MP_TOKEN_REFRESH_MARGIN_SECONDS,
+    concurrency=settings.MP_TOKEN_REFRESH_CONCURRENCY,
+    max_retries=settings.MP_TOKEN_REFRESH_MAX_RETRIES,
+    retry_base_seconds=settings.MP_TOKEN_REFRESH_RETRY_BASE_SECONDS,
+    sync_interval_seconds=settings.MP_TOKEN_REFRESH_SYNC_INTERVAL_SECONDS,
+)
+
+webhook_worker_pool = WebhookWorkerPool(
+    session_factory=SessionLocal,
+    workers=settings.WEBHOOK_WORKERS,
+    batch_size=settings.WEBHOOK_BATCH_SIZE,
+    poll_interval_seconds=settings.WEBHOOK_POLL_INTERVAL_SECONDS,
+    max_attempts=settings.WEBHOOK_MAX_ATTEMPTS,
+    retry_base_seconds=settings.WEBHOOK_RETRY_BASE_SECONDS,
+    lock_timeout_seconds=settings.WEBHOOK_LOCK_TIMEOUT_SECONDS,
+    backend=shared_backend,
+    dedup_window_seconds=settings.WEBHOOK_DEDUP_WINDOW_SECONDS,
+    done_retention_hours=settings.WEBHOOK_DONE_RETENTION_HOURS,
+    purge_interval_seconds=settings.WEBHOOK_PURGE_INTERVAL_SECONDS,
+)
+
+parking_analytics_updater = parking_analytics.ParkingAnalyticsUpdater(
+    session_factory=SessionLocal,
+    interval_seconds=settings.PARKING_ANALYTICS_INTERVAL_SECONDS,
+    batch_size=settings.PARKING_ANALYTICS_BATCH_SIZE,
+    settle_seconds=settings.PARKING_ANALYTICS_SETTLE_SECONDS,
+    backend=shared_backend,
+    lock_ttl_seconds=settings.JOB_LOCK_TTL_SECONDS,
+)
+
+payment_reconciler = payment_reconciliation.PaymentReconciler(
+    session_factory=SessionLocal,
+    interval_seconds=settings.RECONCILIATION_INTERVAL_SECONDS,
+    batch_size=settings.RECONCILIATION_BATCH_SIZE,
+    window_before_minutes=settings.RECONCILIATION_WINDOW_BEFORE_MINUTES,
+    window_after_minutes=settings.RECONCILIATION_WINDOW_AFTER_MINUTES,
+    settle_seconds=settings.RECONCILIATION_SETTLE_SECONDS,
+    backend=shared_backend,
+    lock_ttl_seconds=settings.JOB_LOCK_TTL_SECONDS,
+)
+
+payment_backfill_job = payment_backfill.PaymentBackfill(
+    session_factory=SessionLocal,
+    interval_seconds=settings.PAYMENT_BACKFILL_INTERVAL_SECONDS,
+    concurrency=settings.PAYMENT_BACKFILL_CONCURRENCY,
+    page_size=settings.PAYMENT_BACKFILL_PAGE_SIZE,
+    initial_days=settings.PAYMENT_BACKFILL_INITIAL_DAYS,
+    overlap_minutes=settings.PAYMENT_BACKFILL_OVERLAP_MINUTES,
+    backend=shared_backend,
+    lock_ttl_seconds=settings.JOB_LOCK_TTL_SECONDS,
+)
+
+data_archiver = data_retention.DataArchiver(
+    session_factory=SessionLocal,
+    interval_seconds=settings.DATA_ARCHIVE_INTERVAL_SECONDS,
+    batch_size=settings.DATA_ARCHIVE_BATCH_SIZE,
+    events_retention_days=settings.PARKING_EVENTS_RETENTION_DAYS,
+    payments_retention_days=settings.PAYMENTS_RETENTION_DAYS,
+    wait_for_analytics=settings.PARKING_ANALYTICS_ENABLED,
+    wait_for_reconciliation=settings.RECONCILIATION_ENABLED,
+    backend=shared_backend,
+    lock_ttl_seconds=settings.JOB_LOCK_TTL_SECONDS,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    auth_log.start()
+    await shared_backend.start()
+    await totem_key_index.start()
+    if settings.MP_TOKEN_REFRESH_SCHEDULER_ENABLED:
+        await token_refresh_scheduler.start()
+    if settings.WEBHOOK_WORKERS_ENABLED:
+        await webhook_worker_pool.start()
+    if settings.PARKING_ANALYTICS_ENABLED:
+        await parking_analytics_updater.start()
+    if settings.RECONCILIATION_ENABLED:
+        await payment_reconciler.start()
+    if settings.PAYMENT_BACKFILL_ENABLED:
+        await payment_backfill_job.start()
+    if settings.DATA_ARCHIVE_ENABLED:
+        await data_archiver.start()
+    yield
+    await data_archiver.stop()
+    await payment_backfill_job.stop()
+    await payment_reconciler.stop()
+    await parking_analytics_updater.stop()
+    await webhook_worker_pool.stop()
+    await token_refresh_scheduler.stop()
+    await totem_key_index.stop()
+    await shared_backend.stop()
+    auth_log.stop()
+    # Cierra las conexiones asíncronas (aiosqlite mantiene un hilo por conexión)
+    await async_engine.dispose()
+
 app = FastAPI(
     title="OEM Totem Park - Back Office API",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
+if settings.METRICS_ENABLED or settings.QUERY_DEBUG:
+    app.add_middleware(MetricsMiddleware, metrics=request_metrics)
+
 # Montar directorio estático
 app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
 
@@ -50,6 +177,10 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # --- Endpoints de Mercado Pago OAuth ---
 
 @app.get("/mercadopago/authorize-url", summary="Generar URL de conexión para un Vendedor")
@@ -82,47 +213,30 @@ def handle_mercadopago_connect(request: Request, db: Session = Depends(get_db)):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing 'code' or 'state' parameter")
 
     # Intercambiar el código por credenciales
-    TOKEN_URL = "https://api.mercadopago.com/oauth/token"
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-        "Accept": "application/json"
-    }
-    data = {
-        "client_id": settings.MP_APP_ID,
-        "client_secret": settings.MP_SECRET_KEY,
-        "code": code,
-        "redirect_uri": settings.MP_REDIRECT_URI,
-        "grant_type": "authorization_code"
-    }
-
     try:
-        response = requests.post(TOKEN_URL, headers=headers, data=data)
-        response.raise_for_status()  # Lanza una excepción para errores HTTP (4xx o 5xx)
-        token_info = response.json()
-
-        access_token = token_info.get("access_token")
-        refresh_token = token_info.get("refresh_token")
-
-        if not access_token or not refresh_token:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Failed to obtain access or refresh token from Mercado Pago")
-
-        # Guardar los tokens en la base de datos
-        crud.update_seller_mp_tokens(
-            db=db,
-            seller_id=int(seller_id),
-            access_token=access_token,
-            refresh_token=refresh_token
-        )
-
-    except requests.exceptions.HTTPError as http_err:
-        # Loguear el error HTTP específico
-        print(f"HTTP error during token exchange: {http_err}")
-        print(f"Response content: {response.text}")
-        raise HTTPException(status_code=response.status_code, detail=f"Mercado Pago token exchange failed: {response.text}")
-    except Exception as e:
-        # Loguear cualquier otro error
-        print(f"An unexpected error occurred during token exchange: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {e}")
+        result = mp_client.exchange_authorization_code(code, redirect_uri=settings.MP_REDIRECT_URI)
+    except MercadoPagoError as e:
+        logging.error(f"Error de comunicación con Mercado Pago durante el intercambio del código: {e}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Mercado Pago token exchange failed: {e}")
+
+    if result["status"] >= 400:
+        logging.error(f"HTTP error during token exchange: {result['status']} {result['response']}")
+        raise HTTPException(status_code=result["status"], detail=f"Mercado Pago token exchange failed: {result['response']}")
+
+    token_info = result["response"] or {}
+    access_token = token_info.get("access_token")
+    refresh_token = token_info.get("refresh_token")
+
+    if not access_token or not refresh_token:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Failed to obtain access or refresh token from Mercado Pago")
+
+    # Guardar los tokens en la base de datos
+    crud.update_seller_mp_tokens(
+        db=db,
+        seller_id=int(seller_id),
+        access_token=access_token,
+        refresh_token=refresh_token
+    )
 
     # Redirigir a una página de éxito en el frontend (a futuro)
     return RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
@@ -144,23 +258,31 @@ def disconnect_mercadopago(
 # --- Endpoint de Notificaciones de Mercado Pago (IPN/Webhook) ---
 
 @app.post("/mercadopago/webhook", status_code=status.HTTP_200_OK, summary="Receptor de Webhooks de Mercado Pago")
-async def mercadopago_webhook(
+def mercadopago_webhook(
     notification: schemas.MercadoPagoNotification,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
 ):
     """
     Recibe notificaciones de eventos de Mercado Pago (ej. pagos).
-    Responde inmediatamente con un 200 OK y procesa el pago en segundo plano.
+    Guarda la notificación en la cola persistente y responde inmediatamente con un
+    200 OK; el pool de workers la procesa después con reintentos.
     """
     logging.info(f"--- WEBHOOK MERCADOPAGO RECIBIDO ---")
     logging.info(f"Action: {notification.action}, Type: {notification.type}, Data ID: {notification.data.id}")
 
     if notification.type == "payment":
         payment_id = notification.data.id
-        # Añadimos la tarea para que se ejecute en segundo plano
-        background_tasks.add_task(crud.process_payment_notification, db=db, payment_id=payment_id)
-        logging.info(f"Tarea de procesamiento para el pago {payment_id} encolada.")
+        if not webhook_worker_pool.recent.add(payment_id):
+            # Ya hay una notificación pendiente para este pago
+            logging.info(f"Notificación para el pago {payment_id} agrupada con una pendiente.")
+            return {"status": "notification received"}
+        try:
+            crud.enqueue_webhook_notification(db, topic=notification.type, resource_id=payment_id, action=notification.action)
+        except Exception:
+            webhook_worker_pool.recent.forget(payment_id)
+            raise
+        webhook_worker_pool.notify()
+        logging.info(f"Notificación para el pago {payment_id} encolada.")
     
     return {"status": "notification received"}
 
@@ -181,19 +303,54 @@ def view_dashboard(request: Request):
 
 # --- API para Tótems ---
 
+def _token_age_seconds(seller: models.Seller) -> float:
+    """Segundos transcurridos desde la última actualización del token de MP del vendedor."""
+    return (datetime.now(timezone.utc) - seller.mp_token_last_updated.replace(tzinfo=timezone.utc)).total_seconds()
+
+def _refresh_seller_tokens_blocking(seller_id: int) -> Optional[models.Seller]:
+    """
+    Refresca los tokens de un vendedor con una sesión síncrona propia. Se ejecuta en
+    el threadpool porque tanto el lock como la llamada a Mercado Pago son bloqueantes.
+    Sólo un hilo por vendedor, entre todos los workers, llama a Mercado Pago; el resto
+    espera el lock y reutiliza el token ya refrescado en lugar de pedir otro.
+    """
+    db = SessionLocal()
+    try:
+        with seller_refresh_lock(seller_id):
+            seller = crud.get_seller(db, seller_id=seller_id)
+            if seller and seller.mp_token_last_updated and _token_age_seconds(seller) > TOKEN_STALE_THRESHOLD_SECONDS:
+                seller = crud.refresh_seller_tokens(db, seller=seller)
+            return seller
+    except LockTimeout:
+        # Otro proceso sigue refrescando: se devuelve el token actual, que aún es válido
+        # salvo que lleve más de MP_TOKEN_LIFETIME_SECONDS sin renovarse
+        logging.warning(f"Lock de refresco del vendedor {seller_id} ocupado; se usa el token actual.")
+        return crud.get_seller(db, seller_id=seller_id)
+    finally:
+        db.close()
+
 @app.get("/api/v1/totems/token/{external_pos_id}", summary="Obtener token de MP para un Tótem")
-def get_mp_token_for_totem(
+async def get_mp_token_for_totem(
     external_pos_id: str,
-    db: Session = Depends(get_db),
-    is_validated: bool = Depends(security.validate_totem_api_key)
+    db: AsyncSession = Depends(get_async_db),
+    totem: TotemPrincipal = Depends(security.validate_totem_api_key)
 ):
     """
     Endpoint para que los tótems obtengan el access token de su vendedor.
     Refresca el token proactivamente si está a punto de expirar.
-    Requiere autenticación por API Key (Header: X-API-Key).
+    Requiere autenticación por API Key (Header: X-API-Key); una key de tótem sólo
+    sirve para el token de ese mismo tótem.
     """
+    if totem.external_pos_id is not None and totem.external_pos_id != external_pos_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="API Key does not belong to this totem")
+
+    # Camino rápido: token vigente en memoria, sin tocar la base de datos
+    cached_token = totem_token_cache.get(external_pos_id)
+    if cached_token:
+        return {"mp_access_token": cached_token}
+
     try:
-        db_totem = crud.get_totem_by_external_id(db, external_pos_id=external_pos_id)
+        db_totem = await crud_async.get_totem_by_external_id(db, external_pos_id=external_pos_id)
         if not db_totem:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Totem not found")
         
@@ -205,13 +362,21 @@ def get_mp_token_for_totem(
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Owner has not connected or configured their Mercado Pago account")
 
         # Comprobar si el token está "vencido" y necesita refrescarse
-        token_age = (datetime.now(timezone.utc) - seller.mp_token_last_updated.replace(tzinfo=timezone.utc)).total_seconds()
-        
-        refreshed_seller = seller
-        if token_age > TOKEN_STALE_THRESHOLD_SECONDS:
-            refreshed_seller = crud.refresh_seller_tokens(db, seller=seller)
+        token_age = _token_age_seconds(seller)
+        if token_age > TOKEN_STALE_THRESHOLD_SECONDS and token_refresh_scheduler.is_running and token_age < MP_TOKEN_LIFETIME_SECONDS:
+            # El token todavía es válido: pedimos al planificador que lo refresque en
+            # segundo plano y respondemos sin esperar a Mercado Pago.
+            token_refresh_scheduler.request_refresh(seller.id)
+        elif token_age > TOKEN_STALE_THRESHOLD_SECONDS:
+            seller = await run_in_threadpool(_refresh_seller_tokens_blocking, seller.id)
+
+        if not seller or not seller.mp_access_token or not seller.mp_token_last_updated:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Owner has not connected or configured their Mercado Pago account")
 
-        return {"mp_access_token": refreshed_seller.mp_access_token}
+        expires_at = seller.mp_token_last_updated.replace(tzinfo=timezone.utc) + timedelta(seconds=TOKEN_STALE_THRESHOLD_SECONDS)
+        totem_token_cache.put(external_pos_id, seller.id, seller.mp_access_token, expires_at)
+
+        return {"mp_access_token": seller.mp_access_token}
     except SQLAlchemyError as e:
         # Aquí podrías loguear el error `e` si lo necesitas
         raise HTTPException(
@@ -226,62 +391,295 @@ def get_mp_token_for_totem(
         )
 
 @app.get("/api/v1/payments/me", response_model=List[schemas.Payment], summary="Obtener mis pagos registrados")
-def read_my_payments(
-    skip: int = 0,
-    limit: int = 20,
+async def read_my_payments(
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=PAYMENTS_PAGE_MAX_LIMIT),
+    after: Optional[str] = None,
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: schemas.Seller = Depends(security.get_current_user)
 ):
     """
     Devuelve una lista paginada de los pagos registrados para el vendedor
     actualmente autenticado. Permite filtrar por un rango de fechas.
+    Para paginar, enviar en `after` el valor de la cabecera `X-Next-Cursor` de la
+    página anterior (la cabecera no se envía en la última página). `skip` se
+    mantiene por compatibilidad, pero es lento en páginas profundas.
     """
-    payments = crud.get_payments_by_seller(
+    after_position = None
+    if after:
+        try:
+            after_position = crud.decode_payment_cursor(after)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid 'after' cursor")
+
+    # Pedimos una fila extra para saber si hay una página siguiente
+    payments = await crud_async.get_payments_by_seller(
         db, 
         seller_id=current_user.id, 
         skip=skip, 
-        limit=limit,
+        limit=limit + 1,
         start_date=start_date,
-        end_date=end_date
+        end_date=end_date,
+        after=after_position
     )
+    if len(payments) > limit:
+        payments = payments[:limit]
+        response.headers["X-Next-Cursor"] = crud.encode_payment_cursor(payments[-1])
     return payments
 
+@app.get("/api/v1/payments/me/summary", response_model=schemas.PaymentSummary, summary="Resumen de recaudación")
+def read_my_payments_summary(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    granularity: Literal["hour", "day"] = "day",
+    db: Session = Depends(get_db),
+    current_user: schemas.Seller = Depends(security.get_current_user)
+):
+    """
+    Devuelve la recaudación (pagos aprobados) del vendedor autenticado en el rango
+    [start_date, end_date): totales, desglose por tótem y serie por hora o día.
+    Por defecto, el mes en curso hasta ahora. Se calcula desde los rollups, por lo
+    que no recorre la tabla de pagos.
+    """
+    now = datetime.utcnow()
+    end = end_date or now
+    start = start_date or now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start_date must be before end_date")
+    return payment_rollups.summarize(db, seller_id=current_user.id, start=start, end=end, granularity=granularity)
+
+def _export_response(queries: list, export_format: str, filename: str) -> StreamingResponse:
+    if export_format == "parquet" and not exports.parquet_available():
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Parquet export requires pyarrow")
+    media_type, extension = exports.FORMATS[export_format]
+    return StreamingResponse(
+        exports.stream(SessionLocal, queries, export_format, batch_size=settings.EXPORT_BATCH_SIZE),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{extension}"'},
+    )
+
+@app.get("/api/v1/payments/me/export", summary="Exportar mis pagos (CSV o Parquet)")
+def export_my_payments(
+    format: Literal["csv", "parquet"] = "csv",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.Seller = Depends(security.get_current_user)
+):
+    """
+    Descarga el historial completo de pagos del vendedor autenticado, en orden
+    cronológico y con los mismos filtros de fecha que el listado, incluidos los
+    meses ya archivados. Se genera en streaming, por lo que sirve para rangos de
+    varios años.
+    """
+    queries = exports.payments_queries(db, current_user.id, start_date=start_date, end_date=end_date)
+    return _export_response(queries, format, "payments")
+
+@app.get("/api/v1/live", summary="Canal en vivo del dashboard (Server-Sent Events)")
+async def live_updates(
+    token: Optional[str] = Depends(security.oauth2_scheme),
+    current_user: schemas.Seller = Depends(security.get_current_user)
+):
+    """
+    Mantiene abierta una respuesta `text/event-stream` por la que se envían al
+    vendedor autenticado los pagos nuevos o actualizados y los cambios en sus tótems
+    (y, a los administradores, los lotes de eventos de parking). Si el cliente se
+    atrasa, recibe un evento `resync` y debe recargar sus datos por la API.
+    El canal se cierra al expirar el token, o si en algún latido el token o el
+    vendedor ya no son válidos; al reconectar, el cliente recibe un 401.
+    """
+    subscription = live_feed.subscribe(current_user.id, is_admin=current_user.role == "admin")
+    if subscription is None:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many live connections for this seller")
+    expires_at = security.decode_access_token(token).get("exp")
+
+    async def still_authorized() -> bool:
+        # Mismo vendedor y rol que al abrir el canal (el rol decide qué mensajes recibe)
+        principal = await security.get_optional_current_user(token)
+        return principal is not None and principal.id == current_user.id and principal.role == current_user.role
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            next_check = time.time() + settings.LIVE_FEED_HEARTBEAT_SECONDS
+            while True:
+                deadline = next_check if expires_at is None else min(next_check, expires_at)
+                message = await subscription.get(timeout=max(0.0, deadline - time.time()))
+                if message is None or time.time() >= deadline:
+                    # Se revalida en cada latido aunque lleguen mensajes sin pausa
+                    if deadline == expires_at or not await still_authorized():
+                        break
+                    next_check = time.time() + settings.LIVE_FEED_HEARTBEAT_SECONDS
+                if message is None:
+                    # Comentario SSE: mantiene viva la conexión a través de proxies
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {message.get('id', '')}\nevent: {message['type']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            live_feed.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/api/v1/events", summary="Registrar eventos de parking desde un Tótem")
-def register_parking_events(
+async def register_parking_events(
     events: List[schemas.ParkingEventCreate],
-    db: Session = Depends(get_db),
-    is_validated: bool = Depends(security.validate_totem_api_key)
+    db: AsyncSession = Depends(get_async_db),
+    totem: TotemPrincipal = Depends(security.validate_totem_api_key)
 ):
     """
     Endpoint para que los tótems envíen lotes de eventos (entradas/salidas)
     para ser registrados en la base de datos central del backoffice.
+    Es idempotente: reenviar un lote no duplica los eventos ya registrados.
     """
     try:
-        crud.create_parking_events(db=db, events=events)
-        return {"status": "ok", "detail": f"{len(events)} events registered."}
+        inserted, duplicates = await crud_async.create_parking_events(db=db, events=events)
+        if inserted:
+            parking_analytics_updater.notify()
+        return {
+            "status": "ok",
+            "detail": f"{inserted} events registered, {duplicates} duplicates ignored.",
+            "inserted": inserted,
+            "duplicates": duplicates,
+        }
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to register events: {e}"
         )
 
+async def _iter_ndjson_lines(request: Request):
+    """
+    Lee el cuerpo de la petición de forma incremental y produce (número_de_línea, línea).
+    Las líneas que superan NDJSON_MAX_LINE_BYTES se producen como None para que el
+    llamador las reporte como error sin tener que mantenerlas en memoria.
+    """
+    buffer = b""
+    line_number = 0
+    overflow = False
+    async for chunk in request.stream():
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline == -1:
+                break
+            line, buffer = buffer[:newline], buffer[newline + 1:]
+            line_number += 1
+            yield line_number, None if overflow else line
+            overflow = False
+        if len(buffer) > NDJSON_MAX_LINE_BYTES:
+            buffer = b""
+            overflow = True
+    if buffer or overflow:
+        yield line_number + 1, None if overflow else buffer
+
+@app.post("/api/v1/events/ndjson", summary="Registrar eventos de parking en streaming (NDJSON)")
+async def register_parking_events_ndjson(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    totem: TotemPrincipal = Depends(security.validate_totem_api_key)
+):
+    """
+    Alternativa a /api/v1/events para backfills grandes. Recibe un cuerpo
+    `application/x-ndjson` (un evento JSON por línea), lo procesa a medida que llega
+    y lo escribe en lotes de tamaño fijo, por lo que el consumo de memoria no depende
+    del tamaño de la subida. Las líneas inválidas se reportan sin abortar el resto.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in ("application/x-ndjson", "application/jsonl"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Content-Type must be application/x-ndjson"
+        )
+
+    inserted = duplicates = invalid = 0
+    errors = []
+    batch: List[schemas.ParkingEventCreate] = []
+
+    async def flush():
+        nonlocal inserted, duplicates
+        batch_inserted, batch_duplicates = await crud_async.create_parking_events(db=db, events=batch)
+        inserted += batch_inserted
+        duplicates += batch_duplicates
+        batch.clear()
+
+    try:
+        async for line_number, line in _iter_ndjson_lines(request):
+            if line is None:
+                error = f"Line exceeds {NDJSON_MAX_LINE_BYTES} bytes"
+            elif not line.strip():
+                continue
+            else:
+                try:
+                    batch.append(schemas.ParkingEventCreate.model_validate_json(line))
+                    error = None
+                except ValidationError as e:
+                    error = "; ".join(
+                        f"{'.'.join(map(str, err['loc']))}: {err['msg']}" if err["loc"] else err["msg"]
+                        for err in e.errors()
+                    )
+            if error is not None:
+                invalid += 1
+                if len(errors) < NDJSON_MAX_REPORTED_ERRORS:
+                    errors.append({"line": line_number, "error": error})
+                continue
+            if len(batch) >= crud.PARKING_EVENT_INSERT_BATCH_SIZE:
+                await flush()
+        if batch:
+            await flush()
+    except SQLAlchemyError as e:
+        # Los lotes ya confirmados quedan guardados; el tótem puede reenviar todo sin duplicar
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Failed to register events after {inserted} inserts: {e}"
+        )
+    finally:
+        if inserted:
+            parking_analytics_updater.notify()
+
+    return {
+        "status": "ok" if invalid == 0 else "partial",
+        "detail": f"{inserted} events registered, {duplicates} duplicates ignored, {invalid} invalid lines.",
+        "inserted": inserted,
+        "duplicates": duplicates,
+        "invalid": invalid,
+        "errors": errors,
+    }
+
 # --- Endpoints de Autenticación ---
 
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     """
     Endpoint de login. Recibe email (como username) y contraseña.
     Devuelve un token de acceso si las credenciales son correctas.
     """
-    seller = crud.get_seller_by_email(db, email=form_data.username)
-    if not seller or not security.verify_password(form_data.password, seller.hashed_password):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Incorrect email or password",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    seller = await crud_async.get_seller_by_email(db, email=form_data.username)
+    if not seller:
+        raise credentials_exception
+    # Cierra la transacción de lectura para no retener una conexión del pool mientras corre bcrypt
+    await db.commit()
+    try:
+        # bcrypt corre en el pool de hashing: el event loop sigue atendiendo a los tótems
+        valid, new_hash = await security.password_hasher.verify_and_update(form_data.password, seller.hashed_password)
+    except PasswordHasherBusy:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect email or password",
-            headers={"WWW-Authenticate": "Bearer"},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many concurrent logins, please retry",
+            headers={"Retry-After": "1"},
         )
+    if not valid:
+        raise credentials_exception
+    if new_hash is not None:
+        # Cambiaron los parámetros de bcrypt: se guarda el hash con los nuevos
+        await crud_async.update_seller_password_hash(db, seller.id, new_hash)
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
         data={"sub": seller.email}, expires_delta=access_token_expires
@@ -393,6 +791,59 @@ def delete_totem_endpoint(
 
     return crud.delete_totem(db=db, totem_id=totem_id)
 
+def _get_owned_totem(db: Session, totem_id: int, current_user: schemas.Seller) -> models.Totem:
+    db_totem = crud.get_totem(db, totem_id=totem_id)
+    if db_totem is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Totem not found")
+    if db_totem.owner_id != current_user.id and current_user.role != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to manage this totem")
+    return db_totem
+
+@app.get("/totems/{totem_id}/api-keys", response_model=List[schemas.TotemApiKey], summary="Listar las API keys de un Totem (protegido)")
+def read_totem_api_keys(
+    totem_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.Seller = Depends(security.get_current_user),
+):
+    """
+    Lista las API keys del tótem (sólo su prefijo y estado, nunca la key).
+    Accesible para el dueño del tótem y para administradores.
+    """
+    _get_owned_totem(db, totem_id, current_user)
+    return crud.get_totem_api_keys(db, totem_id=totem_id)
+
+@app.post("/totems/{totem_id}/api-keys", response_model=schemas.TotemApiKeyCreated, status_code=status.HTTP_201_CREATED, summary="Crear una API key para un Totem (protegido)")
+def create_totem_api_key(
+    totem_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.Seller = Depends(security.get_current_user),
+):
+    """
+    Genera una nueva API key para el tótem. La key sólo se muestra en esta respuesta.
+    Las keys anteriores siguen vigentes hasta que se revoquen (rotación sin cortes).
+    Accesible para el dueño del tótem y para administradores.
+    """
+    _get_owned_totem(db, totem_id, current_user)
+    return crud.create_totem_api_key(db, totem_id=totem_id)
+
+@app.delete("/totems/{totem_id}/api-keys/{key_id}", response_model=schemas.TotemApiKey, summary="Revocar una API key de un Totem (protegido)")
+def revoke_totem_api_key(
+    totem_id: int,
+    key_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.Seller = Depends(security.get_current_user),
+):
+    """
+    Revoca una API key del tótem; deja de aceptarse de inmediato en este worker y en
+    los demás tras la siguiente recarga del índice (TOTEM_KEY_REFRESH_SECONDS).
+    Accesible para el dueño del tótem y para administradores.
+    """
+    _get_owned_totem(db, totem_id, current_user)
+    db_key = crud.revoke_totem_api_key(db, totem_id=totem_id, key_id=key_id)
+    if db_key is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="API key not found")
+    return db_key
+
 @app.delete("/sellers/{seller_id}", response_model=schemas.Seller, summary="Eliminar un Vendedor (protegido)")
 def delete_seller_endpoint(
     seller_id: int,
@@ -412,8 +863,293 @@ def delete_seller_endpoint(
     return crud.delete_seller(db=db, seller_id=seller_id)
 
 
+# --- Métricas (Prometheus) ---
+
+def _pool_metrics_lines() -> List[str]:
+    snapshots = {"sync": engine_pool_metrics.snapshot(), "async": async_engine_pool_metrics.snapshot()}
+    lines = []
+    for key, metric_type in (("checked_out", "gauge"), ("overflow", "gauge"), ("checkouts_total", "counter"),
+                             ("timeouts_total", "counter"), ("wait_seconds_total", "counter")):
+        series = [({"pool": name}, snapshot[key]) for name, snapshot in snapshots.items() if key in snapshot]
+        if series:
+            lines += render_counter(f"db_pool_{key}", f"Pool de conexiones: {key}.", series, metric_type=metric_type)
+    return lines
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics(request: Request):
+    """
+    Métricas de este worker en formato de texto de Prometheus: latencia, consultas a
+    la BD y llamadas a Mercado Pago por ruta, latencia de Mercado Pago por operación
+    y estado de los pools de conexiones.
+    """
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if settings.METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    mp_buckets = [bound / 1000 for bound in LatencyHistogram.BUCKETS_MS]
+    lines = request_metrics.render()
+    lines += render_histogram("mp_request_duration_seconds", "Duración de las llamadas a Mercado Pago por operación.",
+                              [({"operation": operation}, mp_buckets, counts, total)
+                               for operation, counts, total in mp_client.latency_series()])
+    lines += _pool_metrics_lines()
+    jwt_cache = security.verified_token_cache.status()
+    lines += render_counter("jwt_verified_cache_hits_total", "Tokens JWT servidos desde la caché de verificados.", [({}, jwt_cache["hits_total"])])
+    lines += render_counter("jwt_verified_cache_misses_total", "Tokens JWT cuya firma hubo que verificar.", [({}, jwt_cache["misses_total"])])
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- Endpoints de Administración (Protegidos para rol 'admin') ---
 
+@app.get("/api/v1/admin/token-scheduler", summary="[Admin] Estado del refresco proactivo de tokens")
+def admin_token_scheduler_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve el estado del planificador de refresco de tokens de Mercado Pago:
+    vendedores en cola, refrescos en curso, retraso acumulado y contadores.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return token_refresh_scheduler.status()
+
+@app.get("/api/v1/admin/mercadopago", summary="[Admin] Estado del cliente de Mercado Pago")
+def admin_mercadopago_client_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve el estado del circuit breaker, las llamadas rechazadas y los
+    histogramas de latencia por operación del cliente de Mercado Pago de este worker.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return mp_client.status()
+
+@app.get("/api/v1/admin/password-hasher", summary="[Admin] Estado del pool de hashing de contraseñas")
+def admin_password_hasher_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve las operaciones pendientes, rechazadas por saturación y rehasheadas,
+    y la duración media y máxima de cada verificación en este worker.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return security.password_hasher.status()
+
+@app.get("/api/v1/admin/db-pool", summary="[Admin] Métricas de los pools de conexiones")
+def admin_db_pool_metrics(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve las métricas de los pools de conexiones síncrono y asíncrono de este
+    worker: checkouts, tiempo de espera, overflow, timeouts e invalidaciones.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return {
+        "sync": engine_pool_metrics.snapshot(),
+        "async": async_engine_pool_metrics.snapshot(),
+    }
+
+@app.get("/api/v1/admin/live-feed", summary="[Admin] Estado del canal en vivo")
+def admin_live_feed_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve las conexiones SSE abiertas en este worker y los contadores de mensajes
+    publicados, entregados y descartados por backpressure.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return live_feed.status()
+
+@app.get("/api/v1/admin/shared-backend", summary="[Admin] Estado del backend compartido entre workers")
+def admin_shared_backend_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve el backend de estado compartido en uso (SHARED_BACKEND) y sus contadores
+    de esperas y timeouts de locks en este worker.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return shared_backend.status()
+
+@app.post("/api/v1/admin/payments/rollups/rebuild", summary="[Admin] Reconstruir rollups de recaudación")
+def admin_rebuild_payment_rollups(
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Recalcula todos los rollups de recaudación desde la tabla de pagos.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    buckets = payment_rollups.rebuild(db)
+    return {"status": "ok", "buckets": buckets}
+
+@app.get("/api/v1/admin/analytics/occupancy", response_model=schemas.ParkingOccupancy, summary="[Admin] Ocupación actual por dispositivo")
+def admin_parking_occupancy(
+    max_age_hours: Optional[float] = None,
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Devuelve los vehículos dentro (entradas sin salida) por dispositivo de entrada.
+    Las entradas más antiguas que `max_age_hours` (por defecto
+    PARKING_ANALYTICS_OPEN_TICKET_MAX_HOURS) se consideran tickets abandonados.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    max_age = settings.PARKING_ANALYTICS_OPEN_TICKET_MAX_HOURS if max_age_hours is None else max_age_hours
+    return parking_analytics.occupancy(db, max_age_hours=max_age)
+
+@app.get("/api/v1/admin/analytics/flow", response_model=List[schemas.ParkingFlowBucket], summary="[Admin] Flujo de entradas y salidas")
+def admin_parking_flow(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    granularity: Literal["hour", "day"] = "hour",
+    device_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Devuelve entradas y salidas por hora o día en [start_date, end_date), de todos
+    los dispositivos o de `device_id`. Por defecto, las últimas 24 horas.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    end = end_date or datetime.utcnow()
+    start = start_date or end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start_date must be before end_date")
+    return parking_analytics.flow(db, start=start, end=end, granularity=granularity, device_id=device_id)
+
+@app.get("/api/v1/admin/analytics/dwell", response_model=schemas.ParkingDwellSummary, summary="[Admin] Distribución de estadías")
+def admin_parking_dwell(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    device_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Devuelve el histograma de estadías (entrada a salida) de los días en
+    [start_date, end_date), con media y percentiles aproximados. Por defecto, los
+    últimos 7 días. Con `device_id`, sólo las estadías que entraron por ese dispositivo.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    end = end_date or datetime.utcnow()
+    start = start_date or end - timedelta(days=7)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start_date must be before end_date")
+    return parking_analytics.dwell(db, start=start, end=end, device_id=device_id)
+
+@app.post("/api/v1/admin/analytics/rebuild", summary="[Admin] Recalcular la analítica de parking")
+def admin_rebuild_parking_analytics(
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Borra los agregados de ocupación, flujo y estadías para que se recalculen desde
+    todos los eventos. El recálculo corre en segundo plano.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    parking_analytics.reset(db)
+    parking_analytics_updater.notify()
+    return {"status": "ok", "updater": parking_analytics_updater.status()}
+
+@app.get("/api/v1/admin/reconciliation", summary="[Admin] Estado de la conciliación de salidas y pagos")
+def admin_reconciliation_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve el progreso de la conciliación: filas por estado, eventos y pagos aún
+    sin procesar, contadores acumulados y rendimiento de la última ejecución.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return payment_reconciler.status()
+
+@app.get("/api/v1/admin/reconciliation/unmatched", response_model=List[schemas.PaymentReconciliation], summary="[Admin] Salidas sin pago o pagos sin salida")
+def admin_reconciliation_unmatched(
+    kind: Literal["exit", "payment"] = "exit",
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Lista las salidas sin pago (`kind=exit`) o los pagos aprobados sin salida
+    (`kind=payment`) que siguen sin emparejar tras RECONCILIATION_GRACE_MINUTES.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    older_than = datetime.utcnow() - timedelta(minutes=settings.RECONCILIATION_GRACE_MINUTES)
+    return payment_reconciliation.get_unmatched(db, kind=kind, older_than=older_than, skip=skip, limit=limit)
+
+@app.post("/api/v1/admin/reconciliation/run", summary="[Admin] Ejecutar la conciliación ahora")
+def admin_run_reconciliation(
+    rebuild: bool = False,
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Concilia los eventos y pagos pendientes sin esperar al siguiente intervalo. Con
+    `rebuild=true`, borra antes el estado y reconcilia todo desde el principio (sólo
+    los eventos y pagos que siguen en las tablas principales, no los archivados).
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    if rebuild:
+        payment_reconciliation.reset(db)
+    return {"status": "ok", "run": payment_reconciler.run_pending()}
+
+@app.get("/api/v1/admin/payments/backfill", summary="[Admin] Estado del backfill de pagos de Mercado Pago")
+def admin_payment_backfill_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve el progreso del backfill: vendedores sincronizados, marca de agua más
+    atrasada, vendedores con error y contadores de la última ejecución.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return payment_backfill_job.status()
+
+@app.post("/api/v1/admin/payments/backfill", status_code=status.HTTP_202_ACCEPTED, summary="[Admin] Sincronizar pagos desde Mercado Pago ahora")
+async def admin_run_payment_backfill(
+    days: Optional[float] = None,
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Lanza en segundo plano la sincronización de pagos de todos los vendedores sin
+    esperar al siguiente intervalo. Con `days`, ignora las marcas de agua y relee
+    los pagos actualizados en los últimos `days` días (re-sincronización completa).
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    if not payment_backfill_job.request_run(since=since):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A payment backfill is already running")
+    return {"status": "accepted"}
+
+@app.get("/api/v1/admin/archive", summary="[Admin] Estado del archivo de datos históricos")
+def admin_archive_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve los meses archivados de eventos, pagos y conciliación (filas y rango de
+    meses), los horizontes de retención vigentes y los contadores de la última ejecución.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return data_archiver.status()
+
+@app.post("/api/v1/admin/archive", status_code=status.HTTP_202_ACCEPTED, summary="[Admin] Archivar datos históricos ahora")
+async def admin_run_archive(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Lanza en segundo plano el archivado de los meses anteriores al horizonte de
+    retención sin esperar al siguiente intervalo.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    if not data_archiver.request_run():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="An archive run is already in progress")
+    return {"status": "accepted"}
+
+@app.get("/api/v1/admin/events/export", summary="[Admin] Exportar eventos de parking (CSV o Parquet)")
+def admin_export_parking_events(
+    format: Literal["csv", "parquet"] = "csv",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    device_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    admin_user: schemas.Seller = Depends(security.require_admin_user)
+):
+    """
+    Descarga los eventos de parking con `event_time` en [start_date, end_date),
+    opcionalmente de un solo dispositivo, incluidos los meses ya archivados. Se
+    genera en streaming.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    queries = exports.parking_events_queries(db, start_date=start_date, end_date=end_date, device_id=device_id)
+    return _export_response(queries, format, "parking_events")
+
+@app.get("/api/v1/admin/webhooks", summary="[Admin] Estado de la cola de notificaciones de Mercado Pago")
+def admin_webhook_queue_status(admin_user: schemas.Seller = Depends(security.require_admin_user)):
+    """
+    Devuelve las notificaciones en cola agrupadas por estado (incluida la dead-letter)
+    y los contadores del pool de workers.
+    Solo accesible para usuarios con rol 'admin'.
+    """
+    return webhook_worker_pool.status()
+
 @app.get("/api/v1/admin/sellers", response_model=List[schemas.Seller], summary="[Admin] Obtener todos los vendedores")
 def admin_read_sellers(
     db: Session = Depends(get_db),
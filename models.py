@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey, Boolean, Float
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey, Boolean, Float, UniqueConstraint, Index, Text
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -27,6 +29,12 @@ class Seller(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
+    # Cubre el listado paginado por vendedor ordenado por fecha (paginación por cursor)
+    __table_args__ = (
+        Index("ix_payments_seller_time_id", "seller_id", "payment_time", "id"),
+        # Selección de meses a archivar (ver data_retention.py)
+        Index("ix_payments_payment_time", "payment_time"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     mp_payment_id = Column(String(50), unique=True, index=True, nullable=False)
@@ -40,8 +48,35 @@ class Payment(Base):
 
     created_at = Column(DateTime, server_default=func.now())
 
+class PaymentRollup(Base):
+    """
+    Totales de pagos aprobados por vendedor, tótem y bucket temporal ('hour' o 'day').
+    Se mantienen de forma incremental al guardar pagos; ver payment_rollups.py.
+    """
+    __tablename__ = "payment_rollups"
+    __table_args__ = (
+        UniqueConstraint("granularity", "seller_id", "external_pos_id", "bucket_start", name="uq_payment_rollup_bucket"),
+        Index("ix_payment_rollups_seller_range", "seller_id", "granularity", "bucket_start"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    seller_id = Column(Integer, ForeignKey("sellers.id"), nullable=False)
+    external_pos_id = Column(String(50), nullable=False, default="") # '' si el pago no tiene tótem
+    granularity = Column(String(10), nullable=False) # 'hour' o 'day'
+    bucket_start = Column(DateTime, nullable=False)
+    payment_count = Column(Integer, nullable=False, default=0)
+    total_amount = Column(Float, nullable=False, default=0.0)
+    min_amount = Column(Float, nullable=True)
+    max_amount = Column(Float, nullable=True)
+
 class ParkingEvent(Base):
     __tablename__ = "parking_events"
+    # Clave natural: un tótem que reintenta un lote no debe duplicar eventos
+    __table_args__ = (
+        UniqueConstraint("ticket_code", "device_id", "event_type", "event_time", name="uq_parking_event_natural_key"),
+        # Exportación por rango de fechas y selección de meses a archivar
+        Index("ix_parking_events_event_time", "event_time"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     ticket_code = Column(String(20), nullable=False, index=True)
@@ -69,3 +104,178 @@ class Totem(Base):
     # Timestamps
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class TotemApiKey(Base):
+    """
+    API key de un tótem. Sólo se guarda el SHA-256 de la key; el prefijo permite
+    identificarla sin exponerla. Ver totem_keys.py.
+    """
+    __tablename__ = "totem_api_keys"
+
+    id = Column(Integer, primary_key=True, index=True)
+    totem_id = Column(Integer, ForeignKey("totems.id"), nullable=False, index=True)
+    key_hash = Column(String(64), unique=True, nullable=False)
+    key_prefix = Column(String(8), nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    revoked_at = Column(DateTime, nullable=True)
+
+
+class WebhookNotification(Base):
+    """
+    Bandeja de entrada persistente de notificaciones de Mercado Pago. El webhook sólo
+    inserta aquí y responde; un pool de workers las procesa con reintentos.
+    """
+    __tablename__ = "webhook_notifications"
+    __table_args__ = (
+        Index("ix_webhook_notifications_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    topic = Column(String(50), nullable=False) # Ej: 'payment'
+    action = Column(String(50), nullable=True) # Ej: 'payment.created'
+    resource_id = Column(String(50), nullable=False, index=True) # Ej: ID del pago en MP
+    status = Column(String(20), nullable=False, default="pending") # 'pending', 'processing', 'done' o 'dead'
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, server_default=func.now())
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+    # Timestamps
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+# --- Tablas de Analítica de Ocupación (ver parking_analytics.py) ---
+
+class AnalyticsWatermark(Base):
+    """Último `parking_events.id` procesado por cada proceso incremental."""
+    __tablename__ = "analytics_watermarks"
+
+    name = Column(String(50), primary_key=True)
+    last_event_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class ParkingOpenTicket(Base):
+    """
+    Estado compacto de tickets sin emparejar: una fila por ticket con su último evento
+    (normalmente una entrada sin salida; puede ser una salida recibida antes que su entrada).
+    """
+    __tablename__ = "parking_open_tickets"
+
+    ticket_code = Column(String(20), primary_key=True)
+    event_type = Column(String(10), nullable=False, index=True) # 'entry' o 'exit' (normalizado)
+    device_id = Column(Integer, nullable=True)
+    event_time = Column(DateTime, nullable=False)
+
+class ParkingFlowHourly(Base):
+    """Entradas y salidas por dispositivo y hora."""
+    __tablename__ = "parking_flow_hourly"
+    __table_args__ = (
+        UniqueConstraint("device_id", "bucket_start", name="uq_parking_flow_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    device_id = Column(Integer, nullable=False) # -1 si el evento no trae dispositivo
+    bucket_start = Column(DateTime, nullable=False, index=True)
+    entries = Column(Integer, nullable=False, default=0)
+    exits = Column(Integer, nullable=False, default=0)
+
+class ParkingDwellStat(Base):
+    """Histograma de estadías (entrada -> salida) por dispositivo de entrada y día de salida."""
+    __tablename__ = "parking_dwell_stats"
+    __table_args__ = (
+        UniqueConstraint("device_id", "bucket_start", "bin_index", name="uq_parking_dwell_bin"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    device_id = Column(Integer, nullable=False) # -1 si el evento no trae dispositivo
+    bucket_start = Column(DateTime, nullable=False, index=True)
+    bin_index = Column(Integer, nullable=False) # Índice en parking_analytics.DWELL_BIN_EDGES_MINUTES
+    stays = Column(Integer, nullable=False, default=0)
+    total_seconds = Column(Float, nullable=False, default=0.0)
+
+
+class PaymentReconciliation(Base):
+    """
+    Estado de la conciliación entre salidas (`parking_events`) y pagos aprobados por
+    `ticket_code`. Cada fila es una salida y/o un pago: 'matched' si se emparejaron,
+    'unmatched' si falta la otra mitad, 'pending' si es un pago aún no aprobado.
+    Ver payment_reconciliation.py.
+    """
+    __tablename__ = "payment_reconciliations"
+    __table_args__ = (
+        Index("ix_payment_reconciliations_ticket_status", "ticket_code", "status"),
+        Index("ix_payment_reconciliations_status_time", "status", "reference_time"),
+        Index("ix_payment_reconciliations_reference_time", "reference_time"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    ticket_code = Column(String(20), nullable=False)
+    status = Column(String(20), nullable=False) # 'matched', 'unmatched' o 'pending'
+    exit_event_id = Column(Integer, ForeignKey("parking_events.id"), unique=True, nullable=True)
+    exit_time = Column(DateTime, nullable=True)
+    device_id = Column(Integer, nullable=True)
+    payment_id = Column(Integer, ForeignKey("payments.id"), unique=True, nullable=True)
+    payment_time = Column(DateTime, nullable=True)
+    reference_time = Column(DateTime, nullable=False) # Salida o, si no hay, pago
+    matched_at = Column(DateTime, nullable=True)
+
+
+class PaymentSyncState(Base):
+    """
+    Progreso del backfill de pagos desde la búsqueda de Mercado Pago, por vendedor.
+    Ver payment_backfill.py.
+    """
+    __tablename__ = "payment_sync_states"
+
+    seller_id = Column(Integer, ForeignKey("sellers.id"), primary_key=True)
+    synced_until = Column(DateTime, nullable=True) # date_last_updated (UTC) hasta el que ya se sincronizó
+    last_run_at = Column(DateTime, nullable=True)
+    last_error = Column(String(255), nullable=True)
+    payments_seen = Column(Integer, nullable=False, default=0)
+    payments_changed = Column(Integer, nullable=False, default=0)
+
+
+class ArchivedMonth(Base):
+    """
+    Catálogo de tablas de archivo mensuales (`<kind>_archive_<YYYYMM>`): qué meses de
+    `parking_events`, `payments` y `payment_reconciliations` se movieron fuera de la
+    tabla principal y con qué rango de ids. Ver archive_tables.py y data_retention.py.
+    """
+    __tablename__ = "archive_months"
+    __table_args__ = (
+        UniqueConstraint("kind", "month", name="uq_archive_month"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(30), nullable=False) # Tabla de origen
+    month = Column(DateTime, nullable=False) # Primer día del mes (UTC)
+    table_name = Column(String(64), nullable=False)
+    row_count = Column(Integer, nullable=False, default=0)
+    min_id = Column(Integer, nullable=True)
+    max_id = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+# --- Estado Compartido entre Workers (ver shared_backend.py) ---
+
+class SharedCacheEntry(Base):
+    """Valor con vencimiento compartido entre procesos; también respalda los locks."""
+    __tablename__ = "shared_cache"
+
+    key = Column(String(191), primary_key=True) # 191: límite de índice de MySQL con utf8mb4
+    value = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True) # UTC
+
+class SharedMessage(Base):
+    """Mensaje de pub/sub entre procesos. Se borra al superar la retención."""
+    __tablename__ = "shared_messages"
+    # AUTOINCREMENT en SQLite: los ids no se reutilizan aunque se borren los últimos
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    channel = Column(String(100), nullable=False)
+    origin = Column(String(32), nullable=False) # Proceso que lo publicó
+    payload = Column(Text, nullable=False) # JSON
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
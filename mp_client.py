@@ -0,0 +1,293 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+import request_metrics
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Cliente HTTP de Mercado Pago ---
+#
+# Todas las llamadas salientes a Mercado Pago pasan por este cliente compartido:
+# - una requests.Session con pool de conexiones (se reutilizan las conexiones TLS),
+# - timeouts explícitos de conexión y lectura, para que un Mercado Pago lento no
+#   retenga hilos del servidor indefinidamente,
+# - un token bucket que limita la tasa de llamadas de este proceso,
+# - un circuit breaker que deja de llamar durante un tiempo tras varios fallos
+#   seguidos (errores de red, 429 y 5xx), y
+# - histogramas de latencia por operación.
+# La URL base es configurable (MP_API_BASE_URL) para probar contra un servidor local.
+
+
+class MercadoPagoError(Exception):
+    """Error de comunicación con Mercado Pago."""
+
+
+class MercadoPagoUnavailable(MercadoPagoError):
+    """No se intentó la llamada: circuito abierto o límite de tasa agotado."""
+
+
+class TokenBucket:
+    """Limitador de tasa: `rate` llamadas por segundo con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        """Toma un token, esperando como máximo `timeout` segundos. Devuelve False si no pudo."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    'closed' mientras las llamadas funcionan; 'open' tras `failure_threshold` fallos
+    seguidos, rechazando llamadas durante `reset_seconds`; luego 'half_open', donde
+    se permite una única llamada de prueba que decide si vuelve a cerrarse.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self.opened_total = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """La llamada permitida no llegó a hacerse: libera la llamada de prueba, si lo era."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    self.opened_total += 1
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+class LatencyHistogram:
+    """Histograma acumulado de latencias (en milisegundos) de una operación."""
+
+    BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.total = 0
+        self.errors = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, milliseconds: float, error: bool = False):
+        index = next((i for i, bound in enumerate(self.BUCKETS_MS) if milliseconds <= bound), len(self.BUCKETS_MS))
+        self.counts[index] += 1
+        self.total += 1
+        self.errors += int(error)
+        self.sum_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+
+    def snapshot(self) -> dict:
+        bounds = [f"le_{bound}" for bound in self.BUCKETS_MS] + ["inf"]
+        return {
+            "count": self.total,
+            "errors": self.errors,
+            "avg_ms": round(self.sum_ms / self.total, 2) if self.total else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "buckets": dict(zip(bounds, self.counts)),
+        }
+
+
+class MercadoPagoClient:
+    # Códigos que indican un Mercado Pago sobrecargado o caído (cuentan para el circuito)
+    FAILURE_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        base_url: str = "https://api.mercadopago.com",
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        pool_size: int = 10,
+        max_retries: int = 2,
+        rate_per_second: float = 20.0,
+        burst: float = 40.0,
+        rate_limit_wait_seconds: float = 5.0,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limit_wait_seconds = rate_limit_wait_seconds
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+
+        # Sólo se reintentan automáticamente los GET (idempotentes) ante errores transitorios
+        retry = Retry(total=max_retries, connect=max_retries, read=0, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET"}), backoff_factor=0.2, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
+
+        self._lock = threading.Lock()
+        self._latency: Dict[str, LatencyHistogram] = {}
+        self.rejected_total = 0
+
+    # --- Núcleo ---
+
+    def request(self, operation: str, method: str, path: str, **kwargs) -> dict:
+        """
+        Ejecuta una llamada y devuelve {"status": <código HTTP>, "response": <JSON o None>},
+        igual que el SDK de Mercado Pago. Lanza MercadoPagoUnavailable si la llamada no
+        se intentó y MercadoPagoError si falló la comunicación.
+        """
+        if not self.breaker.allow():
+            self._reject()
+            raise MercadoPagoUnavailable(f"Circuito abierto: no se llama a Mercado Pago ({operation})")
+        if not self.bucket.acquire(self.rate_limit_wait_seconds):
+            self._reject()
+            self.breaker.release()
+            raise MercadoPagoUnavailable(f"Límite de tasa de Mercado Pago agotado ({operation})")
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self._observe(operation, start, error=True)
+            self.breaker.record_failure()
+            raise MercadoPagoError(f"Error de red llamando a Mercado Pago ({operation}): {e}") from e
+
+        failed = response.status_code in self.FAILURE_STATUSES
+        self._observe(operation, start, error=failed)
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        try:
+            body = response.json() if response.content else None
+        except ValueError:
+            body = None
+        return {"status": response.status_code, "response": body}
+
+    def _observe(self, operation: str, start: float, error: bool):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._latency.setdefault(operation, LatencyHistogram()).observe(elapsed_ms, error=error)
+        request_metrics.record_outbound(elapsed_ms / 1000)
+
+    def _reject(self):
+        with self._lock:
+            self.rejected_total += 1
+
+    # --- Operaciones ---
+
+    def get_payment(self, payment_id: str, access_token: str) -> dict:
+        return self.request("payment.get", "GET", f"/v1/payments/{payment_id}",
+                            headers={"Authorization": f"Bearer {access_token}"})
+
+    def search_payments(self, access_token: str, params: dict) -> dict:
+        return self.request("payment.search", "GET", "/v1/payments/search", params=params,
+                            headers={"Authorization": f"Bearer {access_token}"})
+
+    def refresh_access_token(self, refresh_token: str) -> dict:
+        return self.request("oauth.refresh", "POST", "/oauth/token", data={
+            "client_id": settings.MP_APP_ID,
+            "client_secret": settings.MP_SECRET_KEY,
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        })
+
+    def exchange_authorization_code(self, code: str, redirect_uri: str) -> dict:
+        return self.request("oauth.authorize", "POST", "/oauth/token", data={
+            "client_id": settings.MP_APP_ID,
+            "client_secret": settings.MP_SECRET_KEY,
+            "code": code,
+            "redirect_uri": redirect_uri,
+            "grant_type": "authorization_code",
+        })
+
+    # --- Métricas ---
+
+    def latency_series(self) -> list:
+        """(operación, conteos por bucket, suma en segundos) de cada histograma, para /metrics."""
+        with self._lock:
+            return [(operation, list(histogram.counts), histogram.sum_ms / 1000)
+                    for operation, histogram in self._latency.items()]
+
+    def status(self) -> dict:
+        with self._lock:
+            latency = {operation: histogram.snapshot() for operation, histogram in self._latency.items()}
+        return {
+            "base_url": self.base_url,
+            "circuit": self.breaker.state,
+            "circuit_opened_total": self.breaker.opened_total,
+            "rejected_total": self.rejected_total,
+            "latency": latency,
+        }
+
+
+mp_client = MercadoPagoClient(
+    base_url=settings.MP_API_BASE_URL,
+    connect_timeout=settings.MP_HTTP_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=settings.MP_HTTP_READ_TIMEOUT_SECONDS,
+    pool_size=settings.MP_HTTP_POOL_SIZE,
+    max_retries=settings.MP_HTTP_MAX_RETRIES,
+    rate_per_second=settings.MP_RATE_LIMIT_PER_SECOND,
+    burst=settings.MP_RATE_LIMIT_BURST,
+    rate_limit_wait_seconds=settings.MP_RATE_LIMIT_MAX_WAIT_SECONDS,
+    failure_threshold=settings.MP_CIRCUIT_FAILURE_THRESHOLD,
+    reset_seconds=settings.MP_CIRCUIT_RESET_SECONDS,
+)
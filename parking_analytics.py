@@ -0,0 +1,465 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import select, func, delete, update, insert, union_all
+from sqlalchemy.dialects import sqlite, postgresql, mysql
+from sqlalchemy.orm import Session
+
+import archive_tables
+import models
+from shared_backend import JobLock, SharedBackend
+
+logger = logging.getLogger(__name__)
+
+# --- Analítica de Ocupación y Estadías ---
+#
+# Los eventos de `parking_events` se procesan de forma incremental: cada pasada lee
+# sólo los eventos con id mayor que la marca de agua guardada en
+# `analytics_watermarks`, empareja entradas con salidas por ticket y suma los
+# resultados en tablas agregadas (flujo por hora y histograma de estadías por día).
+# Los tickets sin emparejar se guardan en `parking_open_tickets`, una fila por ticket,
+# que es además la fuente de la ocupación actual. Los agregados, el estado de tickets
+# abiertos y la marca de agua se escriben en la misma transacción, y la marca de agua
+# se avanza con un UPDATE condicional, de modo que dos procesos no suman el mismo lote.
+#
+# Los ids autoincrementales se asignan al insertar, pero las filas se hacen visibles
+# al confirmar: con varios tótems, webhooks y backfills insertando a la vez, un id
+# bajo puede aparecer después de que la marca de agua lo pasó, y se perdería. Por eso
+# cada pasada sólo consume el prefijo de filas (en orden de id) con `created_at`
+# anterior a un margen de asentamiento (`settle_seconds`, medido con el reloj de la
+# BD): cualquier id menor ya se confirmó, salvo transacciones más largas que el margen.
+
+WATERMARK_NAME = "parking_events"
+JOB_LOCK_NAME = "job:parking_analytics"
+NO_DEVICE = -1
+
+ENTRY, EXIT = "entry", "exit"
+# Valores de event_type aceptados, normalizados a 'entry' / 'exit'
+EVENT_TYPES = {
+    "entry": ENTRY, "in": ENTRY, "entrada": ENTRY,
+    "exit": EXIT, "out": EXIT, "salida": EXIT,
+}
+
+# Límites inferiores (en minutos) de cada intervalo del histograma de estadías.
+# El último intervalo no tiene límite superior.
+DWELL_BIN_EDGES_MINUTES = (0, 15, 30, 60, 120, 240, 480, 720, 1440)
+_DWELL_BIN_EDGES_SECONDS = np.array(DWELL_BIN_EDGES_MINUTES, dtype=np.float64) * 60
+
+# Filas por INSERT multi-fila y valores por cláusula IN (SQLite admite pocos parámetros)
+WRITE_BATCH_SIZE = 500
+
+def normalize_event_type(event_type: Optional[str]) -> Optional[str]:
+    return EVENT_TYPES.get((event_type or "").strip().lower())
+
+def _naive_utc(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _chunks(values: list, size: int = WRITE_BATCH_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+# --- Escritura de Agregados ---
+
+def _add_counts(db: Session, table, key: List[str], counters: List[str], rows: List[dict]):
+    """Suma `counters` a las filas existentes con la misma `key` o las inserta."""
+    dialect = db.get_bind().dialect.name
+    for chunk in _chunks(rows):
+        if dialect in ("sqlite", "postgresql"):
+            statement = (sqlite if dialect == "sqlite" else postgresql).insert(table).values(chunk)
+            db.execute(statement.on_conflict_do_update(
+                index_elements=key,
+                set_={column: table.c[column] + statement.excluded[column] for column in counters},
+            ))
+            continue
+        if dialect in ("mysql", "mariadb"):
+            statement = mysql.insert(table).values(chunk)
+            db.execute(statement.on_duplicate_key_update(
+                **{column: table.c[column] + statement.inserted[column] for column in counters}
+            ))
+            continue
+        # Otros motores: lectura + escritura por fila dentro de la transacción en curso
+        for row in chunk:
+            conditions = [table.c[column] == row[column] for column in key]
+            result = db.execute(update(table).where(*conditions).values(
+                **{column: table.c[column] + row[column] for column in counters}
+            ))
+            if not result.rowcount:
+                db.execute(insert(table).values(**row))
+
+def _hour_keys(devices: np.ndarray, times: np.ndarray) -> np.ndarray:
+    return np.stack([devices, times.astype("datetime64[h]").astype(np.int64)], axis=1)
+
+def _flow_rows(devices: np.ndarray, times: np.ndarray, is_entry: np.ndarray) -> List[dict]:
+    """Entradas y salidas por (dispositivo, hora), agrupadas con NumPy."""
+    if not len(devices):
+        return []
+    keys, inverse = np.unique(_hour_keys(devices, times), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    entries = np.bincount(inverse, weights=is_entry, minlength=len(keys))
+    exits = np.bincount(inverse, weights=~is_entry, minlength=len(keys))
+    hours = keys[:, 1].astype("datetime64[h]").astype("datetime64[us]")
+    return [
+        {"device_id": int(device), "bucket_start": hour.item(), "entries": int(entry_count), "exits": int(exit_count)}
+        for device, hour, entry_count, exit_count in zip(keys[:, 0], hours, entries, exits)
+    ]
+
+def _dwell_rows(devices: np.ndarray, exit_times: np.ndarray, seconds: np.ndarray) -> List[dict]:
+    """Estadías por (dispositivo de entrada, día de salida, intervalo del histograma)."""
+    if not len(devices):
+        return []
+    bins = np.searchsorted(_DWELL_BIN_EDGES_SECONDS, seconds, side="right") - 1
+    days = exit_times.astype("datetime64[D]").astype(np.int64)
+    keys, inverse = np.unique(np.stack([devices, days, bins], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    stays = np.bincount(inverse, minlength=len(keys))
+    totals = np.bincount(inverse, weights=seconds, minlength=len(keys))
+    starts = keys[:, 1].astype("datetime64[D]").astype("datetime64[us]")
+    return [
+        {"device_id": int(device), "bucket_start": day.item(), "bin_index": int(bin_index),
+         "stays": int(count), "total_seconds": float(total)}
+        for device, day, bin_index, count, total in zip(keys[:, 0], starts, keys[:, 2], stays, totals)
+    ]
+
+# --- Procesamiento Incremental ---
+
+def get_watermark(db: Session, name: str = WATERMARK_NAME) -> int:
+    last_event_id = db.execute(
+        select(models.AnalyticsWatermark.last_event_id).where(models.AnalyticsWatermark.name == name)
+    ).scalar()
+    return last_event_id or 0
+
+def settle_cutoff(db: Session, settle_seconds: float) -> Optional[datetime]:
+    """Instante (reloj de la BD) antes del cual las filas insertadas ya son visibles."""
+    if settle_seconds <= 0:
+        return None
+    now = db.execute(select(func.now())).scalar()
+    # PostgreSQL devuelve now() con zona; `created_at` se guarda sin ella, en la hora de la sesión
+    return now.replace(tzinfo=None) - timedelta(seconds=settle_seconds)
+
+def settled_prefix(rows: list, cutoff: Optional[datetime]) -> list:
+    """
+    Filas (ordenadas por id, con `created_at` en la última columna) hasta la primera
+    insertada después de `cutoff`: las posteriores pueden tener ids menores sin confirmar.
+    """
+    if cutoff is None:
+        return rows
+    for position, row in enumerate(rows):
+        if row[-1] is not None and row[-1] >= cutoff:
+            return rows[:position]
+    return rows
+
+def advance_watermark(db: Session, previous: int, last_event_id: int, name: str = WATERMARK_NAME) -> bool:
+    """Avanza la marca de agua sólo si nadie la movió desde que leímos `previous`."""
+    watermark = models.AnalyticsWatermark
+    result = db.execute(
+        update(watermark)
+        .where(watermark.name == name, watermark.last_event_id == previous)
+        .values(last_event_id=last_event_id)
+    )
+    if result.rowcount:
+        return True
+    if previous != 0 or db.execute(select(watermark.name).where(watermark.name == name)).first():
+        return False
+    db.execute(insert(watermark).values(name=name, last_event_id=last_event_id))
+    return True
+
+def _load_open_tickets(db: Session, ticket_codes: List[str]) -> Dict[str, tuple]:
+    open_tickets = {}
+    for chunk in _chunks(ticket_codes):
+        rows = db.execute(
+            select(models.ParkingOpenTicket.ticket_code, models.ParkingOpenTicket.event_type,
+                   models.ParkingOpenTicket.device_id, models.ParkingOpenTicket.event_time)
+            .where(models.ParkingOpenTicket.ticket_code.in_(chunk))
+        ).all()
+        for ticket_code, event_type, device_id, event_time in rows:
+            open_tickets[ticket_code] = (event_type, NO_DEVICE if device_id is None else device_id, np.datetime64(event_time, "us"))
+    return open_tickets
+
+def process_batch(db: Session, batch_size: int = 5000, settle_seconds: float = 0.0) -> int:
+    """
+    Procesa hasta `batch_size` eventos posteriores a la marca de agua e insertados
+    hace más de `settle_seconds`. Devuelve el número de eventos consumidos (0 si no
+    había nada nuevo o si otro proceso tomó el mismo lote).
+    """
+    previous = get_watermark(db)
+    cutoff = settle_cutoff(db, settle_seconds)
+    # Sólo se archivan eventos ya procesados, así que las tablas de archivo aparecen
+    # aquí únicamente al recalcular desde cero (reset)
+    sources = [
+        select(table.c.id, table.c.ticket_code, table.c.device_id, table.c.event_type, table.c.event_time,
+               table.c.created_at)
+        .where(table.c.id > previous)
+        for table in archive_tables.tables_after_id(db, "parking_events", previous) + [models.ParkingEvent.__table__]
+    ]
+    if len(sources) == 1:
+        query = sources[0].order_by(models.ParkingEvent.id)
+    else:
+        events = union_all(*sources).subquery()
+        query = select(events).order_by(events.c.id)
+    rows = settled_prefix(db.execute(query.limit(batch_size)).all(), cutoff)
+    if not rows:
+        return 0
+    last_event_id = rows[-1][0]
+
+    # Descartamos tipos de evento desconocidos, pero igual avanzamos la marca de agua
+    events = [(event_id, ticket_code, device_id, normalize_event_type(event_type), event_time)
+              for event_id, ticket_code, device_id, event_type, event_time, _ in rows]
+    events = [event for event in events if event[3] is not None and event[1]]
+
+    if events:
+        ids = np.array([event[0] for event in events], dtype=np.int64)
+        tickets, ticket_index = np.unique(np.array([event[1] for event in events], dtype=object), return_inverse=True)
+        devices = np.array([NO_DEVICE if event[2] is None else event[2] for event in events], dtype=np.int64)
+        is_entry = np.array([event[3] == ENTRY for event in events], dtype=bool)
+        times = np.array([_naive_utc(event[4]) for event in events], dtype="datetime64[us]")
+
+        flow = _flow_rows(devices, times, is_entry)
+
+        # Emparejamiento: por ticket y en orden cronológico, contra el estado abierto
+        open_tickets = _load_open_tickets(db, tickets.tolist())
+        touched = set(open_tickets)
+        dwell_devices, dwell_exits, dwell_seconds = [], [], []
+        for position in np.lexsort((ids, times, ticket_index)):
+            ticket_code = tickets[ticket_index[position]]
+            event_type = ENTRY if is_entry[position] else EXIT
+            device_id, event_time = int(devices[position]), times[position]
+            touched.add(ticket_code)
+            current = open_tickets.get(ticket_code)
+            if current is not None and current[0] != event_type:
+                entry, exit_ = (current, (event_type, device_id, event_time)) if event_type == EXIT \
+                    else ((event_type, device_id, event_time), current)
+                if exit_[2] >= entry[2]:
+                    dwell_devices.append(entry[1])
+                    dwell_exits.append(exit_[2])
+                    dwell_seconds.append((exit_[2] - entry[2]) / np.timedelta64(1, "s"))
+                    del open_tickets[ticket_code]
+                    continue
+                if event_type == EXIT:
+                    # Salida anterior a la entrada abierta: pertenece a una visita previa
+                    continue
+            # Nueva entrada (o salida aún sin entrada): pasa a ser el estado del ticket
+            open_tickets[ticket_code] = (event_type, device_id, event_time)
+
+        dwell = _dwell_rows(np.array(dwell_devices, dtype=np.int64), np.array(dwell_exits, dtype="datetime64[us]"),
+                            np.array(dwell_seconds, dtype=np.float64))
+
+        _add_counts(db, models.ParkingFlowHourly.__table__, ["device_id", "bucket_start"], ["entries", "exits"], flow)
+        _add_counts(db, models.ParkingDwellStat.__table__, ["device_id", "bucket_start", "bin_index"],
+                    ["stays", "total_seconds"], dwell)
+        for chunk in _chunks(sorted(touched)):
+            db.execute(delete(models.ParkingOpenTicket).where(models.ParkingOpenTicket.ticket_code.in_(chunk)))
+        state = [
+            {"ticket_code": ticket_code, "event_type": event_type,
+             "device_id": None if device_id == NO_DEVICE else device_id, "event_time": event_time.item()}
+            for ticket_code, (event_type, device_id, event_time) in open_tickets.items()
+        ]
+        for chunk in _chunks(state):
+            db.execute(insert(models.ParkingOpenTicket), chunk)
+
+    if not advance_watermark(db, previous, last_event_id):
+        db.rollback()
+        return 0
+    db.commit()
+    return len(rows)
+
+def reset(db: Session):
+    """Borra los agregados y la marca de agua para recalcular todo desde cero."""
+    for model in (models.ParkingFlowHourly, models.ParkingDwellStat, models.ParkingOpenTicket):
+        db.execute(delete(model))
+    db.execute(delete(models.AnalyticsWatermark).where(models.AnalyticsWatermark.name == WATERMARK_NAME))
+    db.commit()
+
+# --- Consultas ---
+
+def occupancy(db: Session, max_age_hours: Optional[float] = None) -> dict:
+    """
+    Ocupación actual por dispositivo de entrada: tickets con una entrada sin salida.
+    Con `max_age_hours`, se ignoran las entradas más antiguas (tickets abandonados).
+    """
+    ticket = models.ParkingOpenTicket
+    conditions = [ticket.event_type == ENTRY]
+    if max_age_hours:
+        conditions.append(ticket.event_time >= datetime.utcnow() - timedelta(hours=max_age_hours))
+    rows = db.execute(
+        select(ticket.device_id, func.count(), func.min(ticket.event_time))
+        .where(*conditions)
+        .group_by(ticket.device_id)
+        .order_by(ticket.device_id)
+    ).all()
+    last_event_id = get_watermark(db)
+    pending = db.execute(select(func.count(models.ParkingEvent.id)).where(models.ParkingEvent.id > last_event_id)).scalar()
+    return {
+        "total": sum(count for _, count, _ in rows),
+        "devices": [{"device_id": device_id, "occupancy": count, "oldest_entry": oldest} for device_id, count, oldest in rows],
+        "last_event_id": last_event_id,
+        "pending_events": pending,
+    }
+
+def flow(db: Session, start: datetime, end: datetime, granularity: str = "hour", device_id: Optional[int] = None) -> List[dict]:
+    """Entradas y salidas en [start, end) por hora o día, sumando los dispositivos pedidos."""
+    conditions = [models.ParkingFlowHourly.bucket_start >= start, models.ParkingFlowHourly.bucket_start < end]
+    if device_id is not None:
+        conditions.append(models.ParkingFlowHourly.device_id == device_id)
+    rows = db.execute(
+        select(models.ParkingFlowHourly.bucket_start, models.ParkingFlowHourly.entries, models.ParkingFlowHourly.exits)
+        .where(*conditions)
+    ).all()
+    series = {}
+    for bucket, entries, exits in rows:
+        if granularity == "day":
+            bucket = bucket.replace(hour=0)
+        counts = series.setdefault(bucket, [0, 0])
+        counts[0] += entries
+        counts[1] += exits
+    return [{"bucket_start": bucket, "entries": entries, "exits": exits} for bucket, (entries, exits) in sorted(series.items())]
+
+def _percentile(stays: np.ndarray, fraction: float) -> Optional[float]:
+    """Percentil aproximado (en minutos) interpolando dentro del intervalo del histograma."""
+    total = stays.sum()
+    if not total:
+        return None
+    cumulative = np.cumsum(stays)
+    index = int(np.searchsorted(cumulative, fraction * total))
+    lower = DWELL_BIN_EDGES_MINUTES[index]
+    if index + 1 >= len(DWELL_BIN_EDGES_MINUTES):
+        return float(lower)
+    before = cumulative[index - 1] if index else 0
+    width = DWELL_BIN_EDGES_MINUTES[index + 1] - lower
+    return float(lower + width * (fraction * total - before) / stays[index])
+
+def dwell(db: Session, start: datetime, end: datetime, device_id: Optional[int] = None) -> dict:
+    """Histograma de estadías cuya salida cae en los días de [start, end)."""
+    conditions = [models.ParkingDwellStat.bucket_start >= start, models.ParkingDwellStat.bucket_start < end]
+    if device_id is not None:
+        conditions.append(models.ParkingDwellStat.device_id == device_id)
+    rows = db.execute(
+        select(models.ParkingDwellStat.bin_index, func.sum(models.ParkingDwellStat.stays),
+               func.sum(models.ParkingDwellStat.total_seconds))
+        .where(*conditions)
+        .group_by(models.ParkingDwellStat.bin_index)
+    ).all()
+    stays = np.zeros(len(DWELL_BIN_EDGES_MINUTES), dtype=np.int64)
+    total_seconds = 0.0
+    for bin_index, count, seconds in rows:
+        stays[bin_index] = count
+        total_seconds += seconds or 0.0
+    count = int(stays.sum())
+    upper_edges = DWELL_BIN_EDGES_MINUTES[1:] + (None,)
+    return {
+        "start_date": start,
+        "end_date": end,
+        "stays": count,
+        "average_minutes": total_seconds / count / 60 if count else None,
+        "p50_minutes": _percentile(stays, 0.5),
+        "p90_minutes": _percentile(stays, 0.9),
+        "bins": [{"min_minutes": lower, "max_minutes": upper, "stays": int(bin_stays)}
+                 for lower, upper, bin_stays in zip(DWELL_BIN_EDGES_MINUTES, upper_edges, stays)],
+    }
+
+
+class ParkingAnalyticsUpdater:
+    """
+    Tarea en segundo plano que mantiene los agregados al día. Procesa lotes mientras
+    haya eventos nuevos y luego espera `interval_seconds` o un aviso de notify().
+    Los eventos se procesan cuando tienen más de `settle_seconds` de antigüedad. Con
+    `backend`, cada pasada toma un lock compartido y sólo corre en un worker a la vez.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], interval_seconds: float = 30.0, batch_size: int = 5000,
+                 settle_seconds: float = 10.0, backend: Optional[SharedBackend] = None, lock_ttl_seconds: float = 900.0):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.backend = backend
+        self.lock_ttl_seconds = lock_ttl_seconds
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.processed_total = 0
+        self.failures_total = 0
+        self.skipped_total = 0 # Pasadas omitidas porque otro worker tenía el lock
+        self.last_run_at: Optional[datetime] = None
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Analítica de parking iniciada.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        logger.info("Analítica de parking detenida.")
+
+    # --- API pública ---
+
+    def notify(self):
+        """Avisa de que hay eventos nuevos. Puede llamarse desde hilos del threadpool."""
+        if self.is_running:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def status(self) -> dict:
+        return {
+            "running": self.is_running,
+            "processed_total": self.processed_total,
+            "failures_total": self.failures_total,
+            "skipped_total": self.skipped_total,
+            "last_run_at": self.last_run_at,
+        }
+
+    # --- Implementación ---
+
+    def run_pending(self) -> int:
+        """Procesa todos los eventos pendientes. Devuelve cuántos se consumieron."""
+        job_lock = JobLock(self.backend, JOB_LOCK_NAME, self.lock_ttl_seconds)
+        if not job_lock.acquire():
+            self.skipped_total += 1
+            return 0
+        processed = 0
+        db = self.session_factory()
+        try:
+            # Entre tandas se renueva el lock; si se perdió, otro worker sigue desde la marca de agua
+            while job_lock.keep():
+                batch = process_batch(db, batch_size=self.batch_size, settle_seconds=self.settle_seconds)
+                processed += batch
+                self.processed_total += batch
+                if batch < self.batch_size:
+                    break
+        finally:
+            db.close()
+            job_lock.release()
+        self.last_run_at = datetime.now(timezone.utc)
+        return processed
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_pending)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures_total += 1
+                logger.error(f"Error actualizando la analítica de parking: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
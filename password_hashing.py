@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+# --- Hashing de Contraseñas fuera del Event Loop ---
+#
+# bcrypt consume CPU a propósito (cientos de milisegundos por verificación). Ejecutado
+# en un endpoint async bloquea el event loop y, con él, todas las requests del worker
+# (incluidas las de los tótems). Aquí el trabajo va a un pool de hilos propio y
+# acotado: bcrypt libera el GIL, así que los hilos trabajan en paralelo sin frenar al
+# event loop. Si hay demasiadas operaciones pendientes se rechazan de inmediato
+# (PasswordHasherBusy -> 503) en lugar de dejar que la cola crezca sin límite.
+
+
+class PasswordHasherBusy(Exception):
+    """Hay demasiadas operaciones de hashing pendientes; reintentar más tarde."""
+
+
+class PasswordHasher:
+    def __init__(self, context: CryptContext, workers: int = 2, max_pending: int = 32):
+        self.context = context
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        self.completed_total = 0
+        self.rejected_total = 0
+        self.rehashed_total = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    # --- API pública ---
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """
+        Verifica la contraseña. Si es correcta pero el hash usa parámetros distintos a
+        los actuales del CryptContext (p. ej. otro número de rondas), devuelve también
+        el hash nuevo para guardarlo; si no, (valid, None).
+        """
+        valid, new_hash = await self._submit(self.context.verify_and_update, plain_password, hashed_password)
+        if new_hash is not None:
+            with self._lock:
+                self.rehashed_total += 1
+        return valid, new_hash
+
+    async def hash(self, plain_password: str) -> str:
+        return await self._submit(self.context.hash, plain_password)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "completed_total": self.completed_total,
+                "rejected_total": self.rejected_total,
+                "rehashed_total": self.rehashed_total,
+                "avg_seconds": round(self.seconds_total / self.completed_total, 4) if self.completed_total else 0.0,
+                "max_seconds": round(self.seconds_max, 4),
+            }
+
+    # --- Implementación ---
+
+    async def _submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected_total += 1
+                raise PasswordHasherBusy("Demasiadas operaciones de contraseña pendientes")
+            self._pending += 1
+        started = time.perf_counter()
+        future = self._executor.submit(fn, *args)
+        # El cupo se libera cuando el hilo termina, aunque la request se haya cancelado antes
+        future.add_done_callback(lambda done: self._release(done, started))
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future: Future, started: float):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._pending -= 1
+            if not future.cancelled():
+                self.completed_total += 1
+                self.seconds_total += elapsed
+                self.seconds_max = max(self.seconds_max, elapsed)
@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import crud
+import models
+from mp_client import MercadoPagoClient, MercadoPagoError, mp_client
+from shared_backend import JobLock, SharedBackend
+
+logger = logging.getLogger(__name__)
+
+# --- Backfill de Pagos desde Mercado Pago ---
+#
+# Red de seguridad para los webhooks: si una notificación se pierde, el pago nunca
+# llega a `payments`. Este proceso recorre, para cada vendedor conectado, la búsqueda
+# de pagos de Mercado Pago (/v1/payments/search con el token del vendedor) ordenada
+# por date_last_updated desde la marca de agua del vendedor, y guarda por lotes los
+# pagos nuevos o modificados con la misma lógica que el procesamiento de webhooks
+# (rollups y canal en vivo incluidos). Los vendedores se sincronizan en paralelo con
+# concurrencia acotada; la tasa total de llamadas la limita el cliente compartido.
+
+# Mercado Pago no permite paginar con offsets arbitrariamente grandes: al llegar a
+# este offset la búsqueda se reinicia desde el último date_last_updated visto.
+MAX_SEARCH_OFFSET = 1000
+JOB_LOCK_NAME = "job:payment_backfill"
+# Resultado de los vendedores que no se sincronizaron porque se perdió el lock
+STOPPED = object()
+
+
+class BackfillError(Exception):
+    """La búsqueda de pagos de un vendedor no pudo completarse."""
+
+
+def _mp_date(moment: datetime) -> str:
+    """Fecha UTC sin zona al formato que acepta la búsqueda de Mercado Pago."""
+    return moment.isoformat(timespec="milliseconds") + "Z"
+
+def _parse_mp_date(value: str) -> datetime:
+    """Fecha de Mercado Pago (con zona horaria) a UTC sin zona, como se guardan las marcas de agua."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def get_state(db: Session, seller_id: int) -> models.PaymentSyncState:
+    state = db.get(models.PaymentSyncState, seller_id)
+    if state is None:
+        state = models.PaymentSyncState(seller_id=seller_id, payments_seen=0, payments_changed=0)
+        db.add(state)
+        # Sin flush, un objeto pendiente no está en el identity map: la siguiente
+        # llamada (las sesiones no hacen autoflush) crearía otro y fallaría el INSERT
+        db.flush()
+    return state
+
+def save_page(db: Session, seller_id: int, results: list) -> int:
+    """Guarda una página de resultados de la búsqueda. Devuelve cuántos pagos cambiaron."""
+    external_pos_ids = {
+        reference.split("-")[1]
+        for reference in (payment.get("external_reference") or "" for payment in results)
+        if "-" in reference
+    }
+    totem_owners = crud.get_totem_owners(db, list(external_pos_ids))
+    values_list = [
+        crud.payment_values_from_mp(db, payment, default_seller_id=seller_id, totem_owners=totem_owners)
+        for payment in results
+    ]
+    changed = crud.upsert_payments(db, values_list)
+    for db_payment in changed:
+        crud.publish_payment(db_payment)
+    return len(changed)
+
+def sync_seller(
+    db: Session,
+    seller: models.Seller,
+    client: MercadoPagoClient,
+    since: datetime,
+    until: datetime,
+    page_size: int = 100,
+    keep_running: Optional[Callable[[], bool]] = None,
+) -> dict:
+    """
+    Recorre los pagos del vendedor con date_last_updated en [since, until] y guarda
+    los nuevos o modificados. La marca de agua avanza página a página, así que una
+    ejecución interrumpida (o detenida porque `keep_running` devolvió False) se
+    retoma donde quedó.
+    """
+    stats = {"pages": 0, "seen": 0, "changed": 0}
+    begin, offset = since, 0
+    while True:
+        params = {
+            "sort": "date_last_updated",
+            "criteria": "asc",
+            "range": "date_last_updated",
+            "begin_date": _mp_date(begin),
+            "end_date": _mp_date(until),
+            "offset": offset,
+            "limit": page_size,
+        }
+        result = client.search_payments(seller.mp_access_token, params)
+        if result["status"] != 200 or not isinstance(result["response"], dict):
+            raise BackfillError(f"La búsqueda de pagos devolvió HTTP {result['status']}")
+        results = result["response"].get("results") or []
+
+        changed = save_page(db, seller.id, results) if results else 0
+        stats["pages"] += 1
+        stats["seen"] += len(results)
+        stats["changed"] += changed
+
+        last_updated = _parse_mp_date(results[-1]["date_last_updated"]) if results else None
+        done = len(results) < page_size
+        state = get_state(db, seller.id)
+        state.synced_until = until if done else max(last_updated, state.synced_until or last_updated)
+        state.payments_seen = (state.payments_seen or 0) + len(results)
+        state.payments_changed = (state.payments_changed or 0) + changed
+        db.commit()
+        if done or (keep_running is not None and not keep_running()):
+            return stats
+
+        offset += page_size
+        if offset >= MAX_SEARCH_OFFSET and last_updated > begin:
+            # Los pagos con la misma fecha que el último se vuelven a leer: el upsert es idempotente
+            begin, offset = last_updated, 0
+
+def sync_summary(db: Session) -> dict:
+    row = db.query(
+        func.count(models.PaymentSyncState.seller_id),
+        func.min(models.PaymentSyncState.synced_until),
+        func.count(models.PaymentSyncState.last_error),
+    ).one()
+    return {"sellers": row[0], "oldest_synced_until": row[1], "sellers_with_errors": row[2]}
+
+
+class PaymentBackfill:
+    """
+    Tarea en segundo plano que sincroniza los pagos de todos los vendedores cada
+    `interval_seconds`. Las llamadas a Mercado Pago y a la base de datos son
+    bloqueantes, así que cada vendedor se procesa en un hilo, con a lo sumo
+    `concurrency` vendedores a la vez. Con `backend`, cada ejecución toma un lock
+    compartido para que sólo un worker consulte Mercado Pago a la vez.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        interval_seconds: float = 900.0,
+        concurrency: int = 8,
+        page_size: int = 100,
+        initial_days: float = 30.0,
+        overlap_minutes: float = 10.0,
+        client: Optional[MercadoPagoClient] = None,
+        backend: Optional[SharedBackend] = None,
+        lock_ttl_seconds: float = 900.0,
+    ):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.initial_days = initial_days
+        # Se relee un margen antes de la marca de agua: la búsqueda de MP no es
+        # instantáneamente consistente y un pago puede indexarse con algo de retraso
+        self.overlap = timedelta(minutes=overlap_minutes)
+        self.client = client or mp_client
+        self.backend = backend
+        self.lock_ttl_seconds = lock_ttl_seconds
+
+        self._task: Optional[asyncio.Task] = None
+        self._run_lock: Optional[asyncio.Lock] = None
+        self._in_flight = 0
+
+        self.totals = {"sellers": 0, "pages": 0, "seen": 0, "changed": 0}
+        self.runs_total = 0
+        self.failures_total = 0
+        self.skipped_total = 0 # Ejecuciones omitidas porque otro worker tenía el lock
+        self.last_run_at: Optional[datetime] = None
+        self.last_run_seconds = 0.0
+        self.last_run: Optional[dict] = None
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def is_syncing(self) -> bool:
+        return self._run_lock is not None and self._run_lock.locked()
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._run_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Backfill de pagos de Mercado Pago iniciado.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        logger.info("Backfill de pagos de Mercado Pago detenido.")
+
+    # --- API pública ---
+
+    def status(self) -> dict:
+        db = self.session_factory()
+        try:
+            summary = sync_summary(db)
+        finally:
+            db.close()
+        return {
+            "running": self.is_running,
+            "syncing": self.is_syncing,
+            "in_flight": self._in_flight,
+            "state": summary,
+            "totals": dict(self.totals),
+            "runs_total": self.runs_total,
+            "failures_total": self.failures_total,
+            "skipped_total": self.skipped_total,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": round(self.last_run_seconds, 3),
+            "last_run": self.last_run,
+        }
+
+    async def run_all(self, since: Optional[datetime] = None) -> Optional[dict]:
+        """
+        Sincroniza todos los vendedores conectados. Con `since`, ignora las marcas de
+        agua y relee desde esa fecha (re-sincronización completa). Devuelve None si
+        otro worker tenía el lock de la sincronización.
+        """
+        if self._run_lock is None:
+            self._run_lock = asyncio.Lock()
+        async with self._run_lock:
+            job_lock = JobLock(self.backend, JOB_LOCK_NAME, self.lock_ttl_seconds)
+            if not await asyncio.to_thread(job_lock.acquire):
+                self.skipped_total += 1
+                return None
+            try:
+                return await self._sync_all(since, job_lock)
+            finally:
+                await asyncio.to_thread(job_lock.release)
+
+    def request_run(self, since: Optional[datetime] = None) -> bool:
+        """Lanza una sincronización sin esperarla. Devuelve False si ya hay una en curso."""
+        if self.is_syncing:
+            return False
+        task = asyncio.create_task(self.run_all(since))
+        task.add_done_callback(self._log_failure)
+        return True
+
+    def sync_one(self, seller_id: int, since: Optional[datetime] = None,
+                 keep_running: Optional[Callable[[], bool]] = None) -> Optional[dict]:
+        """
+        Sincroniza un vendedor. Devuelve sus contadores, o None si falló. Con
+        `keep_running`, se detiene tras la página en que devuelva False.
+        """
+        db = self.session_factory()
+        try:
+            seller = crud.get_seller(db, seller_id=seller_id)
+            if not seller or not seller.mp_access_token:
+                return None
+            state = get_state(db, seller_id)
+            until = _utcnow()
+            if since is None:
+                since = state.synced_until - self.overlap if state.synced_until else until - timedelta(days=self.initial_days)
+            try:
+                stats = sync_seller(db, seller, self.client, since=since, until=until, page_size=self.page_size,
+                                    keep_running=keep_running)
+                error = None
+            except (MercadoPagoError, BackfillError) as e:
+                db.rollback()
+                logger.warning(f"Backfill de pagos del vendedor {seller_id} incompleto: {e}")
+                stats, error = None, str(e)[:255]
+            state = get_state(db, seller_id)
+            state.last_run_at = until
+            state.last_error = error
+            db.commit()
+            return stats
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error en el backfill de pagos del vendedor {seller_id}: {e}")
+            return None
+        finally:
+            db.close()
+
+    # --- Implementación ---
+
+    async def _sync_all(self, since: Optional[datetime], job_lock: JobLock) -> dict:
+        started = time.monotonic()
+        seller_ids = await asyncio.to_thread(self._load_seller_ids)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def sync_one(seller_id: int) -> Optional[dict]:
+            async with semaphore:
+                # Si se perdió el lock, otro worker sigue con la sincronización
+                if job_lock.lost or not await asyncio.to_thread(job_lock.keep):
+                    return STOPPED
+                self._in_flight += 1
+                try:
+                    return await asyncio.to_thread(self.sync_one, seller_id, since, job_lock.keep)
+                finally:
+                    self._in_flight -= 1
+
+        results = await asyncio.gather(*(sync_one(seller_id) for seller_id in seller_ids))
+        run = {"sellers": len(seller_ids), "failed": 0, "pages": 0, "seen": 0, "changed": 0,
+               "stopped": job_lock.lost}
+        for stats in results:
+            if stats is STOPPED:
+                run["sellers"] -= 1
+                continue
+            if stats is None:
+                run["failed"] += 1
+                continue
+            for key in ("pages", "seen", "changed"):
+                run[key] += stats[key]
+        for key in self.totals:
+            self.totals[key] += run[key]
+        self.failures_total += run["failed"]
+        self.runs_total += 1
+        self.last_run_at = datetime.now(timezone.utc)
+        self.last_run_seconds = time.monotonic() - started
+        self.last_run = run
+        return run
+
+    def _load_seller_ids(self):
+        db = self.session_factory()
+        try:
+            return [seller_id for seller_id, _ in crud.get_sellers_with_mp_tokens(db)]
+        finally:
+            db.close()
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error en el backfill de pagos: {task.exception()}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en el backfill de pagos: {e}")
+            await asyncio.sleep(self.interval_seconds)
@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select, func, delete, insert
+from sqlalchemy.orm import Session
+
+import models
+import parking_analytics
+from shared_backend import JobLock, SharedBackend
+
+logger = logging.getLogger(__name__)
+
+# --- Conciliación de Salidas y Pagos ---
+#
+# Empareja cada salida registrada por los tótems con el pago aprobado del mismo
+# `ticket_code` hecho poco antes (o, por desfase de relojes, poco después). Cada
+# pasada lee sólo los eventos y pagos posteriores a sus marcas de agua, carga de
+# `payment_reconciliations` únicamente las filas sin emparejar de los tickets del
+# lote (hash join por ticket) y dentro de cada ticket recorre salidas y pagos
+# ordenados por tiempo (merge con ventana). Así nunca se hace un JOIN entre
+# `parking_events` y `payments` completos. Los pagos aún no aprobados quedan como
+# 'pending' y se revisan en cada pasada hasta que se aprueban. Como en la analítica,
+# las marcas de agua sólo pasan filas con más de `settle_seconds` de antigüedad (ver
+# parking_analytics.settled_prefix): los ids pueden confirmarse fuera de orden.
+
+EXITS_WATERMARK = "reconciliation_exits"
+PAYMENTS_WATERMARK = "reconciliation_payments"
+JOB_LOCK_NAME = "job:payment_reconciliation"
+APPROVED_STATUS = "approved"
+MATCHED, UNMATCHED, PENDING = "matched", "unmatched", "pending"
+QUERY_CHUNK_SIZE = 500
+
+def _chunks(values: list, size: int = QUERY_CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _row(ticket_code: str, status: str, exit_: Optional[tuple] = None, payment: Optional[tuple] = None,
+         matched_at: Optional[datetime] = None) -> dict:
+    """exit_ = (exit_time, event_id, device_id); payment = (payment_time, payment_id)."""
+    return {
+        "ticket_code": ticket_code,
+        "status": status,
+        "exit_time": exit_[0] if exit_ else None,
+        "exit_event_id": exit_[1] if exit_ else None,
+        "device_id": exit_[2] if exit_ else None,
+        "payment_time": payment[0] if payment else None,
+        "payment_id": payment[1] if payment else None,
+        "reference_time": exit_[0] if exit_ else payment[0],
+        "matched_at": matched_at,
+    }
+
+def match_ticket(exits: List[tuple], payments: List[tuple], before: timedelta, after: timedelta) -> tuple:
+    """
+    Empareja salidas y pagos de un mismo ticket, ambos ordenados por tiempo. A cada
+    salida le corresponde el pago libre más antiguo dentro de [salida - before,
+    salida + after]. Devuelve (pares, salidas_sin_pago, pagos_sin_salida).
+    """
+    pairs, lonely_exits, lonely_payments = [], [], []
+    position = 0
+    for exit_ in exits:
+        while position < len(payments) and payments[position][0] < exit_[0] - before:
+            lonely_payments.append(payments[position])
+            position += 1
+        if position < len(payments) and payments[position][0] <= exit_[0] + after:
+            pairs.append((exit_, payments[position]))
+            position += 1
+        else:
+            lonely_exits.append(exit_)
+    lonely_payments.extend(payments[position:])
+    return pairs, lonely_exits, lonely_payments
+
+def _load_unmatched(db: Session, ticket_codes: List[str]) -> List[models.PaymentReconciliation]:
+    rows = []
+    for chunk in _chunks(ticket_codes):
+        rows += db.query(models.PaymentReconciliation).filter(
+            models.PaymentReconciliation.ticket_code.in_(chunk),
+            models.PaymentReconciliation.status == UNMATCHED,
+        ).all()
+    return rows
+
+def process_batch(db: Session, batch_size: int = 5000, before: timedelta = timedelta(hours=1),
+                  after: timedelta = timedelta(minutes=10), settle_seconds: float = 0.0) -> dict:
+    """
+    Concilia hasta `batch_size` eventos y `batch_size` pagos nuevos, además de los
+    pagos 'pending' que ya se aprobaron. Devuelve los eventos y pagos leídos y los
+    pares formados (todos en 0 si otro proceso tomó el mismo lote).
+    """
+    exits_previous = parking_analytics.get_watermark(db, EXITS_WATERMARK)
+    payments_previous = parking_analytics.get_watermark(db, PAYMENTS_WATERMARK)
+    cutoff = parking_analytics.settle_cutoff(db, settle_seconds)
+    events = parking_analytics.settled_prefix(db.execute(
+        select(models.ParkingEvent.id, models.ParkingEvent.ticket_code, models.ParkingEvent.device_id,
+               models.ParkingEvent.event_type, models.ParkingEvent.event_time, models.ParkingEvent.created_at)
+        .where(models.ParkingEvent.id > exits_previous)
+        .order_by(models.ParkingEvent.id)
+        .limit(batch_size)
+    ).all(), cutoff)
+    payments = parking_analytics.settled_prefix(db.execute(
+        select(models.Payment.id, models.Payment.ticket_code, models.Payment.status, models.Payment.payment_time,
+               models.Payment.created_at)
+        .where(models.Payment.id > payments_previous)
+        .order_by(models.Payment.id)
+        .limit(batch_size)
+    ).all(), cutoff)
+    approved_pending = db.execute(
+        select(models.PaymentReconciliation.id, models.Payment.id, models.Payment.ticket_code, models.Payment.payment_time)
+        .join(models.Payment, models.Payment.id == models.PaymentReconciliation.payment_id)
+        .where(models.PaymentReconciliation.status == PENDING, models.Payment.status == APPROVED_STATUS)
+        .limit(batch_size)
+    ).all()
+    stats = {"events": len(events), "payments": len(payments), "matched": 0}
+    if not events and not payments and not approved_pending:
+        return stats
+
+    # Hash por ticket de las salidas y pagos aprobados nuevos
+    exits_by_ticket: Dict[str, List[tuple]] = {}
+    payments_by_ticket: Dict[str, List[tuple]] = {}
+    for event_id, ticket_code, device_id, event_type, event_time, _ in events:
+        if ticket_code and parking_analytics.normalize_event_type(event_type) == parking_analytics.EXIT:
+            exits_by_ticket.setdefault(ticket_code, []).append((event_time, event_id, device_id))
+    new_rows = []
+    for payment_id, ticket_code, payment_status, payment_time, _ in payments:
+        if not ticket_code:
+            continue
+        if payment_status == APPROVED_STATUS:
+            payments_by_ticket.setdefault(ticket_code, []).append((payment_time, payment_id))
+        else:
+            new_rows.append(_row(ticket_code, PENDING, payment=(payment_time, payment_id)))
+    for _, payment_id, ticket_code, payment_time in approved_pending:
+        payments_by_ticket.setdefault(ticket_code, []).append((payment_time, payment_id))
+
+    # Filas sin emparejar de pasadas anteriores, sólo de los tickets del lote
+    tickets = sorted(set(exits_by_ticket) | set(payments_by_ticket))
+    previous_rows = _load_unmatched(db, tickets)
+    for row in previous_rows:
+        if row.exit_event_id is not None:
+            exits_by_ticket.setdefault(row.ticket_code, []).append((row.exit_time, row.exit_event_id, row.device_id))
+        else:
+            payments_by_ticket.setdefault(row.ticket_code, []).append((row.payment_time, row.payment_id))
+
+    now = datetime.utcnow()
+    for ticket_code in tickets:
+        pairs, lonely_exits, lonely_payments = match_ticket(
+            sorted(exits_by_ticket.get(ticket_code, [])), sorted(payments_by_ticket.get(ticket_code, [])), before, after
+        )
+        new_rows += [_row(ticket_code, MATCHED, exit_, payment, matched_at=now) for exit_, payment in pairs]
+        new_rows += [_row(ticket_code, UNMATCHED, exit_=exit_) for exit_ in lonely_exits]
+        new_rows += [_row(ticket_code, UNMATCHED, payment=payment) for payment in lonely_payments]
+        stats["matched"] += len(pairs)
+
+    # Las filas previas se reemplazan por el resultado del nuevo emparejamiento
+    replaced = [row.id for row in previous_rows] + [row_id for row_id, _, _, _ in approved_pending]
+    for chunk in _chunks(replaced):
+        db.execute(delete(models.PaymentReconciliation).where(models.PaymentReconciliation.id.in_(chunk)))
+    for chunk in _chunks(new_rows):
+        db.execute(insert(models.PaymentReconciliation), chunk)
+
+    advanced = True
+    if events:
+        advanced = parking_analytics.advance_watermark(db, exits_previous, events[-1][0], name=EXITS_WATERMARK)
+    if advanced and payments:
+        advanced = parking_analytics.advance_watermark(db, payments_previous, payments[-1][0], name=PAYMENTS_WATERMARK)
+    if not advanced:
+        db.rollback()
+        return {key: 0 for key in stats}
+    db.commit()
+    return stats
+
+# --- Consultas ---
+
+def count_by_status(db: Session) -> dict:
+    reconciliation = models.PaymentReconciliation
+    kind = func.coalesce(reconciliation.exit_event_id, 0) > 0
+    rows = db.execute(
+        select(reconciliation.status, kind, func.count(reconciliation.id)).group_by(reconciliation.status, kind)
+    ).all()
+    counts = {"matched": 0, "exits_without_payment": 0, "payments_without_exit": 0, "pending_payments": 0}
+    for row_status, has_exit, count in rows:
+        if row_status == MATCHED:
+            counts["matched"] += count
+        elif row_status == PENDING:
+            counts["pending_payments"] += count
+        elif has_exit:
+            counts["exits_without_payment"] += count
+        else:
+            counts["payments_without_exit"] += count
+    return counts
+
+def backlog(db: Session) -> dict:
+    """Eventos y pagos aún no procesados por la conciliación."""
+    exits_watermark = parking_analytics.get_watermark(db, EXITS_WATERMARK)
+    payments_watermark = parking_analytics.get_watermark(db, PAYMENTS_WATERMARK)
+    return {
+        "events": db.execute(select(func.count(models.ParkingEvent.id)).where(models.ParkingEvent.id > exits_watermark)).scalar(),
+        "payments": db.execute(select(func.count(models.Payment.id)).where(models.Payment.id > payments_watermark)).scalar(),
+        "last_event_id": exits_watermark,
+        "last_payment_id": payments_watermark,
+    }
+
+def get_unmatched(db: Session, kind: str, older_than: datetime, skip: int = 0, limit: int = 100):
+    """
+    Salidas sin pago (kind='exit') o pagos sin salida (kind='payment') cuya hora de
+    referencia es anterior a `older_than`, es decir, que ya no esperan a la otra mitad.
+    """
+    reconciliation = models.PaymentReconciliation
+    side = reconciliation.exit_event_id.isnot(None) if kind == "exit" else reconciliation.exit_event_id.is_(None)
+    return db.query(reconciliation).filter(
+        reconciliation.status == UNMATCHED,
+        reconciliation.reference_time < older_than,
+        side,
+    ).order_by(reconciliation.reference_time.desc()).offset(skip).limit(limit).all()
+
+def reset(db: Session):
+    """Borra el estado de conciliación para recalcularlo desde cero."""
+    db.execute(delete(models.PaymentReconciliation))
+    db.execute(delete(models.AnalyticsWatermark).where(
+        models.AnalyticsWatermark.name.in_([EXITS_WATERMARK, PAYMENTS_WATERMARK])
+    ))
+    db.commit()
+
+
+class PaymentReconciler:
+    """
+    Tarea en segundo plano que concilia los datos nuevos cada `interval_seconds`.
+    Lleva contadores de progreso y de rendimiento (filas por segundo).
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        interval_seconds: float = 60.0,
+        batch_size: int = 5000,
+        window_before_minutes: float = 60.0,
+        window_after_minutes: float = 10.0,
+        settle_seconds: float = 10.0,
+        backend: Optional[SharedBackend] = None,
+        lock_ttl_seconds: float = 900.0,
+    ):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.before = timedelta(minutes=window_before_minutes)
+        self.after = timedelta(minutes=window_after_minutes)
+        self.settle_seconds = settle_seconds
+        # Con backend, cada ejecución toma un lock compartido: sólo concilia un worker a la vez
+        self.backend = backend
+        self.lock_ttl_seconds = lock_ttl_seconds
+
+        self._task: Optional[asyncio.Task] = None
+
+        self.totals = {"events": 0, "payments": 0, "matched": 0}
+        self.runs_total = 0
+        self.failures_total = 0
+        self.skipped_total = 0 # Ejecuciones omitidas porque otro worker tenía el lock
+        self.last_run_at: Optional[datetime] = None
+        self.last_run_seconds = 0.0
+        self.last_rows_per_second = 0.0
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("Conciliación de pagos iniciada.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        logger.info("Conciliación de pagos detenida.")
+
+    # --- API pública ---
+
+    def status(self) -> dict:
+        db = self.session_factory()
+        try:
+            counts = count_by_status(db)
+            pending = backlog(db)
+        finally:
+            db.close()
+        return {
+            "running": self.is_running,
+            "state": counts,
+            "backlog": pending,
+            "totals": dict(self.totals),
+            "runs_total": self.runs_total,
+            "failures_total": self.failures_total,
+            "skipped_total": self.skipped_total,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": round(self.last_run_seconds, 3),
+            "last_rows_per_second": round(self.last_rows_per_second, 1),
+        }
+
+    def run_pending(self) -> dict:
+        """Concilia lotes hasta ponerse al día. Devuelve los contadores de la ejecución."""
+        run = {key: 0 for key in self.totals}
+        job_lock = JobLock(self.backend, JOB_LOCK_NAME, self.lock_ttl_seconds)
+        if not job_lock.acquire():
+            self.skipped_total += 1
+            return run
+        started = time.monotonic()
+        db = self.session_factory()
+        try:
+            # Entre lotes se renueva el lock; si se perdió, otro worker sigue desde las marcas de agua
+            while job_lock.keep():
+                stats = process_batch(db, batch_size=self.batch_size, before=self.before, after=self.after,
+                                      settle_seconds=self.settle_seconds)
+                for key, value in stats.items():
+                    run[key] += value
+                    self.totals[key] += value
+                if stats["events"] < self.batch_size and stats["payments"] < self.batch_size:
+                    break
+        finally:
+            db.close()
+            job_lock.release()
+        self.runs_total += 1
+        self.last_run_at = datetime.now(timezone.utc)
+        self.last_run_seconds = time.monotonic() - started
+        if self.last_run_seconds > 0:
+            self.last_rows_per_second = (run["events"] + run["payments"]) / self.last_run_seconds
+        return run
+
+    # --- Implementación ---
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_pending)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures_total += 1
+                logger.error(f"Error en la conciliación de pagos: {e}")
+            await asyncio.sleep(self.interval_seconds)
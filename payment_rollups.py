@@ -0,0 +1,274 @@
+from sqlalchemy import select, func, delete, update, insert
+from sqlalchemy.dialects import sqlite, postgresql, mysql
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+import archive_tables
+import models
+
+# --- Rollups de Recaudación ---
+#
+# Para responder totales por rango (ej. recaudación del mes) sin recorrer la tabla de
+# pagos, se mantienen acumulados por vendedor, tótem y bucket (hora y día) en la tabla
+# `payment_rollups`. Las altas de pagos aprobados se suman de forma incremental con un
+# upsert; si un pago deja de estar aprobado (ej. reembolso), los buckets afectados se
+# recalculan desde `payments`, ya que el mínimo/máximo no pueden "restarse".
+#
+# Los rollups no se borran al archivar pagos (data_retention.py): los tramos parciales
+# y la reconstrucción leen también las tablas de archivo. El recálculo por cambio de
+# estado sólo mira `payments`, porque un pago sólo se archiva cuando ya no cambia.
+
+APPROVED_STATUS = "approved"
+GRANULARITIES = ("hour", "day")
+
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _bucket_end(start: datetime, granularity: str) -> datetime:
+    return start + (timedelta(hours=1) if granularity == "hour" else timedelta(days=1))
+
+def _ceil(moment: datetime, granularity: str) -> datetime:
+    start = bucket_start(moment, granularity)
+    return start if start == moment else _bucket_end(start, granularity)
+
+def _contribution(payment: models.Payment) -> Optional[tuple]:
+    """Clave (seller_id, external_pos_id, payment_time, amount) si el pago suma en los rollups."""
+    if payment.status != APPROVED_STATUS or payment.seller_id is None or payment.payment_time is None:
+        return None
+    return (payment.seller_id, payment.external_pos_id or "", payment.payment_time, float(payment.amount))
+
+def snapshot(payment: Optional[models.Payment]) -> Optional[tuple]:
+    """Contribución actual de un pago, para compararla tras modificarlo."""
+    return _contribution(payment) if payment is not None else None
+
+def _upsert_rollup(db: Session, values: dict):
+    table = models.PaymentRollup.__table__
+    dialect = db.get_bind().dialect.name
+    key = ["granularity", "seller_id", "external_pos_id", "bucket_start"]
+    if dialect in ("sqlite", "postgresql"):
+        statement = (sqlite if dialect == "sqlite" else postgresql).insert(table).values(**values)
+        least, greatest = (func.min, func.max) if dialect == "sqlite" else (func.least, func.greatest)
+        statement = statement.on_conflict_do_update(index_elements=key, set_={
+            "payment_count": table.c.payment_count + statement.excluded.payment_count,
+            "total_amount": table.c.total_amount + statement.excluded.total_amount,
+            "min_amount": least(table.c.min_amount, statement.excluded.min_amount),
+            "max_amount": greatest(table.c.max_amount, statement.excluded.max_amount),
+        })
+        db.execute(statement)
+        return
+    if dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(table).values(**values)
+        statement = statement.on_duplicate_key_update(
+            payment_count=table.c.payment_count + statement.inserted.payment_count,
+            total_amount=table.c.total_amount + statement.inserted.total_amount,
+            min_amount=func.least(table.c.min_amount, statement.inserted.min_amount),
+            max_amount=func.greatest(table.c.max_amount, statement.inserted.max_amount),
+        )
+        db.execute(statement)
+        return
+    # Otros motores: lectura + escritura dentro de la transacción en curso
+    conditions = [table.c[column] == values[column] for column in key]
+    existing = db.execute(select(table).where(*conditions)).first()
+    if existing is None:
+        db.execute(insert(table).values(**values))
+    else:
+        db.execute(update(table).where(*conditions).values(
+            payment_count=existing.payment_count + values["payment_count"],
+            total_amount=existing.total_amount + values["total_amount"],
+            min_amount=min(existing.min_amount, values["min_amount"]),
+            max_amount=max(existing.max_amount, values["max_amount"]),
+        ))
+
+def _add(db: Session, contribution: tuple, granularity: str):
+    seller_id, external_pos_id, payment_time, amount = contribution
+    _upsert_rollup(db, {
+        "granularity": granularity,
+        "seller_id": seller_id,
+        "external_pos_id": external_pos_id,
+        "bucket_start": bucket_start(payment_time, granularity),
+        "payment_count": 1,
+        "total_amount": amount,
+        "min_amount": amount,
+        "max_amount": amount,
+    })
+
+def _recompute(db: Session, seller_id: int, external_pos_id: str, payment_time: datetime, granularity: str):
+    """Recalcula desde `payments` el bucket de `granularity` que contiene `payment_time`."""
+    db.flush()
+    pos_condition = models.Payment.external_pos_id == external_pos_id if external_pos_id else \
+        func.coalesce(models.Payment.external_pos_id, "") == ""
+    start = bucket_start(payment_time, granularity)
+    count, total, minimum, maximum = db.execute(
+        select(func.count(models.Payment.id), func.sum(models.Payment.amount),
+               func.min(models.Payment.amount), func.max(models.Payment.amount))
+        .where(
+            models.Payment.seller_id == seller_id,
+            pos_condition,
+            models.Payment.status == APPROVED_STATUS,
+            models.Payment.payment_time >= start,
+            models.Payment.payment_time < _bucket_end(start, granularity),
+        )
+    ).one()
+    key = [
+        models.PaymentRollup.granularity == granularity,
+        models.PaymentRollup.seller_id == seller_id,
+        models.PaymentRollup.external_pos_id == external_pos_id,
+        models.PaymentRollup.bucket_start == start,
+    ]
+    if not count:
+        db.execute(delete(models.PaymentRollup).where(*key))
+        return
+    result = db.execute(update(models.PaymentRollup).where(*key).values(
+        payment_count=count, total_amount=total, min_amount=minimum, max_amount=maximum
+    ))
+    if not result.rowcount:
+        db.execute(insert(models.PaymentRollup).values(
+            granularity=granularity, seller_id=seller_id, external_pos_id=external_pos_id, bucket_start=start,
+            payment_count=count, total_amount=total, min_amount=minimum, max_amount=maximum
+        ))
+
+def apply_payment_change(db: Session, before: Optional[tuple], payment: models.Payment):
+    """
+    Actualiza los rollups tras crear o modificar un pago, dentro de la misma transacción.
+    `before` es el snapshot() del pago previo al cambio (None si es nuevo).
+    """
+    after = _contribution(payment)
+    if before == after:
+        return
+    for granularity in GRANULARITIES:
+        if before is None:
+            _add(db, after, granularity)
+            continue
+        # El pago dejó de contar o cambió de importe/bucket: recalculamos el bucket
+        # donde contaba (el recálculo ya incluye el estado nuevo si sigue ahí)
+        _recompute(db, before[0], before[1], before[2], granularity)
+        if after is not None and (after[0], after[1], bucket_start(after[2], granularity)) != \
+                (before[0], before[1], bucket_start(before[2], granularity)):
+            _add(db, after, granularity)
+
+# --- Consultas ---
+
+def _rollup_pieces(db: Session, seller_id: int, granularity: str, start: datetime, end: datetime) -> Iterable[tuple]:
+    if start >= end:
+        return []
+    rows = db.execute(
+        select(models.PaymentRollup.bucket_start, models.PaymentRollup.external_pos_id,
+               models.PaymentRollup.payment_count, models.PaymentRollup.total_amount,
+               models.PaymentRollup.min_amount, models.PaymentRollup.max_amount)
+        .where(
+            models.PaymentRollup.seller_id == seller_id,
+            models.PaymentRollup.granularity == granularity,
+            models.PaymentRollup.bucket_start >= start,
+            models.PaymentRollup.bucket_start < end,
+        )
+    ).all()
+    return [tuple(row) for row in rows]
+
+def _raw_pieces(db: Session, seller_id: int, start: datetime, end: datetime) -> Iterable[tuple]:
+    """Agrega directamente desde `payments` (y su archivo) un tramo que está dentro de una única hora."""
+    if start >= end:
+        return []
+    bucket = bucket_start(start, "hour")
+    pieces = []
+    for table in archive_tables.tables_for_range(db, "payments", start, end) + [models.Payment.__table__]:
+        pos = func.coalesce(table.c.external_pos_id, "")
+        rows = db.execute(
+            select(pos, func.count(table.c.id), func.sum(table.c.amount), func.min(table.c.amount), func.max(table.c.amount))
+            .where(
+                table.c.seller_id == seller_id,
+                table.c.status == APPROVED_STATUS,
+                table.c.payment_time >= start,
+                table.c.payment_time < end,
+            )
+            .group_by(pos)
+        ).all()
+        pieces += [(bucket, pos, count, total, minimum, maximum) for pos, count, total, minimum, maximum in rows]
+    return pieces
+
+def summarize(db: Session, seller_id: int, start: datetime, end: datetime, granularity: str = "day") -> dict:
+    """
+    Resume los pagos aprobados de un vendedor en [start, end). Los días y horas
+    completos salen de los rollups; sólo los tramos parciales de los extremos se
+    agregan desde `payments`.
+    """
+    pieces = []
+    first_hour, last_hour = _ceil(start, "hour"), bucket_start(end, "hour")
+    if first_hour >= last_hour:
+        pieces += _raw_pieces(db, seller_id, start, end)
+    else:
+        first_day, last_day = _ceil(first_hour, "day"), bucket_start(last_hour, "day")
+        if first_day < last_day:
+            pieces += _rollup_pieces(db, seller_id, "day", first_day, last_day)
+            pieces += _rollup_pieces(db, seller_id, "hour", first_hour, first_day)
+            pieces += _rollup_pieces(db, seller_id, "hour", last_day, last_hour)
+        else:
+            pieces += _rollup_pieces(db, seller_id, "hour", first_hour, last_hour)
+        pieces += _raw_pieces(db, seller_id, start, first_hour)
+        pieces += _raw_pieces(db, seller_id, last_hour, end)
+
+    def empty():
+        return {"count": 0, "total_amount": 0.0, "min_amount": None, "max_amount": None}
+
+    def merge(target, count, total, minimum, maximum):
+        target["count"] += count
+        target["total_amount"] += total or 0.0
+        if minimum is not None:
+            target["min_amount"] = minimum if target["min_amount"] is None else min(target["min_amount"], minimum)
+        if maximum is not None:
+            target["max_amount"] = maximum if target["max_amount"] is None else max(target["max_amount"], maximum)
+
+    totals, by_totem, series = empty(), {}, {}
+    for bucket, pos, count, total, minimum, maximum in pieces:
+        merge(totals, count, total, minimum, maximum)
+        merge(by_totem.setdefault(pos, empty()), count, total, minimum, maximum)
+        merge(series.setdefault(bucket_start(bucket, granularity), empty()), count, total, minimum, maximum)
+
+    return {
+        "start_date": start,
+        "end_date": end,
+        "granularity": granularity,
+        **totals,
+        "by_totem": [{"external_pos_id": pos or None, **values} for pos, values in sorted(by_totem.items())],
+        "series": [{"bucket_start": bucket, **values} for bucket, values in sorted(series.items())],
+    }
+
+# --- Reconstrucción ---
+
+def rebuild(db: Session, batch_size: int = 1000) -> int:
+    """
+    Recalcula todos los rollups desde `payments` y sus tablas de archivo (ej. tras
+    desplegar esta tabla sobre datos existentes). Devuelve el número de buckets escritos.
+    """
+    buckets = {}
+    queries = [
+        select(table.c.seller_id, table.c.external_pos_id, table.c.payment_time, table.c.amount)
+        .where(table.c.status == APPROVED_STATUS, table.c.seller_id.isnot(None))
+        .execution_options(yield_per=batch_size)
+        for table in archive_tables.tables_for_range(db, "payments") + [models.Payment.__table__]
+    ]
+    rows = (row for query in queries for row in db.execute(query))
+    for seller_id, external_pos_id, payment_time, amount in rows:
+        for granularity in GRANULARITIES:
+            key = (granularity, seller_id, external_pos_id or "", bucket_start(payment_time, granularity))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, amount, amount, amount]
+            else:
+                bucket[0] += 1
+                bucket[1] += amount
+                bucket[2] = min(bucket[2], amount)
+                bucket[3] = max(bucket[3], amount)
+
+    db.execute(delete(models.PaymentRollup))
+    rows = [
+        {"granularity": granularity, "seller_id": seller_id, "external_pos_id": pos, "bucket_start": start,
+         "payment_count": count, "total_amount": total, "min_amount": minimum, "max_amount": maximum}
+        for (granularity, seller_id, pos, start), (count, total, minimum, maximum) in buckets.items()
+    ]
+    for offset in range(0, len(rows), batch_size):
+        db.execute(insert(models.PaymentRollup), rows[offset:offset + batch_size])
+    db.commit()
+    return len(rows)
@@ -0,0 +1,369 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import event
+
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Métricas por Request ---
+#
+# Un middleware ASGI mide cada request y deja en un ContextVar los acumuladores de esa
+# request; los listeners de SQLAlchemy y el cliente de Mercado Pago suman ahí las
+# consultas y las llamadas salientes que se hacen mientras se atiende. El ContextVar
+# llega también a los endpoints síncronos, porque el threadpool de Starlette copia el
+# contexto al hilo. Todo se expone en formato de texto de Prometheus (GET /metrics) y
+# las requests lentas se registran en el log con el desglose de sus consultas.
+#
+# En modo de depuración de consultas (QUERY_DEBUG) cada respuesta lleva la cabecera
+# X-DB-Queries y se avisa en el log cuando una request repite la misma sentencia
+# (mismo SQL con otros parámetros) muchas veces, el patrón típico de un N+1 por carga
+# perezosa de relaciones. count_queries() y query_budget() permiten además medir y
+# acotar las consultas de un bloque de código desde pruebas o scripts, y
+# capture_requests() y request_query_budget() las de cada request que atiende la app
+# (también con TestClient, que la ejecuta en otro hilo y otro contexto).
+
+# Límites de los histogramas
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Longitud máxima del SQL que se muestra en el log de requests lentas
+STATEMENT_PREVIEW_CHARS = 160
+
+
+class RequestStats:
+    """Acumuladores de una request: consultas a la BD y llamadas a Mercado Pago."""
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.mp_calls = 0
+        self.mp_seconds = 0.0
+        # SQL -> [ejecuciones, segundos]; agrupar por sentencia deja ver los N+1
+        self.statements: Dict[str, List[float]] = {}
+
+    def record_query(self, statement: str, seconds: float):
+        self.db_queries += 1
+        self.db_seconds += seconds
+        entry = self.statements.setdefault(statement, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """Sentencias ejecutadas al menos `threshold` veces, de la más repetida a la menos."""
+        repeated = [(statement, int(count)) for statement, (count, _) in self.statements.items() if count >= threshold]
+        return [(" ".join(statement.split())[:STATEMENT_PREVIEW_CHARS], count)
+                for statement, count in sorted(repeated, key=lambda item: item[1], reverse=True)]
+
+    def top_statements(self, limit: int = 5) -> List[Tuple[str, int, float]]:
+        ranked = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [(" ".join(statement.split())[:STATEMENT_PREVIEW_CHARS], int(count), seconds)
+                for statement, (count, seconds) in ranked]
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+def record_outbound(seconds: float):
+    """Suma una llamada a Mercado Pago a la request en curso (si la hay)."""
+    stats = current_request.get()
+    if stats is not None:
+        stats.mp_calls += 1
+        stats.mp_seconds += seconds
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Un bloque ejecutó más consultas de las permitidas por query_budget()."""
+
+
+@contextmanager
+def count_queries():
+    """
+    Cuenta las consultas ejecutadas dentro del bloque (en este contexto). Dentro de
+    una request, esas consultas dejan de sumarse a la request. No ve las consultas de
+    las requests hechas con TestClient: para eso, capture_requests().
+    """
+    stats = RequestStats()
+    token = current_request.set(stats)
+    try:
+        yield stats
+    finally:
+        current_request.reset(token)
+
+@contextmanager
+def query_budget(max_queries: int, max_repeats: Optional[int] = None):
+    """
+    Lanza QueryBudgetExceeded si el bloque ejecuta más de `max_queries` consultas o
+    repite una misma sentencia más de `max_repeats` veces. Por ejemplo:
+
+        with query_budget(2, max_repeats=1):
+            crud.get_sellers(db)
+    """
+    with count_queries() as stats:
+        yield stats
+    problems = []
+    if stats.db_queries > max_queries:
+        problems.append(f"{stats.db_queries} consultas (máximo {max_queries})")
+    if max_repeats is not None:
+        problems += [f"{count}x {statement}" for statement, count in stats.repeated(max_repeats + 1)]
+    if problems:
+        raise QueryBudgetExceeded("Presupuesto de consultas excedido: " + "; ".join(problems))
+
+
+class CapturedRequest(NamedTuple):
+    method: str
+    route: str
+    status_code: int
+    stats: RequestStats
+
+
+@contextmanager
+def capture_requests(metrics: Optional["RequestMetrics"] = None):
+    """
+    Devuelve la lista de las requests (CapturedRequest) que termina de atender la app
+    mientras dura el bloque, desde cualquier hilo. Requiere el MetricsMiddleware.
+    """
+    metrics = metrics or request_metrics
+    captured: List[CapturedRequest] = []
+    metrics.add_listener(captured.append)
+    try:
+        yield captured
+    finally:
+        metrics.remove_listener(captured.append)
+
+@contextmanager
+def request_query_budget(max_queries: int, max_repeats: Optional[int] = None, metrics: Optional["RequestMetrics"] = None):
+    """
+    Como query_budget(), pero por request: cada request atendida dentro del bloque debe
+    respetar el presupuesto. Falla también si no se midió ninguna request, para que un
+    presupuesto no pase sin comprobar nada. Por ejemplo:
+
+        with request_query_budget(2, max_repeats=1):
+            client.get("/sellers/", headers=headers)
+    """
+    with capture_requests(metrics) as captured:
+        yield captured
+    if not captured:
+        raise QueryBudgetExceeded("No se midió ninguna request (¿falta el MetricsMiddleware?)")
+    problems = []
+    for request in captured:
+        stats = request.stats
+        if stats.db_queries > max_queries:
+            problems.append(f"{request.method} {request.route}: {stats.db_queries} consultas (máximo {max_queries})")
+        if max_repeats is not None:
+            problems += [f"{request.method} {request.route}: {count}x {statement}"
+                         for statement, count in stats.repeated(max_repeats + 1)]
+    if problems:
+        raise QueryBudgetExceeded("Presupuesto de consultas excedido: " + "; ".join(problems))
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_histogram(name: str, help_text: str, series: Iterable[Tuple[dict, Iterable[float], List[int], float]]) -> List[str]:
+    """
+    Líneas de Prometheus de un histograma. Cada serie es (labels, límites, conteos por
+    bucket sin acumular con el de +Inf al final, suma).
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, buckets, counts, total in series:
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ["+Inf"], counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': bound if bound == '+Inf' else _number(bound)})} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return lines
+
+def render_counter(name: str, help_text: str, series: Iterable[Tuple[dict, float]], metric_type: str = "counter") -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    lines.extend(f"{name}{_labels(labels)} {_number(value)}" for labels, value in series)
+    return lines
+
+
+class RequestMetrics:
+    """Registro de métricas por ruta y de las consultas de los engines instrumentados."""
+
+    def __init__(self, slow_request_seconds: float = 1.0, excluded_routes: Iterable[str] = (),
+                 query_debug: bool = False, n_plus_one_threshold: int = 5):
+        self.slow_request_seconds = slow_request_seconds
+        self.query_debug = query_debug
+        self.n_plus_one_threshold = n_plus_one_threshold
+        # Rutas que no se miden (conexiones largas como SSE distorsionarían las latencias)
+        self.excluded_routes = set(excluded_routes)
+        self._lock = threading.Lock()
+        self._duration: Dict[Tuple[str, str], Histogram] = {}
+        self._queries: Dict[Tuple[str, str], Histogram] = {}
+        self._requests: Dict[Tuple[str, str, int], int] = {}
+        self._db_seconds: Dict[Tuple[str, str], float] = {}
+        self._mp_seconds: Dict[Tuple[str, str], float] = {}
+        self._mp_calls: Dict[Tuple[str, str], int] = {}
+        self.db_queries_total = 0
+        self.db_seconds_total = 0.0
+        self.slow_requests_total = 0
+        self._listeners: List[Callable[[CapturedRequest], None]] = []
+
+    # --- Consultas a la BD ---
+
+    def attach(self, engine):
+        """Registra los listeners que miden cada sentencia ejecutada por el engine."""
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("request_metrics_start", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("request_metrics_start")
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        with self._lock:
+            self.db_queries_total += 1
+            self.db_seconds_total += seconds
+        stats = current_request.get()
+        if stats is not None:
+            stats.record_query(statement, seconds)
+
+    # --- Requests ---
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            self._duration.setdefault(key, Histogram(DURATION_BUCKETS)).observe(seconds)
+            self._queries.setdefault(key, Histogram(QUERY_COUNT_BUCKETS)).observe(stats.db_queries)
+            self._requests[(method, route, status_code)] = self._requests.get((method, route, status_code), 0) + 1
+            self._db_seconds[key] = self._db_seconds.get(key, 0.0) + stats.db_seconds
+            self._mp_seconds[key] = self._mp_seconds.get(key, 0.0) + stats.mp_seconds
+            self._mp_calls[key] = self._mp_calls.get(key, 0) + stats.mp_calls
+        if seconds >= self.slow_request_seconds:
+            self.slow_requests_total += 1
+            breakdown = "; ".join(f"{count}x {query_seconds * 1000:.1f}ms {statement}"
+                                  for statement, count, query_seconds in stats.top_statements())
+            logger.warning(
+                f"Request lenta: {method} {route} -> {status_code} en {seconds * 1000:.1f}ms "
+                f"(BD: {stats.db_queries} consultas, {stats.db_seconds * 1000:.1f}ms; "
+                f"MP: {stats.mp_calls} llamadas, {stats.mp_seconds * 1000:.1f}ms). Consultas: {breakdown}"
+            )
+
+    def add_listener(self, callback: Callable[[CapturedRequest], None]):
+        """Registra una función que recibe cada request atendida (la usa capture_requests)."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[CapturedRequest], None]):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def notify(self, method: str, route: str, status_code: int, stats: RequestStats):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback(CapturedRequest(method, route, status_code, stats))
+
+    def check_repeated(self, method: str, route: str, stats: RequestStats):
+        repeated = stats.repeated(self.n_plus_one_threshold)
+        if repeated:
+            logger.warning(f"Posible N+1 en {method} {route}: " + "; ".join(f"{count}x {statement}" for statement, count in repeated))
+
+    def route_totals(self) -> Dict[Tuple[str, str], dict]:
+        """Requests y consultas acumuladas por (método, ruta). Lo usan los benchmarks."""
+        with self._lock:
+            return {key: {"requests": histogram.count, "db_queries": histogram.sum}
+                    for key, histogram in self._queries.items()}
+
+    def render(self) -> List[str]:
+        with self._lock:
+            duration = [({"method": m, "route": r}, h.buckets, list(h.counts), h.sum) for (m, r), h in self._duration.items()]
+            queries = [({"method": m, "route": r}, h.buckets, list(h.counts), h.sum) for (m, r), h in self._queries.items()]
+            requests = [({"method": m, "route": r, "status": s}, n) for (m, r, s), n in self._requests.items()]
+            db_seconds = [({"method": m, "route": r}, v) for (m, r), v in self._db_seconds.items()]
+            mp_seconds = [({"method": m, "route": r}, v) for (m, r), v in self._mp_seconds.items()]
+            mp_calls = [({"method": m, "route": r}, v) for (m, r), v in self._mp_calls.items()]
+            db_totals = [({}, self.db_queries_total)], [({}, self.db_seconds_total)]
+        return [
+            *render_counter("http_requests_total", "Requests atendidas por ruta y código de estado.", requests),
+            *render_histogram("http_request_duration_seconds", "Duración de las requests por ruta.", duration),
+            *render_histogram("http_request_db_queries", "Consultas a la BD por request.", queries),
+            *render_counter("http_request_db_seconds_total", "Tiempo en consultas a la BD dentro de requests.", db_seconds),
+            *render_counter("http_request_mp_calls_total", "Llamadas a Mercado Pago dentro de requests.", mp_calls),
+            *render_counter("http_request_mp_seconds_total", "Tiempo en llamadas a Mercado Pago dentro de requests.", mp_seconds),
+            *render_counter("http_slow_requests_total", "Requests más lentas que el umbral del log.", [({}, self.slow_requests_total)]),
+            *render_counter("db_queries_total", "Consultas a la BD (incluye tareas en segundo plano).", db_totals[0]),
+            *render_counter("db_query_seconds_total", "Tiempo en consultas a la BD (incluye tareas en segundo plano).", db_totals[1]),
+        ]
+
+
+class MetricsMiddleware:
+    """Middleware ASGI que mide cada request HTTP y la atribuye a su ruta (plantilla, no URL)."""
+
+    def __init__(self, app, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        root_path = scope.get("root_path", "")
+        token = current_request.set(stats)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.metrics.query_debug:
+                    message["headers"] = [*message.get("headers", []), (b"x-db-queries", str(stats.db_queries).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - start
+            current_request.reset(token)
+            # El router de FastAPI deja la ruta resuelta en el scope
+            route = getattr(scope.get("route"), "path", None)
+            if route is None:
+                # Un Mount (como /static) sólo deja su prefijo en root_path
+                route = scope["root_path"] if scope.get("root_path", "") != root_path else "unmatched"
+            if route not in self.metrics.excluded_routes:
+                self.metrics.observe(scope["method"], route, status_code, seconds, stats)
+            if self.metrics.query_debug:
+                self.metrics.check_repeated(scope["method"], route, stats)
+            self.metrics.notify(scope["method"], route, status_code, stats)
+
+
+request_metrics = RequestMetrics(
+    slow_request_seconds=settings.SLOW_REQUEST_THRESHOLD_SECONDS,
+    excluded_routes=settings.METRICS_EXCLUDED_ROUTES,
+    query_debug=settings.QUERY_DEBUG,
+    n_plus_one_threshold=settings.QUERY_DEBUG_REPEAT_THRESHOLD,
+)
@@ -0,0 +1,116 @@
+"""
+Actualización del esquema de una base de datos existente.
+
+`create_all` sólo crea las tablas que faltan: a una tabla que ya existía no le agrega
+los índices ni las restricciones únicas declarados después en `models.py` (p. ej.
+`uq_parking_event_natural_key` o `ix_payments_seller_time_id`). Este script los crea
+si faltan; es idempotente y puede ejecutarse en cada despliegue, antes de arrancar la
+app:
+
+    python schema_upgrade.py
+
+Antes de crear `uq_parking_event_natural_key` elimina los eventos duplicados por
+(ticket_code, device_id, event_type, event_time), conservando el de menor id, junto
+con las filas de conciliación que apuntaban a los duplicados borrados. Si se borró
+algún duplicado conviene recalcular la analítica (`POST /api/v1/admin/analytics/rebuild`)
+y la conciliación (`POST /api/v1/admin/reconciliation/run?rebuild=true`).
+"""
+import logging
+from typing import List
+
+from sqlalchemy import Index, MetaData, UniqueConstraint, delete, func, inspect, select, tuple_
+from sqlalchemy.engine import Engine
+
+import models
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Ids a borrar por sentencia
+DELETE_BATCH_SIZE = 1000
+
+PARKING_EVENT_NATURAL_KEY = ("ticket_code", "device_id", "event_type", "event_time")
+
+
+# --- Duplicados ---
+
+def duplicate_parking_event_ids(connection) -> List[int]:
+    """Ids de los eventos repetidos por clave natural, salvo el de menor id de cada grupo."""
+    events = models.ParkingEvent.__table__
+    key = [events.c[name] for name in PARKING_EVENT_NATURAL_KEY]
+    groups = select(*key).group_by(*key).having(func.count() > 1)
+    rows = connection.execute(
+        select(events.c.id, *key).where(tuple_(*key).in_(groups)).order_by(events.c.id)
+    )
+    seen, duplicates = set(), []
+    for row in rows:
+        natural_key = tuple(row[1:])
+        if natural_key in seen:
+            duplicates.append(row.id)
+        else:
+            seen.add(natural_key)
+    return duplicates
+
+def remove_duplicate_parking_events(connection) -> int:
+    """Borra los eventos duplicados (y su conciliación). Devuelve cuántos eventos borró."""
+    duplicates = duplicate_parking_event_ids(connection)
+    reconciliations = models.PaymentReconciliation.__table__
+    events = models.ParkingEvent.__table__
+    for start in range(0, len(duplicates), DELETE_BATCH_SIZE):
+        ids = duplicates[start:start + DELETE_BATCH_SIZE]
+        connection.execute(delete(reconciliations).where(reconciliations.c.exit_event_id.in_(ids)))
+        connection.execute(delete(events).where(events.c.id.in_(ids)))
+    return len(duplicates)
+
+
+# --- Índices y Restricciones ---
+
+def _existing_index_names(connection, table_name: str) -> set:
+    inspector = inspect(connection)
+    names = {index["name"] for index in inspector.get_indexes(table_name)}
+    return names | {constraint["name"] for constraint in inspector.get_unique_constraints(table_name)}
+
+def _missing_indexes(connection, table) -> List[Index]:
+    """
+    Índices declarados en el modelo que no existen en la tabla. Las restricciones
+    únicas con nombre se crean como índice único del mismo nombre, que los motores
+    soportados aceptan como destino del INSERT que ignora duplicados.
+    """
+    existing = _existing_index_names(connection, table.name)
+    # Copia en metadata propia: agregar el índice a la tabla del modelo haría que
+    # create_all lo emitiera dos veces en una BD nueva
+    copy = table.to_metadata(MetaData())
+    missing = [index for index in copy.indexes if index.name and index.name not in existing]
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint) and constraint.name and constraint.name not in existing:
+            missing.append(Index(constraint.name, *[copy.c[column.name] for column in constraint.columns], unique=True))
+    columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    for index in [index for index in missing if not {column.name for column in index.columns} <= columns]:
+        # Las columnas nuevas no se agregan aquí: requieren su propio ALTER TABLE
+        logger.warning("No se crea %s: faltan columnas en la tabla %s", index.name, table.name)
+        missing.remove(index)
+    return missing
+
+def upgrade(bind: Engine = engine) -> dict:
+    """Crea las tablas, índices y restricciones que falten. Devuelve un resumen de lo hecho."""
+    models.Base.metadata.create_all(bind=bind)
+    summary = {"duplicate_parking_events_removed": 0, "indexes_created": []}
+    with bind.begin() as connection:
+        if "uq_parking_event_natural_key" not in _existing_index_names(connection, models.ParkingEvent.__tablename__):
+            summary["duplicate_parking_events_removed"] = remove_duplicate_parking_events(connection)
+        for table in models.Base.metadata.sorted_tables:
+            for index in _missing_indexes(connection, table):
+                index.create(bind=connection)
+                summary["indexes_created"].append(index.name)
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    result = upgrade()
+    logger.info("Índices creados: %s", ", ".join(result["indexes_created"]) or "ninguno")
+    if result["duplicate_parking_events_removed"]:
+        logger.warning(
+            "Se borraron %s eventos duplicados: recalcule la analítica y la conciliación (rebuild)",
+            result["duplicate_parking_events_removed"],
+        )
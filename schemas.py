@@ -74,6 +74,20 @@ class TotemUpdate(BaseModel):
 
 # El schema Totem ya está definido arriba para la forward declaration
 
+class TotemApiKey(BaseModel):
+    id: int
+    totem_id: int
+    key_prefix: str
+    created_at: datetime
+    revoked_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class TotemApiKeyCreated(TotemApiKey):
+    # La key completa sólo se devuelve al crearla; después no puede recuperarse
+    api_key: str
+
 # --- Schemas para Payment ---
 
 class PaymentBase(BaseModel):
@@ -93,6 +107,26 @@ class Payment(PaymentBase):
         from_attributes = True
 
 
+class PaymentSummaryTotals(BaseModel):
+    count: int
+    total_amount: float
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+
+class PaymentSummaryTotem(PaymentSummaryTotals):
+    external_pos_id: Optional[str] = None
+
+class PaymentSummaryBucket(PaymentSummaryTotals):
+    bucket_start: datetime
+
+class PaymentSummary(PaymentSummaryTotals):
+    start_date: datetime
+    end_date: datetime
+    granularity: str
+    by_totem: List[PaymentSummaryTotem] = []
+    series: List[PaymentSummaryBucket] = []
+
+
 # --- Schemas para ParkingEvent ---
 
 class ParkingEventBase(BaseModel):
@@ -111,6 +145,56 @@ class ParkingEvent(ParkingEventBase):
         from_attributes = True
 
 
+# --- Schemas para Analítica de Parking ---
+
+class ParkingDeviceOccupancy(BaseModel):
+    device_id: Optional[int] = None
+    occupancy: int
+    oldest_entry: Optional[datetime] = None
+
+class ParkingOccupancy(BaseModel):
+    total: int
+    devices: List[ParkingDeviceOccupancy] = []
+    last_event_id: int # Último evento incluido; los posteriores aún no se procesaron
+    pending_events: int
+
+class ParkingFlowBucket(BaseModel):
+    bucket_start: datetime
+    entries: int
+    exits: int
+
+class ParkingDwellBin(BaseModel):
+    min_minutes: int
+    max_minutes: Optional[int] = None # None en el último intervalo
+    stays: int
+
+class ParkingDwellSummary(BaseModel):
+    start_date: datetime
+    end_date: datetime
+    stays: int
+    average_minutes: Optional[float] = None
+    p50_minutes: Optional[float] = None
+    p90_minutes: Optional[float] = None
+    bins: List[ParkingDwellBin] = []
+
+
+# --- Schemas para Conciliación de Salidas y Pagos ---
+
+class PaymentReconciliation(BaseModel):
+    id: int
+    ticket_code: str
+    status: str
+    exit_event_id: Optional[int] = None
+    exit_time: Optional[datetime] = None
+    device_id: Optional[int] = None
+    payment_id: Optional[int] = None
+    payment_time: Optional[datetime] = None
+    matched_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
 # --- Schemas para Notificaciones de Mercado Pago (IPN) ---
 
 class MercadoPagoNotificationData(BaseModel):
@@ -1,32 +1,47 @@
 from fastapi import Depends, HTTPException, status, Security
 from fastapi.security import OAuth2PasswordBearer, APIKeyHeader
-from jose import JWTError, jwt
+from jose import JWTError
 from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 import schemas
-import crud
-from database import SessionLocal
+import crud_async
+from auth_cache import principal_cache
+from database import AsyncSessionLocal
+from jwt_keyring import JWTKeyring, VerifiedTokenCache
+from password_hashing import PasswordHasher
 from settings import settings
+from totem_keys import TotemPrincipal, auth_log, totem_key_index
 
 # --- Configuración de Seguridad ---
 
-# Contexto para el hashing de contraseñas
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Contexto para el hashing de contraseñas. Si cambian las rondas, los hashes anteriores
+# se actualizan en el siguiente login correcto (ver PasswordHasher.verify_and_update)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+# Pool acotado para verificar contraseñas desde endpoints async sin bloquear el event loop
+password_hasher = PasswordHasher(pwd_context, workers=settings.PASSWORD_HASH_WORKERS, max_pending=settings.PASSWORD_HASH_MAX_PENDING)
 
 # Esquema de autenticación OAuth2 para Vendedores (Dashboard)
 # auto_error=False hace que el Dependency devuelva None si no hay token, en lugar de un error 401.
 # Esto nos permite tener endpoints verdaderamente opcionales.
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
+# Llavero de claves de firma (rotación por `kid`) y caché de tokens ya verificados
+jwt_keyring = JWTKeyring.from_settings(settings)
+verified_token_cache = VerifiedTokenCache(max_entries=settings.JWT_VERIFIED_CACHE_MAX_ENTRIES)
+
 # Esquema de autenticación por API Key para Tótems
 api_key_header_scheme = APIKeyHeader(name="X-API-Key")
 
 # --- Funciones de Contraseña ---
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verifica que una contraseña en texto plano coincida con un hash."""
+    """
+    Verifica que una contraseña en texto plano coincida con un hash. Bloqueante: desde
+    código async usar password_hasher.verify_and_update.
+    """
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
@@ -44,11 +59,39 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
         # Por defecto, el token expira en 15 minutos
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
-    return encoded_jwt
+    return jwt_keyring.encode(to_encode)
+
+def decode_access_token(token: str) -> dict:
+    """
+    Devuelve las claims de un token válido, verificando la firma sólo la primera vez
+    que se ve el token. Lanza JWTError si no es válido.
+    """
+    claims = verified_token_cache.get(token)
+    if claims is None:
+        claims = jwt_keyring.decode(token)
+        verified_token_cache.put(token, claims)
+    return claims
 
 # --- Dependencias de Seguridad ---
 
+async def _resolve_principal(email: str, exp: Optional[int]) -> Optional[schemas.Seller]:
+    """
+    Obtiene el vendedor del token, primero desde la caché de principals y si no
+    desde la base de datos. Los tokens sin `exp` no se cachean.
+    """
+    if exp is not None:
+        cached = principal_cache.get(email, exp)
+        if cached is not None:
+            return cached
+    async with AsyncSessionLocal() as db:
+        user = await crud_async.get_seller_by_email(db, email=email)
+    if user is None:
+        return None
+    principal = schemas.Seller.model_validate(user)
+    if exp is not None:
+        principal_cache.put(email, exp, principal)
+    return principal
+
 async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)) -> schemas.Seller:
     """
     Dependencia para obtener el VENDEDOR actual a partir de un token JWT.
@@ -63,7 +106,7 @@ async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)) -> sch
     if token is None:
         raise credentials_exception
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = decode_access_token(token)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -71,14 +114,10 @@ async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)) -> sch
     except JWTError:
         raise credentials_exception
     
-    db = SessionLocal()
-    try:
-        user = crud.get_seller_by_email(db, email=token_data.email)
-        if user is None:
-            raise credentials_exception
-        return user
-    finally:
-        db.close()
+    user = await _resolve_principal(token_data.email, payload.get("exp"))
+    if user is None:
+        raise credentials_exception
+    return user
 
 async def get_optional_current_user(token: Optional[str] = Depends(oauth2_scheme)) -> Optional[schemas.Seller]:
     """
@@ -89,7 +128,7 @@ async def get_optional_current_user(token: Optional[str] = Depends(oauth2_scheme
     if token is None:
         return None
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = decode_access_token(token)
         email: str = payload.get("sub")
         if email is None:
             return None
@@ -97,30 +136,22 @@ async def get_optional_current_user(token: Optional[str] = Depends(oauth2_scheme
     except JWTError:
         return None # Token inválido (expirado, malformado, etc.)
     
-    db = SessionLocal()
-    try:
-        user = crud.get_seller_by_email(db, email=token_data.email)
-        return user
-    finally:
-        db.close()
+    return await _resolve_principal(token_data.email, payload.get("exp"))
 
-def validate_totem_api_key(api_key: str = Security(api_key_header_scheme)):
+async def validate_totem_api_key(api_key: str = Security(api_key_header_scheme)) -> TotemPrincipal:
     """
-    Dependencia para validar la API Key enviada por un Tótem.
+    Dependencia para validar la API Key enviada por un Tótem. Devuelve el tótem al
+    que pertenece la key (o LEGACY_PRINCIPAL si es la key compartida).
     """
-    print("--- VALIDATING TOTEM API KEY ---")
-    print(f"--> Received Key: '{api_key}'")
-    print(f"--> Expected Key: '{settings.TOTEM_API_KEY}'")
-    
-    if api_key != settings.TOTEM_API_KEY:
-        print("--- VALIDATION FAILED: Keys do not match. ---")
+    principal = totem_key_index.authenticate(api_key)
+    if principal is None:
+        auth_log.failure("invalid_key", api_key)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or missing API Key",
         )
-    
-    print("--- VALIDATION SUCCESS ---")
-    return True
+    auth_log.success(principal)
+    return principal
 
 def require_admin_user(current_user: schemas.Seller = Depends(get_current_user)):
     """
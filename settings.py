@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import secrets
 from pathlib import Path
+from typing import Dict, List, Optional
 
 # Construye una ruta absoluta al directorio del proyecto para que .env se encuentre siempre
 BASE_DIR = Path(__file__).resolve().parent
@@ -9,12 +10,36 @@ class Settings(BaseSettings):
     # Para desarrollo, podemos usar una base de datos SQLite en archivo.
     # En producción, esto cambiará a la URL de tu base de datos MySQL.
     DATABASE_URL: str = "sqlite:///./test.db"
+    # URL para el acceso asíncrono. Si se deja vacía se deriva de DATABASE_URL
+    # (sqlite -> sqlite+aiosqlite, mysql -> mysql+aiomysql).
+    ASYNC_DATABASE_URL: str = ""
+
+    # Pool de conexiones (se aplica a cada engine, síncrono y asíncrono, de cada worker)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0 # Segundos de espera máxima por una conexión libre
+    DB_POOL_RECYCLE: int = 1800 # Debe ser menor que el wait_timeout de MySQL
+    DB_POOL_PRE_PING: bool = True
 
     # Clave secreta para firmar los JWT. ¡Debe ser secreta!
     # Puedes generar una nueva con: openssl rand -hex 32
     SECRET_KEY: str = secrets.token_hex(32)
     ALGORITHM: str = "HS256"
+    # Llavero para rotar la clave de los JWT: {"kid": "secreto", ...} (JSON en el .env) y la
+    # clave con la que se firman los tokens nuevos. Sin llavero se firma con SECRET_KEY.
+    # Todos los workers deben compartir estos valores (o SECRET_KEY) para aceptar los tokens
+    JWT_KEYS: Dict[str, str] = {}
+    JWT_ACTIVE_KID: str = ""
+    JWT_VERIFIED_CACHE_MAX_ENTRIES: int = 10000 # Tokens ya verificados que no vuelven a pasar por la criptografía
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # Hashing de contraseñas (bcrypt) en un pool acotado, fuera del event loop
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 32 # Logins en espera antes de responder 503
+    # Caché de usuarios autenticados (por worker). El TTL acota cuánto tarda un worker
+    # en ver cambios hechos desde otro worker.
+    AUTH_CACHE_TTL_SECONDS: float = 60.0
+    AUTH_CACHE_MAX_ENTRIES: int = 1000
 
     # Variables para MercadoPago
     MP_APP_ID: str = ""
@@ -22,8 +47,110 @@ class Settings(BaseSettings):
     MP_WEBHOOK_SECRET: str = ""
     MP_REDIRECT_URI: str = "https://127.0.0.1:8000/mercadopago/connect" # Default para desarrollo
 
+    # Cliente HTTP compartido de Mercado Pago (mp_client.py)
+    MP_API_BASE_URL: str = "https://api.mercadopago.com"
+    MP_HTTP_CONNECT_TIMEOUT_SECONDS: float = 3.05
+    MP_HTTP_READ_TIMEOUT_SECONDS: float = 10.0
+    MP_HTTP_POOL_SIZE: int = 10
+    MP_HTTP_MAX_RETRIES: int = 2 # Sólo GET, ante errores de conexión y 502/503/504
+    MP_RATE_LIMIT_PER_SECOND: float = 20.0
+    MP_RATE_LIMIT_BURST: float = 40.0
+    MP_RATE_LIMIT_MAX_WAIT_SECONDS: float = 5.0
+    MP_CIRCUIT_FAILURE_THRESHOLD: int = 5
+    MP_CIRCUIT_RESET_SECONDS: float = 30.0
+
+    # Refresco proactivo de tokens de MP en segundo plano
+    MP_TOKEN_REFRESH_SCHEDULER_ENABLED: bool = True
+    MP_TOKEN_REFRESH_MARGIN_SECONDS: int = 1800 # Antelación respecto al umbral de token "vencido"
+    MP_TOKEN_REFRESH_CONCURRENCY: int = 4
+    MP_TOKEN_REFRESH_MAX_RETRIES: int = 5 # Tras agotarlos, el vendedor espera a la próxima sincronización
+    MP_TOKEN_REFRESH_RETRY_BASE_SECONDS: float = 30.0
+    MP_TOKEN_REFRESH_SYNC_INTERVAL_SECONDS: float = 300.0
+
+    # Cola persistente de notificaciones (webhooks) de MP
+    WEBHOOK_WORKERS_ENABLED: bool = True
+    WEBHOOK_WORKERS: int = 2
+    WEBHOOK_BATCH_SIZE: int = 10
+    WEBHOOK_POLL_INTERVAL_SECONDS: float = 2.0
+    WEBHOOK_MAX_ATTEMPTS: int = 8
+    WEBHOOK_RETRY_BASE_SECONDS: float = 10.0
+    WEBHOOK_LOCK_TIMEOUT_SECONDS: float = 300.0
+    WEBHOOK_DEDUP_WINDOW_SECONDS: float = 10.0
+    WEBHOOK_DONE_RETENTION_HOURS: float = 72.0 # Las notificaciones procesadas se borran pasado este plazo
+    WEBHOOK_PURGE_INTERVAL_SECONDS: float = 3600.0
+
+    # Estado compartido entre workers/nodos (shared_backend.py): locks de refresco de tokens,
+    # invalidación de la caché de tokens de tótems y deduplicación de webhooks.
+    # "memory" sólo vale con un único worker; "database" usa la BD de la app.
+    SHARED_BACKEND: str = "memory"
+    SHARED_MEMORY_MAX_ENTRIES: int = 10000
+    SHARED_BACKEND_POLL_INTERVAL_SECONDS: float = 1.0 # Demora máxima de los mensajes entre procesos
+    SHARED_BACKEND_MESSAGE_RETENTION_SECONDS: float = 3600.0
+    # Lock del refresco de tokens de MP: vence a los TTL segundos si su dueño muere
+    MP_TOKEN_REFRESH_LOCK_TTL_SECONDS: float = 60.0
+    MP_TOKEN_REFRESH_LOCK_TIMEOUT_SECONDS: float = 30.0 # Espera máxima por el lock
+    # Lock de las tareas periódicas (analítica, conciliación, backfill y archivo): sólo un
+    # worker ejecuta cada una a la vez. Se renueva entre tandas; debe superar la duración
+    # de una tanda (si vence y lo toma otro worker, la ejecución en curso se detiene).
+    JOB_LOCK_TTL_SECONDS: float = 900.0
+
+    # Analítica incremental de ocupación y estadías (parking_analytics.py)
+    PARKING_ANALYTICS_ENABLED: bool = True
+    PARKING_ANALYTICS_INTERVAL_SECONDS: float = 30.0
+    PARKING_ANALYTICS_BATCH_SIZE: int = 5000
+    # Antigüedad mínima de un evento para procesarlo: los ids pueden confirmarse fuera de orden
+    PARKING_ANALYTICS_SETTLE_SECONDS: float = 10.0
+    PARKING_ANALYTICS_OPEN_TICKET_MAX_HOURS: float = 72.0 # Entradas más antiguas no cuentan como ocupación
+
+    # Conciliación de salidas y pagos por ticket (payment_reconciliation.py)
+    RECONCILIATION_ENABLED: bool = True
+    RECONCILIATION_INTERVAL_SECONDS: float = 60.0
+    RECONCILIATION_BATCH_SIZE: int = 5000
+    RECONCILIATION_WINDOW_BEFORE_MINUTES: float = 60.0 # Pago como máximo esto antes de la salida
+    RECONCILIATION_WINDOW_AFTER_MINUTES: float = 10.0 # Tolerancia por desfase de relojes
+    RECONCILIATION_GRACE_MINUTES: float = 120.0 # Espera antes de reportar algo como sin emparejar
+    RECONCILIATION_SETTLE_SECONDS: float = 10.0 # Antigüedad mínima de salidas y pagos para conciliarlos
+
+    # Backfill de pagos desde la búsqueda de MP, por si se pierden webhooks (payment_backfill.py)
+    PAYMENT_BACKFILL_ENABLED: bool = True
+    PAYMENT_BACKFILL_INTERVAL_SECONDS: float = 900.0
+    PAYMENT_BACKFILL_CONCURRENCY: int = 8 # Vendedores sincronizados a la vez
+    PAYMENT_BACKFILL_PAGE_SIZE: int = 100
+    PAYMENT_BACKFILL_INITIAL_DAYS: float = 30.0 # Historia que se lee para un vendedor sin marca de agua
+    PAYMENT_BACKFILL_OVERLAP_MINUTES: float = 10.0 # Margen que se relee antes de la marca de agua
+
+    # Archivo mensual de eventos y pagos antiguos fuera de las tablas principales (data_retention.py)
+    DATA_ARCHIVE_ENABLED: bool = False
+    DATA_ARCHIVE_INTERVAL_SECONDS: float = 3600.0
+    DATA_ARCHIVE_BATCH_SIZE: int = 500 # Filas movidas por transacción (máximo 500)
+    PARKING_EVENTS_RETENTION_DAYS: float = 90.0 # También para las filas de conciliación
+    # Debe superar el plazo en que un pago aún puede cambiar (reembolsos): un pago ya
+    # archivado que vuelve a llegar se guarda otra vez en `payments`
+    PAYMENTS_RETENTION_DAYS: float = 400.0
+
+    # Canal en vivo (SSE) del dashboard
+    LIVE_FEED_QUEUE_SIZE: int = 100 # Mensajes pendientes por conexión antes de pedir un 'resync'
+    LIVE_FEED_MAX_CONNECTIONS_PER_SELLER: int = 5
+    LIVE_FEED_HEARTBEAT_SECONDS: float = 15.0
+
+    # Métricas por request en formato Prometheus (GET /metrics) y log de requests lentas
+    METRICS_ENABLED: bool = True
+    METRICS_TOKEN: Optional[str] = None # Si se define, /metrics exige "Authorization: Bearer <token>"
+    METRICS_EXCLUDED_ROUTES: List[str] = ["/api/v1/live", "/metrics"] # Conexiones largas o el propio scrape
+    SLOW_REQUEST_THRESHOLD_SECONDS: float = 1.0
+    # Depuración de consultas (desarrollo/pruebas): cabecera X-DB-Queries y aviso de N+1
+    QUERY_DEBUG: bool = False
+    QUERY_DEBUG_REPEAT_THRESHOLD: int = 5 # Repeticiones de una misma sentencia que se avisan como N+1
+
+    # Exportaciones en streaming (filas leídas por tanda del cursor)
+    EXPORT_BATCH_SIZE: int = 2000
+
     # Clave de API para la comunicación entre el tótem y el backoffice
     TOTEM_API_KEY: str = secrets.token_hex(32)
+    # Keys por tótem (totem_keys.py). La key compartida de arriba se acepta mientras esto esté activo
+    TOTEM_LEGACY_API_KEY_ENABLED: bool = True
+    TOTEM_KEY_REFRESH_SECONDS: float = 30.0 # Recarga periódica del índice, respaldo de los avisos entre workers
+    TOTEM_AUTH_LOG_SAMPLE_RATE: float = 0.01 # Fracción de autenticaciones exitosas que se registran
 
     model_config = SettingsConfigDict(env_file=BASE_DIR / ".env")
 
@@ -0,0 +1,523 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+# --- Estado Compartido entre Workers y Nodos ---
+#
+# Los locks, cachés y deduplicaciones en memoria sólo valen dentro de un proceso: con
+# varios workers de uvicorn, o varios nodos detrás de un balanceador, cada uno tiene
+# los suyos. Este módulo define una interfaz mínima para ese estado (valores con TTL,
+# locks con vencimiento y pub/sub) con dos implementaciones:
+#
+#  - MemoryBackend: en memoria del proceso. Es el comportamiento de siempre, válido
+#    con un único worker.
+#  - DatabaseBackend: sobre dos tablas de la misma base de datos de la app
+#    (`shared_cache` y `shared_messages`), sin servicios externos. Funciona en SQLite y
+#    MySQL: la exclusión se apoya en la clave primaria (INSERT) y en UPDATE/DELETE
+#    condicionales, y el pub/sub en un sondeo periódico de los mensajes nuevos.
+#    Como los ids autoincrementales pueden confirmarse fuera de orden, el sondeo
+#    recuerda los ids salteados y los vuelve a buscar durante un tiempo.
+#
+# Se elige con SHARED_BACKEND ("memory" o "database").
+
+
+class LockTimeout(Exception):
+    """No se pudo adquirir un lock compartido en el tiempo indicado."""
+
+
+class SharedBackend:
+    """
+    Interfaz común. Los valores son strings; quien necesite estructuras las serializa.
+    Los métodos son bloqueantes y seguros desde cualquier hilo; desde el event loop
+    deben llamarse con asyncio.to_thread (salvo con MemoryBackend).
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Callable[[dict], None]]] = {}
+        self._subscribers_lock = threading.Lock()
+        # Un lock local por nombre: dentro del proceso sólo un hilo compite por el lock
+        # compartido, el resto espera aquí sin consultar al backend
+        self._local_locks: Dict[str, threading.Lock] = {}
+        self.lock_waits_total = 0
+        self.lock_timeouts_total = 0
+
+    # --- Ciclo de vida ---
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    # --- Caché con TTL ---
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl_seconds: float):
+        raise NotImplementedError
+
+    def add(self, key: str, value: str, ttl_seconds: float) -> bool:
+        """Guarda el valor sólo si la clave no existe (o venció). Devuelve True si lo guardó."""
+        raise NotImplementedError
+
+    def delete(self, key: str, value: Optional[str] = None) -> bool:
+        """Borra la clave; si se pasa `value`, sólo si sigue teniendo ese valor."""
+        raise NotImplementedError
+
+    def extend(self, key: str, value: str, ttl_seconds: float) -> bool:
+        """Renueva el TTL de la clave sólo si sigue teniendo `value`. Devuelve True si lo renovó."""
+        raise NotImplementedError
+
+    # --- Locks ---
+
+    @contextmanager
+    def lock(self, name: str, ttl_seconds: float, timeout_seconds: float):
+        """
+        Lock exclusivo entre todos los workers que comparten el backend. Vence a los
+        `ttl_seconds` por si quien lo tiene muere; la sección crítica debe durar menos.
+        Lanza LockTimeout si no se consigue en `timeout_seconds`.
+        """
+        deadline = time.monotonic() + timeout_seconds
+        local_lock = self._local_lock(name)
+        if not local_lock.acquire(timeout=max(0.0, timeout_seconds)):
+            self.lock_timeouts_total += 1
+            raise LockTimeout(f"Lock '{name}' ocupado")
+        try:
+            key = f"lock:{name}"
+            owner = uuid.uuid4().hex
+            delay = 0.05
+            while not self.add(key, owner, ttl_seconds):
+                self.lock_waits_total += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.lock_timeouts_total += 1
+                    raise LockTimeout(f"Lock '{name}' ocupado")
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.5)
+            try:
+                yield
+            finally:
+                self.delete(key, owner)
+        finally:
+            local_lock.release()
+
+    def try_acquire(self, name: str, ttl_seconds: float) -> Optional[str]:
+        """
+        Toma el lock `name` sin esperar (ej. para que una tarea periódica corra en un solo
+        worker). Devuelve el token con que liberarlo, o None si lo tiene otro.
+        """
+        owner = uuid.uuid4().hex
+        return owner if self.add(f"lock:{name}", owner, ttl_seconds) else None
+
+    def release(self, name: str, owner: str):
+        self.delete(f"lock:{name}", owner)
+
+    def renew(self, name: str, owner: str, ttl_seconds: float) -> bool:
+        """Extiende un lock tomado con try_acquire. Devuelve False si ya no es de `owner`."""
+        return self.extend(f"lock:{name}", owner, ttl_seconds)
+
+    def _local_lock(self, name: str) -> threading.Lock:
+        with self._subscribers_lock:
+            lock = self._local_locks.get(name)
+            if lock is None:
+                lock = self._local_locks[name] = threading.Lock()
+            return lock
+
+    # --- Pub/sub ---
+
+    def subscribe(self, channel: str, callback: Callable[[dict], None]):
+        """Registra `callback` para los mensajes de `channel`. Se invoca desde cualquier hilo."""
+        with self._subscribers_lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def publish(self, channel: str, message: dict):
+        """Entrega `message` a los suscriptores de este proceso y de los demás."""
+        raise NotImplementedError
+
+    def _dispatch(self, channel: str, message: dict):
+        with self._subscribers_lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                logger.error(f"Error entregando un mensaje del canal '{channel}': {e}")
+
+    def status(self) -> dict:
+        return {
+            "backend": self.name,
+            "lock_waits_total": self.lock_waits_total,
+            "lock_timeouts_total": self.lock_timeouts_total,
+        }
+
+
+class JobLock:
+    """
+    Lock de una ejecución de una tarea periódica, para que corra en un solo worker.
+    Vence a los `ttl_seconds` por si el worker muere, así que la tarea llama a `keep()`
+    entre tandas: renueva el vencimiento (a lo sumo cada tercio del TTL) y devuelve
+    False si el lock se perdió, en cuyo caso la ejecución debe detenerse. Sin backend
+    siempre se consigue.
+    """
+
+    def __init__(self, backend: Optional[SharedBackend], name: str, ttl_seconds: float):
+        self.backend = backend
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.owner: Optional[str] = None
+        self.lost = False
+        self._renewed_at = 0.0
+        # Una ejecución puede llamar a keep() desde varios hilos (backfill)
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        if self.backend is None:
+            return True
+        self.owner = self.backend.try_acquire(self.name, self.ttl_seconds)
+        self._renewed_at = time.monotonic()
+        return self.owner is not None
+
+    def keep(self) -> bool:
+        if self.backend is None:
+            return True
+        with self._lock:
+            if not self.lost and time.monotonic() - self._renewed_at >= self.ttl_seconds / 3:
+                if self.backend.renew(self.name, self.owner, self.ttl_seconds):
+                    self._renewed_at = time.monotonic()
+                else:
+                    self.lost = True
+                    logger.warning(f"Lock '{self.name}' perdido: la ejecución se detiene.")
+            return not self.lost
+
+    def release(self):
+        if self.backend is not None and self.owner is not None and not self.lost:
+            self.backend.release(self.name, self.owner)
+        self.owner = None
+
+
+class MemoryBackend(SharedBackend):
+    """Backend del propio proceso: LRU acotado de valores con TTL y pub/sub local."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = 10000):
+        super().__init__()
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (value, expires_at monotónico)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._live_entry(key)
+            return entry[0] if entry is not None else None
+
+    def set(self, key: str, value: str, ttl_seconds: float):
+        with self._lock:
+            self._store(key, value, ttl_seconds)
+
+    def add(self, key: str, value: str, ttl_seconds: float) -> bool:
+        with self._lock:
+            if self._live_entry(key) is not None:
+                return False
+            self._store(key, value, ttl_seconds)
+            return True
+
+    def delete(self, key: str, value: Optional[str] = None) -> bool:
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None or (value is not None and entry[0] != value):
+                return False
+            del self._entries[key]
+            return True
+
+    def extend(self, key: str, value: str, ttl_seconds: float) -> bool:
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None or entry[0] != value:
+                return False
+            self._store(key, value, ttl_seconds)
+            return True
+
+    def publish(self, channel: str, message: dict):
+        self._dispatch(channel, message)
+
+    def status(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        return {**super().status(), "entries": entries, "max_entries": self.max_entries}
+
+    def _live_entry(self, key: str) -> Optional[Tuple[str, float]]:
+        # Debe llamarse con self._lock adquirido
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def _store(self, key: str, value: str, ttl_seconds: float):
+        # Debe llamarse con self._lock adquirido
+        self._entries[key] = (value, time.monotonic() + ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class DatabaseBackend(SharedBackend):
+    """
+    Backend sobre la base de datos de la app. Cada operación usa una sesión propia y
+    hace commit de inmediato, independiente de la transacción de quien la llama. Los
+    mensajes publicados se entregan al instante en este proceso y, en los demás, en
+    el siguiente sondeo (cada `poll_interval_seconds`). Un mensaje confirmado después
+    que otros de id mayor se entrega si aparece dentro de `gap_timeout_seconds`.
+    """
+
+    name = "database"
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        poll_interval_seconds: float = 1.0,
+        message_retention_seconds: float = 3600.0,
+        cleanup_interval_seconds: float = 300.0,
+        gap_timeout_seconds: float = 60.0,
+        max_gaps: int = 1000,
+    ):
+        super().__init__()
+        self.session_factory = session_factory
+        self.poll_interval_seconds = poll_interval_seconds
+        self.message_retention_seconds = message_retention_seconds
+        self.cleanup_interval_seconds = cleanup_interval_seconds
+        self.gap_timeout_seconds = gap_timeout_seconds
+        self.max_gaps = max_gaps
+        # Identifica a este proceso para no recibir dos veces sus propios mensajes
+        self.node_id = uuid.uuid4().hex
+        self._last_message_id: Optional[int] = None
+        # Ids menores que _last_message_id aún no vistos -> instante (monotónico) en que se notaron.
+        # Son transacciones sin confirmar o INSERTs revertidos (que nunca aparecerán).
+        self._gaps: "OrderedDict[int, float]" = OrderedDict()
+        self._next_cleanup_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.received_total = 0
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.is_running:
+            return
+        if self._last_message_id is None:
+            # Sólo interesan los mensajes publicados a partir de ahora
+            self._last_message_id = await asyncio.to_thread(self._max_message_id)
+        self._task = asyncio.create_task(self._run())
+        logger.info("Backend compartido en base de datos iniciado.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # --- Caché con TTL ---
+
+    def get(self, key: str) -> Optional[str]:
+        db = self.session_factory()
+        try:
+            return db.query(models.SharedCacheEntry.value).filter(
+                models.SharedCacheEntry.key == key,
+                models.SharedCacheEntry.expires_at > datetime.utcnow(),
+            ).scalar()
+        finally:
+            db.close()
+
+    def set(self, key: str, value: str, ttl_seconds: float):
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl_seconds)
+        db = self.session_factory()
+        try:
+            for _ in range(2):
+                result = db.execute(
+                    update(models.SharedCacheEntry)
+                    .where(models.SharedCacheEntry.key == key)
+                    .values(value=value, expires_at=expires_at)
+                )
+                if result.rowcount:
+                    db.commit()
+                    return
+                db.add(models.SharedCacheEntry(key=key, value=value, expires_at=expires_at))
+                try:
+                    db.commit()
+                    return
+                except IntegrityError:
+                    # Otro proceso la creó entre el UPDATE y el INSERT: se vuelve a actualizar
+                    db.rollback()
+        finally:
+            db.close()
+
+    def add(self, key: str, value: str, ttl_seconds: float) -> bool:
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl_seconds)
+        db = self.session_factory()
+        try:
+            db.add(models.SharedCacheEntry(key=key, value=value, expires_at=expires_at))
+            try:
+                db.commit()
+                return True
+            except IntegrityError:
+                db.rollback()
+            # La clave existe: sólo se puede tomar si ya venció. El UPDATE condicional es
+            # atómico, así que entre varios procesos sólo uno lo consigue.
+            result = db.execute(
+                update(models.SharedCacheEntry)
+                .where(models.SharedCacheEntry.key == key, models.SharedCacheEntry.expires_at <= now)
+                .values(value=value, expires_at=expires_at)
+            )
+            db.commit()
+            return bool(result.rowcount)
+        finally:
+            db.close()
+
+    def delete(self, key: str, value: Optional[str] = None) -> bool:
+        statement = delete(models.SharedCacheEntry).where(models.SharedCacheEntry.key == key)
+        if value is not None:
+            statement = statement.where(models.SharedCacheEntry.value == value)
+        db = self.session_factory()
+        try:
+            result = db.execute(statement)
+            db.commit()
+            return bool(result.rowcount)
+        finally:
+            db.close()
+
+    def extend(self, key: str, value: str, ttl_seconds: float) -> bool:
+        db = self.session_factory()
+        try:
+            # Condicional al valor: si venció y otro proceso la tomó, no se le quita
+            result = db.execute(
+                update(models.SharedCacheEntry)
+                .where(models.SharedCacheEntry.key == key, models.SharedCacheEntry.value == value)
+                .values(expires_at=datetime.utcnow() + timedelta(seconds=ttl_seconds))
+            )
+            db.commit()
+            return bool(result.rowcount)
+        finally:
+            db.close()
+
+    # --- Pub/sub ---
+
+    def publish(self, channel: str, message: dict):
+        db = self.session_factory()
+        try:
+            db.add(models.SharedMessage(channel=channel, origin=self.node_id, payload=json.dumps(message)))
+            db.commit()
+        finally:
+            db.close()
+        self._dispatch(channel, message)
+
+    def status(self) -> dict:
+        return {
+            **super().status(),
+            "running": self.is_running,
+            "node_id": self.node_id,
+            "last_message_id": self._last_message_id,
+            "pending_gaps": len(self._gaps),
+            "received_total": self.received_total,
+        }
+
+    # --- Implementación ---
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self._poll)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error leyendo mensajes del backend compartido: {e}")
+            await asyncio.sleep(self.poll_interval_seconds)
+
+    def _max_message_id(self) -> int:
+        db = self.session_factory()
+        try:
+            return db.query(func.max(models.SharedMessage.id)).scalar() or 0
+        finally:
+            db.close()
+
+    def _poll(self):
+        now = time.monotonic()
+        while self._gaps and next(iter(self._gaps.values())) <= now - self.gap_timeout_seconds:
+            self._gaps.popitem(last=False)
+        condition = models.SharedMessage.id > self._last_message_id
+        if self._gaps:
+            condition = or_(condition, models.SharedMessage.id.in_(list(self._gaps)))
+        db = self.session_factory()
+        try:
+            rows = db.query(models.SharedMessage.id, models.SharedMessage.channel,
+                            models.SharedMessage.origin, models.SharedMessage.payload)\
+                .filter(condition)\
+                .order_by(models.SharedMessage.id)\
+                .limit(1000).all()
+            if now >= self._next_cleanup_at:
+                self._cleanup(db)
+                self._next_cleanup_at = now + self.cleanup_interval_seconds
+        finally:
+            db.close()
+        for message_id, channel, origin, payload in rows:
+            if message_id > self._last_message_id:
+                for missing in range(max(self._last_message_id + 1, message_id - self.max_gaps), message_id):
+                    self._gaps[missing] = now
+                self._last_message_id = message_id
+            else:
+                self._gaps.pop(message_id, None)
+            while len(self._gaps) > self.max_gaps:
+                self._gaps.popitem(last=False)
+            if origin == self.node_id:
+                continue
+            self.received_total += 1
+            self._dispatch(channel, json.loads(payload))
+
+    def _cleanup(self, db: Session):
+        """Borra los valores vencidos y los mensajes más viejos que la retención."""
+        now = datetime.utcnow()
+        db.execute(delete(models.SharedCacheEntry).where(models.SharedCacheEntry.expires_at <= now))
+        db.execute(delete(models.SharedMessage).where(
+            models.SharedMessage.created_at < now - timedelta(seconds=self.message_retention_seconds)
+        ))
+        db.commit()
+
+
+def create_backend() -> SharedBackend:
+    if settings.SHARED_BACKEND == "database":
+        return DatabaseBackend(
+            session_factory=SessionLocal,
+            poll_interval_seconds=settings.SHARED_BACKEND_POLL_INTERVAL_SECONDS,
+            message_retention_seconds=settings.SHARED_BACKEND_MESSAGE_RETENTION_SECONDS,
+        )
+    if settings.SHARED_BACKEND != "memory":
+        raise ValueError(f"SHARED_BACKEND desconocido: '{settings.SHARED_BACKEND}' (usar 'memory' o 'database')")
+    return MemoryBackend(max_entries=settings.SHARED_MEMORY_MAX_ENTRIES)
+
+
+shared_backend = create_backend()
@@ -8,6 +8,9 @@ document.addEventListener('DOMContentLoaded', () => {
             items: [],
             currentPage: 1,
             perPage: 10,
+            cursors: [null], // cursors[i] es el valor de 'after' para pedir la página i + 1
+            nextCursor: null,
+            staleCursor: false, // La página 1 cambió por el live feed y cursors[1] ya no apunta a su último pago
             startDate: null,
             endDate: null,
         },
@@ -79,7 +82,7 @@ document.addEventListener('DOMContentLoaded', () => {
     };
 
     // --- API Service ---
-    async function apiService(endpoint, method = 'GET', body = null) {
+    async function apiService(endpoint, method = 'GET', body = null, { withHeaders = false } = {}) {
         const headers = { 'Authorization': `Bearer ${state.token}` };
         if (body) {
             headers['Content-Type'] = 'application/json';
@@ -95,7 +98,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (!response.ok) {
                 throw new Error(data.detail || 'Ocurrió un error en la petición.');
             }
-            return data;
+            return withHeaders ? { data, headers: response.headers } : data;
         } catch (error) {
             showToast(error.message, 'error');
             throw error;
@@ -190,7 +193,7 @@ document.addEventListener('DOMContentLoaded', () => {
             elements.payments.info.to.textContent = to;
             
             elements.payments.prevButton.disabled = currentPage === 1;
-            elements.payments.nextButton.disabled = items.length < perPage;
+            elements.payments.nextButton.disabled = !state.payments.nextCursor;
 
         } else if (currentPage === 1) {
             elements.payments.pagination.classList.add('hidden');
@@ -276,27 +279,110 @@ document.addEventListener('DOMContentLoaded', () => {
 
     async function loadPayments(page = 1, keepFilters = false) {
         const perPage = state.payments.perPage;
-        const skip = (page - 1) * perPage;
 
         if (!keepFilters) {
             state.payments.startDate = elements.payments.startDateFilter.value || null;
             state.payments.endDate = elements.payments.endDateFilter.value || null;
+            state.payments.cursors = [null];
         }
 
-        let url = `/api/v1/payments/me?skip=${skip}&limit=${perPage}`;
+        // Paginación por cursor: cada página se pide a partir del último pago de la anterior
+        const after = state.payments.cursors[page - 1];
+        let url = `/api/v1/payments/me?limit=${perPage}`;
+        if (after) url += `&after=${encodeURIComponent(after)}`;
         if (state.payments.startDate) url += `&start_date=${state.payments.startDate}`;
         if (state.payments.endDate) url += `&end_date=${state.payments.endDate}`;
 
         try {
-            const paymentsData = await apiService(url);
+            const { data: paymentsData, headers } = await apiService(url, 'GET', null, { withHeaders: true });
             state.payments.items = paymentsData;
             state.payments.currentPage = page;
+            state.payments.nextCursor = headers.get('X-Next-Cursor');
+            state.payments.cursors[page] = state.payments.nextCursor;
+            if (page === 1) state.payments.staleCursor = false;
             renderPaymentsTable();
         } catch (error) {
             console.error('Error al cargar los pagos:', error);
         }
     }
 
+    // --- Live Feed (Server-Sent Events) ---
+    // Se lee con fetch en lugar de EventSource para poder enviar el token en la cabecera.
+    const liveFeed = { retryDelay: 1000 };
+
+    function applyLivePayment(payment) {
+        const { items, currentPage, perPage, startDate, endDate } = state.payments;
+        const index = items.findIndex(p => p.id === payment.id);
+        if (index !== -1) {
+            items[index] = payment;
+        } else if (currentPage === 1 && !startDate && !endDate) {
+            // Los pagos nuevos se muestran arriba de la primera página sin volver a consultarla
+            items.unshift(payment);
+            if (items.length > perPage) {
+                items.splice(perPage);
+                state.payments.staleCursor = true;
+            }
+        }
+        renderPaymentsTable();
+        if (index === -1) showToast(`Nuevo pago recibido: $${parseFloat(payment.amount).toFixed(2)}`);
+    }
+
+    function applyLiveTotem(action, totem) {
+        const others = state.totems.filter(t => t.id !== totem.id);
+        state.totems = action === 'deleted' ? others : [...others, totem].sort((a, b) => a.id - b.id);
+        renderTotemsTable();
+    }
+
+    function handleLiveMessage(type, message) {
+        if (type === 'payment') {
+            applyLivePayment(message.payment);
+        } else if (type === 'totem') {
+            applyLiveTotem(message.action, message.totem);
+        } else if (type === 'resync') {
+            // Nos perdimos mensajes: recargamos lo visible por la API
+            loadPayments(state.payments.currentPage, true);
+            loadInitialData(true);
+        }
+    }
+
+    async function connectLiveFeed() {
+        try {
+            const response = await fetch('/api/v1/live', { headers: { 'Authorization': `Bearer ${state.token}` } });
+            if (response.status === 401) {
+                localStorage.removeItem('access_token');
+                window.location.href = '/';
+                return;
+            }
+            if (!response.ok || !response.body) throw new Error(`HTTP ${response.status}`);
+            liveFeed.retryDelay = 1000;
+
+            const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += value;
+                let separator;
+                while ((separator = buffer.indexOf('\n\n')) !== -1) {
+                    const block = buffer.slice(0, separator);
+                    buffer = buffer.slice(separator + 2);
+                    let type = 'message';
+                    let data = '';
+                    block.split('\n').forEach(line => {
+                        if (line.startsWith('event: ')) type = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    });
+                    if (data) handleLiveMessage(type, JSON.parse(data));
+                }
+            }
+        } catch (error) {
+            console.error('Canal en vivo desconectado:', error);
+        }
+        // Reconexión con backoff exponencial (máximo 1 minuto)
+        setTimeout(connectLiveFeed, liveFeed.retryDelay);
+        liveFeed.retryDelay = Math.min(liveFeed.retryDelay * 2, 60000);
+    }
+
     // --- Initialization ---
     async function loadInitialData(onlyTotems = false) {
         try {
@@ -404,8 +490,12 @@ document.addEventListener('DOMContentLoaded', () => {
             if (state.payments.currentPage > 1) loadPayments(state.payments.currentPage - 1, true);
         });
 
-        elements.payments.nextButton.addEventListener('click', () => {
-            loadPayments(state.payments.currentPage + 1, true);
+        elements.payments.nextButton.addEventListener('click', async () => {
+            if (!state.payments.nextCursor) return;
+            // Los pagos que el live feed empujó fuera de la página 1 van al principio de la 2:
+            // se vuelve a pedir la página 1 para obtener su cursor actual
+            if (state.payments.currentPage === 1 && state.payments.staleCursor) await loadPayments(1, true);
+            if (state.payments.nextCursor) loadPayments(state.payments.currentPage + 1, true);
         });
 
         elements.payments.startDateFilter.addEventListener('change', () => {
@@ -425,6 +515,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
         await loadInitialData();
         setupEventListeners();
+        connectLiveFeed();
     }
 
     startApp();
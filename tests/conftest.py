@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+# La configuración se lee al importar la app: la BD de pruebas debe quedar fijada antes
+_db_dir = tempfile.mkdtemp(prefix="backoffice-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ["METRICS_ENABLED"] = "true"
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import models
+from database import SessionLocal, engine
+
+
+@pytest.fixture
+def db():
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def client(db):
+    # Sin `with`: no arranca el lifespan (workers en segundo plano)
+    return TestClient(main.app)
@@ -0,0 +1,142 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mp_client import MercadoPagoClient, MercadoPagoError, MercadoPagoUnavailable, TokenBucket
+
+
+class StubMercadoPago(ThreadingHTTPServer):
+    """Mercado Pago falso: responde `status` tras `delay` segundos y cuenta las llamadas."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.status = 200
+        self.delay = 0.0
+        self.calls = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.calls += 1
+        time.sleep(self.server.delay)
+        body = b'{"id": "1", "status": "approved"}'
+        try:
+            self.send_response(self.server.status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # El cliente cortó la conexión por timeout
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = StubMercadoPago()
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def _client(stub, **kwargs):
+    options = {"base_url": stub.base_url, "max_retries": 0, "connect_timeout": 1.0, "read_timeout": 2.0}
+    options.update(kwargs)
+    return MercadoPagoClient(**options)
+
+
+# --- Token Bucket ---
+
+def test_token_bucket_allows_burst_then_waits_for_refill():
+    bucket = TokenBucket(rate=20.0, capacity=2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+    start = time.monotonic()
+    assert bucket.acquire(timeout=1.0)
+    assert 0.02 <= time.monotonic() - start < 0.5
+
+def test_rate_limited_call_is_rejected_without_reaching_mercadopago(stub):
+    client = _client(stub, rate_per_second=0.1, burst=1, rate_limit_wait_seconds=0)
+    assert client.get_payment("1", "token")["status"] == 200
+
+    with pytest.raises(MercadoPagoUnavailable):
+        client.get_payment("1", "token")
+    assert stub.calls == 1
+    assert client.rejected_total == 1
+    assert client.breaker.state == "closed"
+
+
+# --- Circuit Breaker ---
+
+def test_circuit_opens_after_failures_and_closes_after_successful_trial(stub):
+    client = _client(stub, failure_threshold=2, reset_seconds=0.2)
+    stub.status = 500
+    for _ in range(2):
+        assert client.get_payment("1", "token")["status"] == 500
+    assert client.breaker.state == "open"
+
+    # Con el circuito abierto no se llama a Mercado Pago
+    with pytest.raises(MercadoPagoUnavailable):
+        client.get_payment("1", "token")
+    assert stub.calls == 2
+
+    time.sleep(0.25)
+    assert client.breaker.state == "half_open"
+    stub.status = 200
+    assert client.get_payment("1", "token")["response"]["status"] == "approved"
+    assert client.breaker.state == "closed"
+    assert client.breaker.opened_total == 1
+
+def test_failed_half_open_trial_reopens_the_circuit(stub):
+    client = _client(stub, failure_threshold=1, reset_seconds=0.2)
+    stub.status = 503
+    client.get_payment("1", "token")
+    assert client.breaker.state == "open"
+
+    time.sleep(0.25)
+    assert client.breaker.state == "half_open"
+    client.get_payment("1", "token")
+    assert client.breaker.state == "open"
+    assert client.breaker.opened_total == 2
+    assert stub.calls == 2
+
+def test_half_open_allows_a_single_trial_call(stub):
+    client = _client(stub, failure_threshold=1, reset_seconds=0.1)
+    stub.status = 500
+    client.get_payment("1", "token")
+    time.sleep(0.15)
+
+    assert client.breaker.allow()
+    assert not client.breaker.allow()
+    client.breaker.release()
+    assert client.breaker.allow()
+
+
+# --- Timeouts ---
+
+def test_read_timeout_raises_and_counts_as_failure(stub):
+    client = _client(stub, read_timeout=0.1, failure_threshold=1, reset_seconds=30)
+    stub.delay = 0.5
+
+    start = time.monotonic()
+    with pytest.raises(MercadoPagoError) as excinfo:
+        client.get_payment("1", "token")
+    assert time.monotonic() - start < 0.4
+    assert not isinstance(excinfo.value, MercadoPagoUnavailable)
+    assert client.breaker.state == "open"
+    assert client.status()["latency"]["payment.get"]["errors"] == 1
@@ -0,0 +1,91 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import crud
+import models
+import security
+from auth_cache import principal_cache
+from request_metrics import QueryBudgetExceeded, count_queries, request_query_budget
+from token_cache import totem_token_cache
+
+
+def _create_sellers(db, count=5, totems_per_seller=2, admin_index=0):
+    sellers = []
+    for i in range(count):
+        seller = models.Seller(name=f"Seller {i}", email=f"seller{i}@example.com", hashed_password="x",
+                               role="admin" if i == admin_index else "seller")
+        seller.totems = [models.Totem(external_pos_id=f"POS-{i}-{j}") for j in range(totems_per_seller)]
+        db.add(seller)
+        sellers.append(seller)
+    db.commit()
+    return sellers
+
+def _auth_headers(email):
+    return {"Authorization": f"Bearer {security.create_access_token({'sub': email})}"}
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    principal_cache.clear()
+    totem_token_cache.clear()
+    yield
+    principal_cache.clear()
+    totem_token_cache.clear()
+
+
+def test_request_budget_fails_when_no_request_is_measured(db):
+    with pytest.raises(QueryBudgetExceeded):
+        with request_query_budget(10):
+            crud.get_sellers(db)
+
+def test_request_budget_sees_queries_made_by_the_test_client(client, db):
+    _create_sellers(db)
+    with count_queries() as stats, request_query_budget(10) as captured:
+        client.get("/sellers/", headers=_auth_headers("seller1@example.com"))
+    # count_queries no ve el hilo de la app; la request sí se midió
+    assert stats.db_queries == 0
+    assert captured[0].route == "/sellers/"
+    assert captured[0].stats.db_queries > 0
+
+def test_request_budget_reports_repeated_statements(client, db):
+    _create_sellers(db)
+    with pytest.raises(QueryBudgetExceeded):
+        with request_query_budget(1):
+            client.get("/sellers/", headers=_auth_headers("seller1@example.com"))
+
+def test_list_sellers_loads_totems_eagerly(client, db):
+    _create_sellers(db, count=10)
+    # Principal (vendedor + tótems) y listado (vendedores + tótems), sin una consulta por vendedor
+    with request_query_budget(4, max_repeats=1):
+        response = client.get("/sellers/", headers=_auth_headers("seller1@example.com"))
+    assert response.status_code == 200
+    assert all(len(seller["totems"]) == 2 for seller in response.json())
+
+def test_admin_list_sellers_loads_totems_eagerly(client, db):
+    _create_sellers(db, count=10)
+    with request_query_budget(4, max_repeats=1):
+        response = client.get("/api/v1/admin/sellers", headers=_auth_headers("seller0@example.com"))
+    assert response.status_code == 200
+    assert len(response.json()) == 10
+
+def test_totem_token_loads_owner_with_the_totem(client, db):
+    seller = _create_sellers(db, count=1)[0]
+    seller.mp_access_token = "APP_USR-token"
+    seller.mp_refresh_token = "TG-refresh"
+    seller.mp_token_last_updated = datetime.now(timezone.utc).replace(tzinfo=None)
+    db.commit()
+    totem = seller.totems[0]
+    api_key = crud.create_totem_api_key(db, totem.id).api_key
+    headers = {"X-API-Key": api_key}
+
+    # Primera llamada: tótem y vendedor en una sola consulta
+    with request_query_budget(1):
+        response = client.get(f"/api/v1/totems/token/{totem.external_pos_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"mp_access_token": "APP_USR-token"}
+
+    # Siguientes: desde la caché de tokens, sin tocar la BD
+    with request_query_budget(0):
+        response = client.get(f"/api/v1/totems/token/{totem.external_pos_id}", headers=headers)
+    assert response.status_code == 200
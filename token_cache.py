@@ -0,0 +1,114 @@
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set, Tuple
+
+from settings import settings
+from shared_backend import SharedBackend, shared_backend
+
+# --- Caché de Tokens de Mercado Pago para Tótems ---
+#
+# Los tótems consultan su token de forma periódica y, al encenderse todos a la vez
+# (ej. a primera hora de la mañana), el endpoint recibe cientos de peticiones casi
+# simultáneas para los mismos vendedores. Este módulo evita ir a la base de datos en
+# cada petición y garantiza que sólo una petición por vendedor refresque el token
+# contra Mercado Pago (single-flight).
+#
+# Con varios workers, cada uno tiene su propia caché: las invalidaciones se difunden a
+# los demás por el pub/sub del backend compartido, y el lock de refresco es un lock
+# del backend, así que el refresco sigue siendo único entre todos los procesos.
+
+INVALIDATION_CHANNEL = "totem_token_cache"
+
+
+class TotemTokenCache:
+    """
+    Caché en memoria del access_token de Mercado Pago indexado por `external_pos_id`.
+    Cada entrada recuerda a qué vendedor pertenece para poder invalidar todas las
+    entradas de un vendedor cuando sus tokens cambian.
+    """
+
+    def __init__(self, backend: Optional[SharedBackend] = None):
+        self._lock = threading.Lock()
+        # external_pos_id -> (seller_id, access_token, expires_at)
+        self._entries: Dict[str, Tuple[int, str, datetime]] = {}
+        # seller_id -> {external_pos_id, ...}
+        self._by_seller: Dict[int, Set[str]] = {}
+        self.backend = backend
+        if backend is not None:
+            backend.subscribe(INVALIDATION_CHANNEL, self._on_invalidation)
+
+    def get(self, external_pos_id: str) -> Optional[str]:
+        """Devuelve el token cacheado si existe y no ha vencido."""
+        with self._lock:
+            entry = self._entries.get(external_pos_id)
+            if entry is None:
+                return None
+            seller_id, access_token, expires_at = entry
+            if expires_at <= datetime.now(timezone.utc):
+                self._discard(external_pos_id)
+                return None
+            return access_token
+
+    def put(self, external_pos_id: str, seller_id: int, access_token: str, expires_at: datetime):
+        """Guarda el token de un tótem hasta `expires_at` (UTC)."""
+        if expires_at <= datetime.now(timezone.utc):
+            return
+        with self._lock:
+            self._discard(external_pos_id)
+            self._entries[external_pos_id] = (seller_id, access_token, expires_at)
+            self._by_seller.setdefault(seller_id, set()).add(external_pos_id)
+
+    def invalidate_totem(self, external_pos_id: str):
+        """Invalida el tótem en este proceso y en los demás que compartan el backend."""
+        self._broadcast({"external_pos_id": external_pos_id})
+
+    def invalidate_seller(self, seller_id: int):
+        """Invalida los tótems del vendedor en este proceso y en los demás."""
+        self._broadcast({"seller_id": seller_id})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_seller.clear()
+
+    def _broadcast(self, message: dict):
+        if self.backend is None:
+            self._on_invalidation(message)
+        else:
+            # El backend entrega el mensaje también a este proceso
+            self.backend.publish(INVALIDATION_CHANNEL, message)
+
+    def _on_invalidation(self, message: dict):
+        with self._lock:
+            if message.get("external_pos_id") is not None:
+                self._discard(message["external_pos_id"])
+            if message.get("seller_id") is not None:
+                for external_pos_id in self._by_seller.pop(message["seller_id"], set()):
+                    self._entries.pop(external_pos_id, None)
+
+    def _discard(self, external_pos_id: str):
+        # Debe llamarse con self._lock adquirido
+        entry = self._entries.pop(external_pos_id, None)
+        if entry is None:
+            return
+        totems = self._by_seller.get(entry[0])
+        if totems is not None:
+            totems.discard(external_pos_id)
+            if not totems:
+                del self._by_seller[entry[0]]
+
+
+def seller_refresh_lock(seller_id: int):
+    """
+    Lock de refresco de tokens de un vendedor, compartido entre workers. Quien lo
+    adquiera debe volver a comprobar en la BD si el token sigue vencido antes de
+    llamar a Mercado Pago. Lanza LockTimeout si otro proceso lo retiene demasiado.
+    """
+    return shared_backend.lock(
+        f"mp_token_refresh:{seller_id}",
+        ttl_seconds=settings.MP_TOKEN_REFRESH_LOCK_TTL_SECONDS,
+        timeout_seconds=settings.MP_TOKEN_REFRESH_LOCK_TIMEOUT_SECONDS,
+    )
+
+
+totem_token_cache = TotemTokenCache(backend=shared_backend)
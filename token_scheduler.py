@@ -0,0 +1,258 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+import crud
+from token_cache import seller_refresh_lock
+
+logger = logging.getLogger(__name__)
+
+# --- Refresco Proactivo de Tokens de Mercado Pago ---
+#
+# En lugar de refrescar el token cuando un tótem lo pide (y hacer esperar a ese tótem
+# toda la llamada a Mercado Pago), este planificador mantiene un min-heap de vendedores
+# ordenado por el momento en que su token debe refrescarse y los refresca en segundo
+# plano antes de que queden vencidos.
+
+
+class TokenRefreshScheduler:
+    """
+    Planificador asíncrono de refrescos de tokens. Las llamadas a la base de datos y a
+    Mercado Pago son bloqueantes, así que se ejecutan en hilos con una concurrencia
+    acotada por un semáforo.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        refresh_after_seconds: float,
+        concurrency: int = 4,
+        max_retries: int = 5,
+        retry_base_seconds: float = 30.0,
+        sync_interval_seconds: float = 300.0,
+        client_factory: Optional[Callable] = None,
+    ):
+        self.session_factory = session_factory
+        self.refresh_after_seconds = refresh_after_seconds
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.sync_interval_seconds = sync_interval_seconds
+        # Permite inyectar un cliente falso en pruebas; por defecto crud usa mp_client
+        self.client_factory = client_factory
+
+        # Heap de (due_at, seller_id). Las entradas obsoletas se descartan al extraerlas
+        # comparando con self._due, que guarda la fecha vigente de cada vendedor.
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._attempts: Dict[int, int] = {}
+        self._in_flight: Set[int] = set()
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._workers: Set[asyncio.Task] = set()
+        self._next_sync_at = 0.0
+
+        self.refreshed_total = 0
+        self.failures_total = 0
+        self.gave_up_total = 0
+        self.last_sync_at: Optional[datetime] = None
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._next_sync_at = 0.0
+        self._task = asyncio.create_task(self._run())
+        logger.info("Planificador de refresco de tokens iniciado.")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        for worker in list(self._workers):
+            worker.cancel()
+        await asyncio.gather(self._task, *self._workers, return_exceptions=True)
+        self._task = None
+        self._workers.clear()
+        self._in_flight.clear()
+        logger.info("Planificador de refresco de tokens detenido.")
+
+    # --- API pública ---
+
+    def schedule(self, seller_id: int, due_at: float):
+        """Programa (o reprograma) el refresco de un vendedor para `due_at` (epoch)."""
+        self._due[seller_id] = due_at
+        heapq.heappush(self._heap, (due_at, seller_id))
+
+    def request_refresh(self, seller_id: int):
+        """
+        Pide un refresco inmediato. Puede llamarse desde hilos del threadpool de
+        FastAPI, por eso se delega en el event loop del planificador.
+        """
+        if not self.is_running or seller_id in self._in_flight:
+            return
+        self._loop.call_soon_threadsafe(self._request_refresh, seller_id)
+
+    def status(self) -> dict:
+        now = time.time()
+        earliest = min(self._due.values()) if self._due else None
+        return {
+            "running": self.is_running,
+            "queue_depth": len(self._due),
+            "in_flight": len(self._in_flight),
+            "overdue": sum(1 for due_at in self._due.values() if due_at <= now),
+            "lag_seconds": max(0.0, now - earliest) if earliest is not None else 0.0,
+            "next_refresh_in_seconds": max(0.0, earliest - now) if earliest is not None else None,
+            "refreshed_total": self.refreshed_total,
+            "failures_total": self.failures_total,
+            "gave_up_total": self.gave_up_total,
+            "last_sync_at": self.last_sync_at,
+        }
+
+    # --- Implementación ---
+
+    def _request_refresh(self, seller_id: int):
+        if seller_id not in self._in_flight and self._due.get(seller_id, 0) > time.time():
+            self.schedule(seller_id, time.time())
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            if now >= self._next_sync_at:
+                try:
+                    await self._sync()
+                except Exception as e:
+                    logger.error(f"Error sincronizando vendedores para refresco de tokens: {e}")
+                self._next_sync_at = now + self.sync_interval_seconds
+
+            while self._heap and self._heap[0][0] <= time.time():
+                due_at, seller_id = heapq.heappop(self._heap)
+                if self._due.get(seller_id) != due_at or seller_id in self._in_flight:
+                    continue
+                self._in_flight.add(seller_id)
+                worker = asyncio.create_task(self._refresh(seller_id))
+                self._workers.add(worker)
+                worker.add_done_callback(self._workers.discard)
+
+            next_wake = self._next_sync_at
+            if self._heap:
+                next_wake = min(next_wake, self._heap[0][0])
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_wake - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _sync(self):
+        """Carga desde la BD los vendedores conectados y su fecha de refresco."""
+        rows = await asyncio.to_thread(self._load_sellers)
+        connected = set()
+        for seller_id, last_updated in rows:
+            connected.add(seller_id)
+            if seller_id in self._in_flight or seller_id in self._attempts:
+                continue
+            due_at = self._due_at(last_updated)
+            if self._due.get(seller_id) != due_at:
+                self.schedule(seller_id, due_at)
+        # Vendedores desconectados o eliminados dejan de planificarse
+        for seller_id in list(self._due):
+            if seller_id not in connected:
+                del self._due[seller_id]
+                self._attempts.pop(seller_id, None)
+        self.last_sync_at = datetime.now(timezone.utc)
+
+    def _load_sellers(self):
+        db = self.session_factory()
+        try:
+            return crud.get_sellers_with_mp_tokens(db)
+        finally:
+            db.close()
+
+    def _due_at(self, last_updated: datetime) -> float:
+        return last_updated.replace(tzinfo=timezone.utc).timestamp() + self.refresh_after_seconds
+
+    async def _refresh(self, seller_id: int):
+        try:
+            async with self._semaphore:
+                last_updated = await asyncio.to_thread(self._refresh_seller, seller_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error refrescando el token del vendedor {seller_id}: {e}")
+            last_updated = None
+        finally:
+            self._in_flight.discard(seller_id)
+
+        if seller_id not in self._due:
+            return
+        if last_updated is not None:
+            self._attempts.pop(seller_id, None)
+            self.schedule(seller_id, self._due_at(last_updated))
+        else:
+            self.failures_total += 1
+            attempt = self._attempts.get(seller_id, 0) + 1
+            if attempt > self.max_retries:
+                # Se deja de reintentar hasta la próxima sincronización, que lo vuelve a planificar
+                logger.warning(
+                    f"Refresco del token del vendedor {seller_id} abandonado tras {self.max_retries} reintentos; "
+                    f"se reintentará tras la próxima sincronización."
+                )
+                self.gave_up_total += 1
+                del self._due[seller_id]
+                self._attempts.pop(seller_id, None)
+                return
+            self._attempts[seller_id] = attempt
+            # Backoff exponencial con jitter para no sincronizar reintentos entre vendedores
+            delay = self.retry_base_seconds * (2 ** (attempt - 1))
+            self.schedule(seller_id, time.time() + delay * random.uniform(0.5, 1.5))
+        self._wakeup.set()
+
+    def _refresh_seller(self, seller_id: int) -> Optional[datetime]:
+        """
+        Refresca un vendedor si su token sigue pendiente. Devuelve la nueva fecha de
+        actualización del token, o None si el refresco falló.
+        """
+        db = self.session_factory()
+        try:
+            seller = crud.get_seller(db, seller_id=seller_id)
+            if not seller or not seller.mp_refresh_token or not seller.mp_token_last_updated:
+                return None
+            # Mismo lock que el endpoint de tótems (compartido entre workers), para no
+            # refrescar dos veces a la vez
+            with seller_refresh_lock(seller_id):
+                # Se cierra la transacción de la lectura anterior: con REPEATABLE READ
+                # (MySQL) no se vería un refresco hecho por otro proceso mientras tanto
+                db.rollback()
+                db.refresh(seller)
+                previous = seller.mp_token_last_updated
+                if previous is None:
+                    return None
+                if self._due_at(previous) > time.time():
+                    # Otro proceso ya lo refrescó mientras esperábamos
+                    return previous
+                client = self.client_factory() if self.client_factory else None
+                seller = crud.refresh_seller_tokens(db, seller=seller, client=client)
+            if seller.mp_token_last_updated == previous:
+                return None
+            self.refreshed_total += 1
+            return seller.mp_token_last_updated
+        finally:
+            db.close()
@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import random
+import secrets
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from settings import settings
+from shared_backend import SharedBackend, shared_backend
+
+logger = logging.getLogger(__name__)
+
+# --- Autenticación de Tótems ---
+#
+# Cada tótem tiene sus propias API keys. En la base de datos sólo se guarda el SHA-256
+# de cada key: son valores aleatorios de 256 bits, así que no hace falta un hash lento
+# como bcrypt. Validar una request se reduce a calcular ese hash y buscarlo en un
+# índice en memoria (digest -> tótem), que se carga al arrancar y se recarga cada vez
+# que cambian las keys o los tótems: en este proceso al instante y en los demás workers
+# al recibir el aviso por el pub/sub del backend compartido, para que una key revocada
+# deje de valer en todos. El refresco periódico queda como respaldo por si se pierde un
+# aviso. La búsqueda es sobre el hash, así que su tiempo no revela cuántos caracteres
+# de la key eran correctos.
+#
+# La key compartida TOTEM_API_KEY se sigue aceptando (comparada en tiempo constante)
+# mientras TOTEM_LEGACY_API_KEY_ENABLED esté activo, para migrar la flota de a poco.
+
+KEY_PREFIX_LENGTH = 8
+RELOAD_CHANNEL = "totem_keys"
+
+
+class TotemPrincipal(NamedTuple):
+    """Tótem autenticado. `totem_id` es None si se usó la key compartida."""
+    key_id: Optional[int]
+    totem_id: Optional[int]
+    external_pos_id: Optional[str]
+    owner_id: Optional[int]
+
+
+LEGACY_PRINCIPAL = TotemPrincipal(None, None, None, None)
+
+
+def generate_key() -> str:
+    return secrets.token_urlsafe(32)
+
+def hash_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class AuthLog:
+    """
+    Log estructurado (una línea JSON por evento) de la autenticación de tótems. Los
+    registros se encolan y los escribe un hilo aparte (QueueListener), así que la
+    request nunca espera a la E/S; los éxitos se muestrean y los fallos se registran
+    siempre. Nunca se registra la key, sólo su prefijo.
+    """
+
+    def __init__(self, sample_rate: float = 0.01):
+        self.sample_rate = sample_rate
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._logger = logging.getLogger("totem_auth")
+        self._listener: Optional[QueueListener] = None
+
+    def start(self):
+        if self._listener is not None:
+            return
+        handlers = logging.getLogger().handlers or [logging.StreamHandler()]
+        self._listener = QueueListener(self._queue, *handlers, respect_handler_level=True)
+        self._logger.addHandler(QueueHandler(self._queue))
+        self._logger.propagate = False
+        self._listener.start()
+
+    def stop(self):
+        if self._listener is None:
+            return
+        self._listener.stop()
+        self._logger.handlers.clear()
+        self._logger.propagate = True
+        self._listener = None
+
+    def success(self, principal: TotemPrincipal):
+        if random.random() < self.sample_rate:
+            self._emit(logging.INFO, "ok", totem_id=principal.totem_id, key_id=principal.key_id,
+                       legacy=principal.totem_id is None, sample_rate=self.sample_rate)
+
+    def failure(self, reason: str, api_key: Optional[str]):
+        self._emit(logging.WARNING, "rejected", reason=reason, key_prefix=(api_key or "")[:KEY_PREFIX_LENGTH] or None)
+
+    def _emit(self, level: int, result: str, **fields):
+        self._logger.log(level, json.dumps({"event": "totem_auth", "result": result, **fields}))
+
+
+class TotemKeyIndex:
+    """Índice en memoria digest -> TotemPrincipal de las keys vigentes de tótems activos."""
+
+    def __init__(self, session_factory: Callable[[], Session], refresh_seconds: float = 30.0,
+                 backend: Optional[SharedBackend] = None):
+        self.session_factory = session_factory
+        self.refresh_seconds = refresh_seconds
+        self.backend = backend
+        # Identifica a este índice para no recargar dos veces con su propio aviso
+        self.node_id = uuid.uuid4().hex
+        if backend is not None:
+            backend.subscribe(RELOAD_CHANNEL, self._on_reload)
+        self._index: Dict[str, TotemPrincipal] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.loaded_at: Optional[float] = None
+        self.reloads_total = 0
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.is_running:
+            return
+        await asyncio.to_thread(self.reload)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Índice de API keys de tótems cargado ({len(self._index)} keys).")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # --- API pública ---
+
+    def authenticate(self, api_key: str) -> Optional[TotemPrincipal]:
+        """Devuelve el tótem de la key, LEGACY_PRINCIPAL si es la key compartida, o None."""
+        principal = self._index.get(hash_key(api_key))
+        if principal is not None:
+            return principal
+        if settings.TOTEM_LEGACY_API_KEY_ENABLED and hmac.compare_digest(api_key.encode(), settings.TOTEM_API_KEY.encode()):
+            return LEGACY_PRINCIPAL
+        return None
+
+    def reload(self, db: Optional[Session] = None):
+        """Vuelve a cargar el índice desde la BD (usa `db` si se pasa, si no abre una sesión)."""
+        own_session = db is None
+        if own_session:
+            db = self.session_factory()
+        try:
+            rows = db.query(
+                models.TotemApiKey.id, models.TotemApiKey.key_hash, models.Totem.id,
+                models.Totem.external_pos_id, models.Totem.owner_id,
+            ).join(models.Totem, models.Totem.id == models.TotemApiKey.totem_id).filter(
+                models.TotemApiKey.revoked_at.is_(None),
+                models.Totem.is_active.is_(True),
+            ).all()
+        finally:
+            if own_session:
+                db.close()
+        index = {key_hash: TotemPrincipal(key_id, totem_id, external_pos_id, owner_id)
+                 for key_id, key_hash, totem_id, external_pos_id, owner_id in rows}
+        with self._lock:
+            # Se reemplaza el diccionario entero: las lecturas concurrentes no necesitan lock
+            self._index = index
+            self.loaded_at = time.time()
+            self.reloads_total += 1
+
+    def invalidate(self, db: Optional[Session] = None):
+        """Recarga el índice en este proceso y avisa a los demás workers para que lo recarguen."""
+        self.reload(db)
+        if self.backend is not None:
+            self.backend.publish(RELOAD_CHANNEL, {"origin": self.node_id})
+
+    def status(self) -> dict:
+        return {
+            "running": self.is_running,
+            "keys": len(self._index),
+            "loaded_at": self.loaded_at,
+            "reloads_total": self.reloads_total,
+            "legacy_key_enabled": settings.TOTEM_LEGACY_API_KEY_ENABLED,
+        }
+
+    # --- Implementación ---
+
+    def _on_reload(self, message: dict):
+        if message.get("origin") != self.node_id:
+            self.reload()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await asyncio.to_thread(self.reload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error recargando el índice de API keys de tótems: {e}")
+
+
+totem_key_index = TotemKeyIndex(session_factory=SessionLocal, refresh_seconds=settings.TOTEM_KEY_REFRESH_SECONDS,
+                                backend=shared_backend)
+auth_log = AuthLog(sample_rate=settings.TOTEM_AUTH_LOG_SAMPLE_RATE)
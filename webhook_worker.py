@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+import crud
+from shared_backend import MemoryBackend, SharedBackend
+
+logger = logging.getLogger(__name__)
+
+# --- Procesamiento de Notificaciones de Mercado Pago ---
+#
+# El webhook guarda cada notificación en la tabla `webhook_notifications` y responde
+# de inmediato. Este pool de workers las reclama desde la base de datos y las procesa
+# con sesiones propias, reintentando con backoff exponencial. Como la cola es
+# persistente, un reinicio del proceso no pierde pagos: lo pendiente se retoma al
+# arrancar y lo que quedó a medias se recupera al vencer su lock. Las notificaciones
+# procesadas se borran pasado `done_retention_hours`, para que la tabla no crezca con
+# cada webhook recibido.
+
+
+class RecentNotifications:
+    """
+    IDs de pago con una notificación ya encolada y aún sin procesar, guardados en el
+    backend compartido para que la deduplicación valga entre workers (el webhook puede
+    llegar a un worker y procesarse en otro). Mercado Pago envía varias
+    notificaciones por pago (payment.created, payment.updated, reintentos); mientras
+    la primera siga pendiente, las demás no aportan nada porque el worker consultará
+    el estado más reciente igualmente. Cada entrada caduca tras `window_seconds` y el
+    worker la olvida al reclamar la notificación, de modo que los cambios posteriores
+    sí generan una nueva consulta. La tabla de notificaciones respalda esta caché.
+    """
+
+    def __init__(self, backend: SharedBackend, window_seconds: float = 10.0):
+        self.backend = backend
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self.coalesced_total = 0
+
+    @staticmethod
+    def _key(resource_id: str) -> str:
+        return f"webhook_pending:{resource_id}"
+
+    def add(self, resource_id: str) -> bool:
+        """Registra el ID. Devuelve False si ya estaba pendiente (notificación redundante)."""
+        if self.backend.add(self._key(resource_id), "1", self.window_seconds):
+            return True
+        with self._lock:
+            self.coalesced_total += 1
+        return False
+
+    def forget(self, resource_id: str):
+        self.backend.delete(self._key(resource_id))
+
+
+class WebhookWorkerPool:
+    """
+    Pool de workers asíncronos. Las llamadas a la base de datos y a Mercado Pago son
+    bloqueantes, así que cada notificación se procesa en un hilo.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        workers: int = 2,
+        batch_size: int = 10,
+        poll_interval_seconds: float = 2.0,
+        max_attempts: int = 8,
+        retry_base_seconds: float = 10.0,
+        lock_timeout_seconds: float = 300.0,
+        dedup_window_seconds: float = 10.0,
+        done_retention_hours: float = 72.0,
+        purge_interval_seconds: float = 3600.0,
+        backend: Optional[SharedBackend] = None,
+        handler: Optional[Callable[[Session, str], None]] = None,
+    ):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self.done_retention_hours = done_retention_hours
+        self.purge_interval_seconds = purge_interval_seconds
+        # Permite inyectar un procesador falso en pruebas
+        self.handler = handler or crud.process_payment_notification
+        self.recent = RecentNotifications(backend or MemoryBackend(), window_seconds=dedup_window_seconds)
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+        self.processed_total = 0
+        self.failed_total = 0
+        self.dead_total = 0
+        self.purged_total = 0
+
+    # --- Ciclo de vida ---
+
+    @property
+    def is_running(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    async def start(self):
+        if self.is_running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._purger()))
+        logger.info(f"Pool de webhooks iniciado con {self.workers} workers.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Pool de webhooks detenido.")
+
+    # --- API pública ---
+
+    def notify(self):
+        """
+        Avisa a los workers de que hay trabajo nuevo, sin esperar al siguiente sondeo.
+        Puede llamarse desde hilos del threadpool de FastAPI.
+        """
+        if self.is_running:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def status(self) -> dict:
+        db = self.session_factory()
+        try:
+            counts = crud.count_webhook_notifications_by_status(db)
+        finally:
+            db.close()
+        return {
+            "running": self.is_running,
+            "workers": self.workers,
+            "queue": counts,
+            "processed_total": self.processed_total,
+            "failed_total": self.failed_total,
+            "dead_total": self.dead_total,
+            "purged_total": self.purged_total,
+            "coalesced_total": self.recent.coalesced_total,
+        }
+
+    # --- Implementación ---
+
+    async def _worker(self):
+        while True:
+            try:
+                claimed = await asyncio.to_thread(self._process_batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reclamando notificaciones de Mercado Pago: {e}")
+                claimed = 0
+            if claimed:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purger(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.purge_done)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error borrando notificaciones procesadas: {e}")
+            await asyncio.sleep(self.purge_interval_seconds)
+
+    def purge_done(self) -> int:
+        """Borra las notificaciones 'done' más antiguas que la ventana de retención."""
+        db = self.session_factory()
+        try:
+            cutoff = datetime.utcnow() - timedelta(hours=self.done_retention_hours)
+            purged = crud.purge_done_webhook_notifications(db, older_than=cutoff)
+        finally:
+            db.close()
+        if purged:
+            self.purged_total += purged
+            logger.info(f"Borradas {purged} notificaciones de Mercado Pago ya procesadas.")
+        return purged
+
+    def _process_batch(self) -> int:
+        db = self.session_factory()
+        try:
+            notifications = crud.claim_webhook_notifications(
+                db, limit=self.batch_size, lock_timeout_seconds=self.lock_timeout_seconds
+            )
+            # Varias notificaciones del mismo pago se resuelven con una sola consulta a MP
+            by_resource: Dict[str, List[int]] = {}
+            for notification in notifications:
+                by_resource.setdefault(notification.resource_id, []).append(notification.id)
+            for resource_id, notification_ids in by_resource.items():
+                # A partir de aquí, una nueva notificación de este pago sí debe encolarse
+                self.recent.forget(resource_id)
+                self._process_one(db, notification_ids, resource_id)
+            return len(notifications)
+        finally:
+            db.close()
+
+    def _process_one(self, db: Session, notification_ids: List[int], resource_id: str):
+        try:
+            self.handler(db, resource_id)
+        except Exception as e:
+            db.rollback()
+            self.failed_total += 1
+            for notification_id in notification_ids:
+                db_notification = crud.fail_webhook_notification(
+                    db, notification_id, error=str(e),
+                    max_attempts=self.max_attempts, retry_base_seconds=self.retry_base_seconds
+                )
+                if db_notification is not None and db_notification.status == "dead":
+                    self.dead_total += 1
+                    logger.error(f"Notificación {notification_id} (pago {resource_id}) movida a dead-letter: {e}")
+            return
+        for notification_id in notification_ids:
+            crud.complete_webhook_notification(db, notification_id)
+        self.processed_total += 1